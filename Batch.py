@@ -0,0 +1,143 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Auxillary import Config, Methods
+from model.Metrics import metrics
+from View import View
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Pool
+import json
+
+
+# the View of a worker process, set up once per process by _init_worker
+_view = None
+
+
+def _init_worker(tree, dist):
+    global _view
+    # every query reaches a worker only once, so a result cache would only cost memory
+    # a forked worker starts with a copy of the metrics of the main process (e.g. of the build),
+    # only the work of its own queries may be sent back
+    metrics.reset()
+    _view = View(tree=tree, dist=dist, cache_size=0)
+
+
+def _answer(job):
+    """
+    answers a single query in a worker process
+    :param job: tuple of the query word, the maximum distance and the number of closest words (one of them is None)
+    :return: tuple of the result as one line of JSON, the filter statistics and the metrics of the query
+    """
+    word, d, k = job
+    return Batch.answer(_view, word, d, k), _view.filter_stats(reset=True), metrics.take()
+
+
+class Batch:
+    """
+    Non-interactive query mode: answers every word of a query file (or stdin) with either
+    all words within a maximum distance or the k closest words
+    queries are deduplicated and spread over worker processes, the workers get the tree once when they start
+    (a tree opened from an index file is passed as its path, so all workers share the memory mapped pages)
+    the results are written as JSON lines while the queries are being read, so memory stays flat
+    """
+
+    def __init__(self, tree, dist, d=None, k=None, workers=None):
+        assert (d is None) != (k is None), "either a maximum distance or a number of closest words is needed"
+        self.tree = tree
+        self.dist = dist
+        self.d = d
+        self.k = k
+        self.workers = workers or Methods.thread_count()
+        self.queries = 0
+        self.duplicates = 0
+        # words ruled out by each lower bound and exact distances calculated, summed over all queries
+        self.rejected = {}
+        self.exact = 0
+
+    @staticmethod
+    def answer(view, word, d, k):
+        """
+        :return: the matches of a query as one line of JSON, see result()
+        """
+        return json.dumps(Batch.result(word, Batch.search(view, word, d, k)), ensure_ascii=False)
+
+    @staticmethod
+    def search(view, word, d, k):
+        """
+        :return: dictionary of the matches of a query and their distance,
+        all words within d or the k closest words (one of d and k is None)
+        """
+        return view.search(word, d=d, k=k)
+
+    @staticmethod
+    def result(word, matches):
+        """
+        :return: the matches of a query in the output format, e.g.
+        {"query": "hose", "matches": [["hase", 1], ["hosen", 1]]}, sorted by distance and then alphabetically
+        the query word itself is left out, just like in the interactive mode
+        """
+        matches = sorted((dist, match) for match, dist in matches.items() if match != word)
+        return {"query": word, "matches": [[match, dist] for dist, match in matches]}
+
+    def _count(self, stats):
+        """ adds the filter statistics of a query (see View.filter_stats) """
+        for stage, count in stats["rejected"].items():
+            self.rejected[stage] = self.rejected.get(stage, 0) + count
+        self.exact += stats["exact"]
+
+    def _unique(self, lines):
+        """
+        yields every query word once, empty lines are skipped
+        the words seen last are kept in a bounded window (Config.batch_dedup_size), so memory stays flat;
+        a word that repeats after it has left the window is answered again
+        """
+        seen = OrderedDict()
+        for line in lines:
+            word = line.strip()
+            if not word:
+                continue
+            self.queries += 1
+            if word in seen:
+                seen.move_to_end(word)
+                self.duplicates += 1
+                continue
+            seen[word] = None
+            if len(seen) > Config.batch_dedup_size:
+                seen.popitem(last=False)
+            yield word, self.d, self.k
+
+    def run(self, lines, out):
+        """
+        answers all queries and writes the results
+        the queries are handed to the pool in blocks, so that no more than one block is in memory at a time
+        :param lines: iterable of query words, one per line (e.g. an open file or sys.stdin)
+        :param out: file the JSON lines are written to
+        :return: number of answered queries
+        """
+        jobs = self._unique(lines)
+        answered = 0
+        if self.workers <= 1:
+            view = View(tree=self.tree, dist=self.dist, cache_size=0)
+            for word, d, k in jobs:
+                out.write(self.answer(view, word, d, k) + "\n")
+                answered += 1
+            self._count(view.filter_stats())
+            return answered
+
+        block_size = self.workers * Config.batch_chunk_size * 4
+        with Pool(self.workers, initializer=_init_worker, initargs=(self.tree, self.dist)) as pool:
+            while True:
+                block = list(islice(jobs, block_size))
+                if not block:
+                    break
+                for line, stats, snapshot in pool.imap(_answer, block, chunksize=Config.batch_chunk_size):
+                    out.write(line + "\n")
+                    self._count(stats)
+                    metrics.merge(snapshot)
+                answered += len(block)
+                out.flush()
+        return answered
@@ -0,0 +1,268 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Auxillary import Methods
+from model.BKTree import BKTree
+from model.PivotTable import PivotTable, Scan
+from model.Registry import registry
+from View import View
+from contextlib import redirect_stdout
+from random import Random
+from time import perf_counter
+import argparse
+import io
+import json
+import platform
+import sys
+import tracemalloc
+import numpy
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+class WordGenerator:
+    """
+    Seeded generator for synthetic word lists, the same seed always gives the same list
+    the words are made of letters drawn with the frequencies of German text, and a part of them are
+    small variations (one letter replaced, inserted or removed) of other words, so that queries with small radii
+    find something, like they would in a real word list
+    """
+
+    letters = "enisratdhulcgmobwfkzpvjyxq"
+    weights = [17.4, 9.8, 7.6, 7.3, 7.0, 6.5, 6.2, 5.1, 4.8, 4.4, 4.4, 3.4, 3.0, 3.0, 2.5, 2.5, 1.9, 1.7, 1.2, 1.1,
+               0.8, 0.7, 0.3, 0.1, 0.1, 0.1]
+    # share of the words that are variations of earlier words
+    variations = 0.3
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def words(self, n):
+        """
+        :param n: number of distinct words
+        :return: list of n distinct words in the order they were generated
+        """
+        random = Random(self.seed)
+        words = []
+        seen = set()
+        while len(words) < n:
+            if words and random.random() < self.variations:
+                word = self._vary(random, random.choice(words))
+            else:
+                length = min(max(int(random.gauss(8, 2.5)), 2), 16)
+                word = "".join(random.choices(self.letters, self.weights, k=length))
+            if word and word not in seen:
+                seen.add(word)
+                words.append(word)
+        return words
+
+    def queries(self, words, n):
+        """
+        :return: n query words, half of them taken from the list and half of them variations of listed words
+        """
+        random = Random(self.seed + 1)
+        return [word if i % 2 else self._vary(random, word) for i, word in enumerate(random.choices(words, k=n))]
+
+    def _vary(self, random, word):
+        position = random.randrange(len(word) + 1)
+        letter = random.choices(self.letters, self.weights)[0]
+        change = random.randrange(3)
+        if change == 0:
+            return word[:position] + letter + word[position:]
+        if change == 1 and len(word) > 2:
+            return word[:position] + word[position + 1:]
+        return word[:position] + letter + word[position + 1:]
+
+
+class Benchmark:
+    """
+    Times the distance kernels, the construction of the index in every mode and the queries,
+    and records the peak memory of every build (of the main process, the workers are only measured per run)
+    every result is stored under a name like "build/lev/10000/workers=4" with its time in seconds and,
+    if it consists of many operations, the time per operation in microseconds
+    the results can be written to a JSON file and compared to an earlier one, see compare()
+    """
+
+    metrics = ["lev", "ham", "jac", "jar"]
+
+    def __init__(self, sizes, metrics=None, queries=100, kernel_size=10000, workers=None, seed=0, memory=True):
+        self.sizes = sizes
+        self.metrics = metrics or Benchmark.metrics
+        self.queries = queries
+        self.kernel_size = kernel_size
+        # the parallel modes: a single process and all cpus (if there is more than one)
+        cpus = workers or Methods.thread_count()
+        self.modes = sorted({1, cpus})
+        self.generator = WordGenerator(seed)
+        self.seed = seed
+        self.memory = memory
+        self.results = {}
+
+    def run(self):
+        """
+        :return: dictionary with information about the machine and the results
+        """
+        self.results = {}
+        for metric in self.metrics:
+            self._kernel(metric)
+        for size in self.sizes:
+            words = self.generator.words(size)
+            queries = self.generator.queries(words, self.queries)
+            for metric in self.metrics:
+                self._build_and_query(metric, words, queries)
+        return {"meta": self.meta(), "results": self.results}
+
+    def meta(self):
+        return {"python": platform.python_version(), "numpy": numpy.__version__, "machine": platform.machine(),
+                "cpus": Methods.thread_count(), "seed": self.seed, "sizes": self.sizes, "queries": self.queries,
+                # peak resident memory of the whole run (kilobytes on Linux), of this process and of the largest
+                # worker process, the worker processes of the parallel builds are not measured per build
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+                "max_worker_rss_mb": (round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+                                      if resource else None)}
+
+    def _record(self, name, seconds, operations=None, **extra):
+        result = {"seconds": round(seconds, 6)}
+        if operations:
+            result["per_op_us"] = round(seconds / operations * 1e6, 3)
+        result.update(extra)
+        self.results[name] = result
+        print(f"{name:<45} {seconds:>10.4f}s" + (f" {result['per_op_us']:>12.3f}us/op" if operations else "")
+              + "".join(f" {key}={value}" for key, value in extra.items()), file=sys.stderr)
+
+    def _kernel(self, metric):
+        """ times the scalar and the batch kernel of a metric on the same word pairs """
+        words = self.generator.words(self.kernel_size)
+        query = words[len(words) // 2]
+        scalar = registry.get(metric).dist
+        batch = registry.get(metric).many
+        sample = words[:min(len(words), 2000)]
+        start = perf_counter()
+        for word in sample:
+            scalar(word, query)
+        self._record(f"kernel/{metric}/scalar", perf_counter() - start, len(sample))
+        start = perf_counter()
+        batch(query, words)
+        self._record(f"kernel/{metric}/batch", perf_counter() - start, len(words))
+
+    @staticmethod
+    def _build(metric, words, workers, engine="bktree"):
+        with redirect_stdout(io.StringIO()):
+            if engine == "pivot":
+                return PivotTable(list(words), edit_dist=metric, workers=workers)
+            if engine == "scan":
+                return Scan(list(words), edit_dist=metric, workers=workers)
+            return BKTree(list(words), edit_dist=metric, workers=workers)
+
+    def _measure_build(self, name, metric, words, workers, engine="bktree"):
+        """
+        builds the index and records the time of the build under the given name
+        :return: the index
+        """
+        start = perf_counter()
+        index = self._build(metric, words, workers, engine)
+        seconds = perf_counter() - start
+        extra = {}
+        if self.memory:
+            # measured in a second build, since tracing the allocations slows the build down
+            # (only the allocations of this process, the worker processes are not traced)
+            tracemalloc.start()
+            self._build(metric, words, workers, engine)
+            extra["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            tracemalloc.stop()
+        self._record(name, seconds, len(words), **extra)
+        return index
+
+    def _build_and_query(self, metric, words, queries):
+        size = len(words)
+        # the BK-tree is built in every mode for every metric
+        for workers in self.modes:
+            index = self._measure_build(f"build/{metric}/{size}/workers={workers}", metric, words, workers)
+        # the queries are answered by the default engine of the metric, which is built as well if it is another one
+        # (a scan has nothing to build in parallel)
+        engine = registry.get(metric).engine
+        if engine != "bktree":
+            for workers in self.modes if engine == "pivot" else [1]:
+                index = self._measure_build(f"build/{metric}/{size}/{engine}/workers={workers}", metric, words,
+                                            workers, engine)
+
+        view = View(index.tree, metric, cache_size=0)
+        # the scaled metrics are queried with radii of the same share of their range
+        scale = registry.get(metric).radius
+        for radius in (1, 2, 3):
+            start = perf_counter()
+            matches = sum(len(view.search(query, d=radius * scale)) for query in queries)
+            self._record(f"query/{metric}/{size}/d={radius * scale}", perf_counter() - start, len(queries),
+                         matches=matches)
+        start = perf_counter()
+        for query in queries:
+            view.search(query, k=5)
+        self._record(f"query/{metric}/{size}/k=5", perf_counter() - start, len(queries))
+
+    @staticmethod
+    def compare(results, baseline, tolerance=0.25, minimum=0.001):
+        """
+        compares results with those of an earlier run
+        :param results: output of run()
+        :param baseline: output of an earlier run()
+        :param tolerance: how much slower (as a share) a result may be before it counts as a regression
+        :param minimum: results faster than this (in seconds) in both runs are too noisy and are not compared
+        :return: list of (name, baseline seconds, seconds, change) of the regressions, slowest first
+        """
+        regressions = []
+        for name, result in results["results"].items():
+            old = baseline["results"].get(name)
+            if old is None or max(old["seconds"], result["seconds"]) < minimum:
+                continue
+            change = result["seconds"] / max(old["seconds"], 1e-9) - 1
+            if change > tolerance:
+                regressions.append((name, old["seconds"], result["seconds"], round(change, 3)))
+        return sorted(regressions, key=lambda regression: regression[3], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measures the speed of the distance kernels, the build and queries")
+    parser.add_argument("--sizes", type=str, default="1000,10000",
+                        help="comma separated sizes of the generated word lists (1000 up to 1000000)")
+    parser.add_argument("--dist", "-d", type=str, default=",".join(Benchmark.metrics),
+                        help="comma separated metrics to measure")
+    parser.add_argument("--queries", "-q", type=int, default=100, help="number of queries per list")
+    parser.add_argument("--workers", "-w", type=int, required=False,
+                        help="number of processes of the parallel build (default: number of cpus)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the word list generator")
+    parser.add_argument("--no-memory", action="store_true", help="skip the second build that measures peak memory")
+    parser.add_argument("--out", "-o", type=str, required=False, help="JSON file the results are written to")
+    parser.add_argument("--baseline", "-b", type=str, required=False,
+                        help="JSON file of an earlier run, the program fails if a result got slower")
+    parser.add_argument("--tolerance", "-t", type=float, default=0.25,
+                        help="how much slower than the baseline a result may be (default: 0.25 = 25%%)")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(sizes=[int(size) for size in args.sizes.split(",")], metrics=args.dist.split(","),
+                          queries=args.queries, workers=args.workers, seed=args.seed, memory=not args.no_memory)
+    results = benchmark.run()
+    if args.out:
+        with open(args.out, "w", encoding="UTF-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline, encoding="UTF-8") as f:
+            baseline = json.load(f)
+        regressions = Benchmark.compare(results, baseline, args.tolerance)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.4f}s -> {new:.4f}s (+{change:.0%})", file=sys.stderr)
+        if regressions:
+            sys.exit(f"{len(regressions)} results are more than {args.tolerance:.0%} slower than the baseline.")
+        print("No regressions compared to the baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
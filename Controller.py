@@ -4,121 +4,284 @@
 # 4. Semester
 
 
-from model.Auxillary import Config, Art
+from model.Auxillary import Config, Art, Methods
 from model.BKTree import BKTree
-from model.tests import BKTreeTests
-from model.Visualizer import Visualizer
+from model.Cache import BuildCache
+from model.Metrics import metrics
+from model.NodeStore import NodeStore
+from model.PivotTable import PivotTable, Scan
+from model.Registry import registry
 from View import View
-import ntpath
-import os
-import pickle
+from Batch import Batch
+from Server import Server
+import asyncio
 
 
 class Controller:
 
-    def __init__(self, path, demo, dist):
+    def __init__(self, path, demo, dist, workers=None, add=None, remove=None, queries=None, out=None, radius=None,
+                 k=None, serve=None, pivot=None, engine=None,
+                 separator=None, metrics_path=None, plot=None, plot_root=None, plot_depth=None, verify=False):
         self.path = path
-        self.file = self._load()
+        self.workers = workers
+        # files with words to add to or remove from a saved tree
+        self.add = add
+        self.remove = remove
+        # batch mode: open file with one query per line, file the results are written to and radius or k
+        self.queries = queries
+        self.out = out
+        self.radius = radius
+        self.k = k
+        # server mode: port the queries are answered on
+        self.serve = serve
         self.dist = dist or "lev"
-        self.file_name = f"{self.file[1]}_{self.dist[:3]}"
-        self.word_list = self.file[0]
+        self.metric = registry.get(self.dist)
+        # string between the words of the word list files, guessed from the beginning of each file if not given
+        self.separator = separator if separator is not None else Config.separator
+        # JSON file the metrics of the run are written to when the program ends
+        self.metrics_path = metrics_path
+        # strategy for choosing the root of new trees, see BKTree.choose_root
+        self.pivot = pivot
+        # BK-tree, pivot table or scan, by default a BK-tree for true metrics and a scan otherwise (Metric.engine)
+        self.engine = engine or self.metric.engine
+        # build options that change the generated files, they are part of the cache key
+        self.options = [option for option in (pivot, self.engine) if option not in (None, "first", "bktree")]
         self.save = demo != "demo"
+        # "show" opens the graph of small trees in a window, "png" saves it, "svg" and "dot" write trees of any size,
+        # by default nothing is drawn, so the plotting libraries are never imported
+        self.plot = plot
+        # word whose subtree is drawn and number of levels below it, the whole tree by default
+        self.plot_root = plot_root
+        self.plot_depth = plot_depth
+        # check a loaded index for consistency, which reads all of it instead of only the pages queries touch
+        self.verify = verify
+        # the files of a tree are named after the content of the cleaned word list (see BuildCache),
+        # the word list is only read and cleaned if the cache does not know the file yet
+        self.cache = BuildCache(Config.output_dir)
+        self.word_list = None
+        self.file_name = self.cache.lookup(self.path, self.dist, self.options)
 
-    def _load_saved_pickle(self):
+    def _load_saved_index(self):
         """
-        If a pickle file corresponding to the input word list was found,
-        this method will load the tree and generate a graph for it
+        If an index file corresponding to the input word list was found,
+        this method will open the tree (and draw a graph for it if asked to)
+        the index is memory mapped, so only the parts of it that queries touch are actually read
         """
         print("A tree was already generated for this word list. Loading...")
 
-        with open(f"output/{self.file_name}.pickle", "rb") as f:
-            self.tree = pickle.load(f)
+        path = self.cache.index_path(self.file_name)
+        self.cache.touch(self.file_name)
+        if PivotTable.is_index(path):
+            self.tree = self._open_table(path)
+            if self.engine == "scan":
+                print(f"The word list has {len(self.tree)} words, every query is compared with all of them.")
+            else:
+                print(f"The pivot table has {len(self.tree)} words and {len(self.tree.pivots)} pivots.")
+            if self.verify:
+                print("No problems found." if self.tree.verify() else "The pivot table is not consistent!")
+            return
+        store, _ = NodeStore.open(path)
+        self.tree = store.node(0)
 
-        # making sure the tree that was loaded was built correctly
-        tester = BKTreeTests(self.tree)
-        print(tester.test_if_tree_is_correct())
-
-        # graph is being generated and shown if not too long
-        if len(self.word_list) >= Config.max_items:
-            print("Cannot plot graph since tree is too large.")
-        else:
-            vis = Visualizer(self.tree)
-            graph = vis.graph
-            graph.show()
+        # with --verify, making sure the tree that was loaded was built correctly
+        if self.verify:
+            print("No problems found." if store.verify() else "Tree is not a BK tree!")
+        if self.plot:
+            self._plot(BKTree.from_store(store, edit_dist=self.dist))
 
     def _generate_new_files(self):
         """
         If the input word list has not previously been used,
-        a new tree and a new graph will be generated
-        in demo mode, only the graph will be shown and no files will be stored
-        otherwise the tree will be stored in a pickle file (and in text format) and the graph will be saved as a png
+        a new tree will be generated (and a graph drawn if asked to)
+        in demo mode no files will be stored,
+        otherwise the tree will be stored in an index file (and in text format)
         """
+        if self.engine in ("pivot", "scan"):
+            self._generate_pivot_table()
+            return
         print("Tree is being generated...")
-        tree = BKTree(self.word_list, edit_dist=self.dist)
+        tree = BKTree(self.word_list, edit_dist=self.dist, workers=self.workers, pivot=self.pivot, cleaned=True)
         self.tree = tree.tree
         print(f"The maximum height of the tree is {tree.max_depth} and it has {len(self.word_list)} nodes.")
-        if len(self.word_list) <= Config.max_items:
-            print("Plotting graph...")
-        graph = tree.graph
+        stats = tree.statistics()
+        print(f"Root '{stats['root']}' ({stats['pivot']}) has {stats['root_children']} children, "
+              f"the mean depth is {stats['mean_depth']} and inner nodes have {stats['mean_children']} children "
+              f"on average.")
         if self.save:
-            self._save_files(tree=tree, graph=graph, file_name=self.file_name)
-        try:
-            graph.show()
-        except AttributeError:
-            pass
+            self._save_files(tree=tree, file_name=self.file_name)
+        if self.plot:
+            self._plot(tree)
+
+    def _generate_pivot_table(self):
+        """
+        builds a pivot table or a scan instead of a tree, there is no graph for them
+        """
+        if self.engine == "scan":
+            table = Scan(self.word_list, edit_dist=self.dist, workers=self.workers, cleaned=True)
+            print(f"The word list has {table.length} words, every query is compared with all of them.")
+        else:
+            print("Pivot table is being generated...")
+            table = PivotTable(self.word_list, edit_dist=self.dist, workers=self.workers, cleaned=True)
+            stats = table.statistics()
+            print(f"The table has {stats['words']} words and {stats['pivots']} pivots, a typical query has to look "
+                  f"at {stats['visited_share']:.1%} of the words.")
+        self.tree = table.tree
+        if self.save:
+            self._save_files(tree=table, file_name=self.file_name)
 
     def _load(self):
         """
         Loads the word list from input file and does a bit of pre processing
-        assuming there is one word per line in the file
-        :return:
-        a tuple consisting of the word list and the name of the file without extension
+        the file is streamed and cleaned word by word, only the distinct words are kept in memory
+        the cache key of the cleaned list becomes the name of the generated files,
+        and the builders get the list as it is instead of cleaning it again
         """
-        with open(file=self.path, encoding="UTF-8") as file:
-            text = file.read()
+        with metrics.phase("clean"):
+            self.word_list = Methods.clean_list(Methods.read_words(self.path, self.separator))
+        self.file_name = BuildCache.key(self.word_list, self.dist, self.options)
+        self.cache.remember(self.path, self.dist, self.file_name, self.options)
 
-        word_list = ""
-
-        # finding out what separator is used
-        word_list_type = text[:50]
+    def _apply_diff(self, base):
+        """
+        Adds and removes words to and from a saved tree instead of building it again,
+        removed words are left as tombstones first and then cleared out by compacting the tree
+        the updated tree is saved under a key made of the base key and the changes (see BuildCache.diff_key),
+        so the word list file keeps pointing to the tree of its own content, and applying the same changes again
+        opens the saved result
+        :param base: cache key of the saved tree the changes are applied to
+        """
+        added = removed = []
+        if self.add:
+            added = list(Methods.clean_words(Methods.read_words(self.add, self.separator)))
+        if self.remove:
+            removed = list(Methods.clean_words(Methods.read_words(self.remove, self.separator)))
+        self.file_name = BuildCache.diff_key(base, added, removed)
+        if self.cache.has(self.file_name):
+            self._load_saved_index()
+            return
 
-        if "\n" in word_list_type: word_list = text.split("\n")
-        elif "," in word_list_type: word_list = text.split(",")
-        elif " " in word_list_type: word_list = text.split()
+        print("Applying the changes to the saved tree...")
+        path = self.cache.index_path(base)
+        if PivotTable.is_index(path):
+            tree = self._open_table(path)
+        else:
+            tree = BKTree.from_store(NodeStore.open(path)[0], edit_dist=self.dist)
+        added = sum(map(tree.insert, added))
+        removed = sum(map(tree.delete, removed))
+        reinserted = tree.compact()
+        print(f"{added} words were added and {removed} words were removed, "
+              f"{reinserted} words had to be sorted in again. The tree now has {tree.length} nodes.")
 
-        # determining the file name excl extension
-        file_name = ntpath.basename(file.name)
-        file_name = file_name.strip(".txt")
+        self.tree = tree.tree
+        if self.save:
+            self._save_files(tree=tree, file_name=self.file_name)
 
-        return word_list, file_name
+    def _open_table(self, path):
+        """ opens a saved pivot table, as a Scan if the word list is queried with one """
+        return (Scan if self.engine == "scan" else PivotTable).open(path)
 
     @staticmethod
-    def _save_files(tree, file_name, graph):
+    def _save_files(tree, file_name):
         """
-        Saves the tree in a pickle file and a text version of the tree in a .txt file
-        The graph is also being saved in a png file
-        :param tree: tree object generated by _generate_new_files method
+        Saves the tree in a binary index file and a text version of the tree in a .txt file,
+        which is written line by line and can be read back with BKTree.read_text
+        :param tree: tree object generated by _generate_new_files method (BKTree or PivotTable)
         :param file_name: name of the word list file without extension
-        :param graph: graph visualization of the tree
         """
-        with open(f"output/{file_name}.pickle", "wb") as f:
-            pickle.dump(tree.tree, f)
-        with open(f"output/{file_name}_result.txt", "w", encoding="UTF-8") as f:
-            f.write(str(tree.tree))
+        with metrics.phase("save"):
+            tree.save(f"{Config.output_dir}/{file_name}.bkidx")
+            with open(f"{Config.output_dir}/{file_name}_result.txt", "w", encoding="UTF-8") as f:
+                tree.write_text(f)
 
+    def _plot(self, tree):
+        """
+        draws the graph of the tree or of the subtree chosen with --plot-root and --plot-depth
+        svg and dot files are written next to the index for trees of any size,
+        small graphs are shown in a window or, with --plot png or without a display, saved as a png
+        :param tree: BKTree or PivotTable (which has no graph)
+        """
+        print("Plotting graph...")
         try:
-            graph.savefig(f"output/{file_name}.png", bbox_inches="tight", dpi=100)
-        except AttributeError:
-            pass
+            if self.plot in ("svg", "dot"):
+                renderer = tree.renderer(self.plot_root, self.plot_depth)
+                if renderer is not None:
+                    path = f"{Config.output_dir}/{self.file_name}.{self.plot}"
+                    count = renderer.write_svg(path) if self.plot == "svg" else renderer.write_dot(path)
+                    print(f"The graph of {count} nodes was saved in {path}.")
+                    return
+                graph = None
+            else:
+                graph = tree.get_graph(headless=self.plot == "png", root=self.plot_root, max_depth=self.plot_depth)
+        except KeyError:
+            print(f"'{self.plot_root}' is not part of the tree.")
+            return
+        if graph is None:
+            print("Cannot plot graph for this index.")
+            return
+        if self.plot == "show" and graph.get_backend().lower() != "agg":
+            graph.show()
+        else:
+            path = f"{Config.output_dir}/{self.file_name}.png"
+            graph.savefig(path, bbox_inches="tight", dpi=100)
+            print(f"The graph was saved in {path}.")
 
     def main(self):
-        os.makedirs("output", exist_ok=True)
-        # If the word list has been previously used, the tree will be loaded from the pickle file
-        if os.path.exists(f"output/{self.file_name}.pickle"):
-            self._load_saved_pickle()
+        try:
+            self._main()
+        finally:
+            # also written when the interactive mode is ended
+            if self.metrics_path:
+                metrics.dump(self.metrics_path)
+
+    def _main(self):
+        # changes to the word list can be applied to the tree that was last saved for the file
+        if self.add or self.remove:
+            base = self.cache.previous(self.path, self.dist, self.options)
+            if base is None:
+                raise SystemExit(f"There is no saved tree for {self.path} yet, --add and --remove can only be applied "
+                                 f"to a tree that was built (without -m demo) before.")
+            self._apply_diff(base)
         else:
-            # otherwise the tree will be newly generated
-            self._generate_new_files()
+            # the word list only has to be read if the file changed or was never used
+            if self.file_name is None:
+                self._load()
+            # If the word list has been previously used, the tree will be loaded from the index file
+            if self.cache.has(self.file_name):
+                self._load_saved_index()
+            else:
+                # otherwise the tree will be newly generated
+                self._generate_new_files()
+        # BK-trees skip words using the triangle inequality, which only some metrics guarantee
+        # (pivot tables get no pivots for the other metrics and compare the query with every word, like a scan)
+        if self.engine == "bktree" and not self.metric.true_metric:
+            print(f"Note: '{self.metric.name}' is not a true metric, so a few matches may be missed by the searches.")
+        # the least recently used trees are removed if the output directory grows too large
+        for key in self.cache.evict(keep=self.file_name):
+            print(f"Removed the files of tree {key} from the cache.")
+        # with a query file the queries are answered in batch mode instead of the interactive mode
+        if self.queries is not None:
+            self._run_batch()
+            return
+        # in server mode the tree stays loaded and answers queries over a socket
+        if self.serve is not None:
+            self._run_server()
+            return
         print(Art.interactive_mode)
         view = View(tree=self.tree, dist=self.dist)
         view.main()
+
+    def _run_batch(self):
+        print("Answering the queries...")
+        batch = Batch(tree=self.tree, dist=self.dist, d=self.radius, k=self.k, workers=self.workers)
+        answered = batch.run(self.queries, self.out)
+        print(f"{answered} queries were answered, {batch.duplicates} duplicates were skipped.")
+        rejected = ", ".join(f"{stage} {count}" for stage, count in batch.rejected.items())
+        print(f"{batch.exact} exact distances were calculated"
+              + (f", ruled out before: {rejected}." if rejected else "."))
+
+    def _run_server(self):
+        server = Server(tree=self.tree, dist=self.dist, port=self.serve, workers=self.workers)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            print("Server stopped.")
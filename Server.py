@@ -0,0 +1,257 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Auxillary import Config, Methods
+from model.Cache import QueryCache
+from model.Metrics import metrics
+from View import View
+from Batch import Batch
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import asyncio
+import json
+
+
+# the View of a worker process, set up once per process by _init_worker
+_view = None
+
+
+def _init_worker(tree, dist):
+    global _view
+    # the server keeps its own cache, so the workers do not need one
+    # a forked worker starts with a copy of the metrics of the main process (e.g. of the build),
+    # only the work of its own queries may be sent back
+    metrics.reset()
+    _view = View(tree=tree, dist=dist, cache_size=0)
+
+
+def _search(job):
+    """
+    answers a single query in a worker process
+    :param job: tuple of the query word, the maximum distance and the number of closest words (one of them is None)
+    :return: tuple of the dictionary of the matches and their distance, the filter statistics and the metrics
+    of the query
+    """
+    word, d, k = job
+    return Batch.search(_view, word, d, k), _view.filter_stats(reset=True), metrics.take()
+
+
+class QueryError(Exception):
+    """ a query could not be calculated """
+
+
+class Server:
+    """
+    Keeps a tree loaded and answers queries over a local TCP socket, so that clients do not have to
+    load and check the tree again for every run
+    the protocol is one JSON object per line in both directions:
+    {"word": "hose", "d": 1} asks for all words within distance 1, {"word": "hose", "k": 5} for the 5 closest words
+    and {"stats": true} for the metrics of the server; an "id" in the request is sent back with the answer,
+    since the queries of one connection are answered concurrently and may finish out of order
+    the traversals run in a pool of worker processes, identical queries that are being answered at the same time
+    are only calculated once, and range queries are cached like in the interactive mode
+    """
+
+    def __init__(self, tree, dist, host="127.0.0.1", port=0, workers=None, max_pending=None):
+        self.tree = tree
+        self.dist = dist
+        self.host = host
+        self.port = port
+        self.workers = workers or Methods.thread_count()
+        # queries that are calculated at the moment, more are turned down with a "busy" error
+        self.max_pending = max_pending if max_pending is not None else Config.server_max_pending
+        self.cache = QueryCache()
+        # (word, d, k) -> future of a query that is being calculated
+        self._in_flight = {}
+        self._executor = None
+        self._server = None
+        # latencies of the last requests in milliseconds
+        self._latencies = deque(maxlen=Config.server_latency_window)
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.errors = 0
+        # words ruled out by each lower bound and exact distances calculated, summed over all queries
+        self.filtered = {}
+        self.exact = 0
+
+    async def start(self):
+        """ starts the workers and opens the socket, with port 0 a free port is chosen and stored in self.port """
+        self._executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.tree, self.dist))
+        self._server = await asyncio.start_server(self._handle, self.host, self.port,
+                                                  limit=Config.server_max_line_length)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        print(f"Listening on {self.host}:{self.port}.")
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def query(self, word, d=None, k=None):
+        """
+        :return: dictionary of the matches of a query and their distance
+        :raise OverflowError: if too many queries are being calculated already
+        """
+        if k is None:
+            matches = self.cache.get(word, d)
+            if matches is not None:
+                return matches
+        job = (word, d, k)
+        future = self._in_flight.get(job)
+        if future is not None:
+            # the same query is already being calculated, its result is shared
+            self.coalesced += 1
+            return (await asyncio.shield(future))[0]
+        if len(self._in_flight) >= self.max_pending:
+            raise OverflowError("busy")
+        future = asyncio.get_running_loop().run_in_executor(self._executor, _search, job)
+        self._in_flight[job] = future
+        try:
+            matches, stats, snapshot = await asyncio.shield(future)
+        finally:
+            del self._in_flight[job]
+        for stage, count in stats["rejected"].items():
+            self.filtered[stage] = self.filtered.get(stage, 0) + count
+        self.exact += stats["exact"]
+        metrics.merge(snapshot)
+        if k is None:
+            self.cache.put(word, d, matches)
+        return matches
+
+    @staticmethod
+    def _validate(word, d, k):
+        """
+        checks the fields of a query request before it is passed on to the executor
+        :raise ValueError: if the request cannot be answered
+        """
+        if not isinstance(word, str) or not word:
+            raise ValueError("word must be a non-empty string")
+        if (d is None) == (k is None):
+            raise ValueError("either d or k is needed")
+        value = d if k is None else k
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError("d and k must be non-negative integers")
+
+    async def _query_or_error(self, word, d, k):
+        """
+        runs a query, anything that goes wrong while it is calculated is turned into a QueryError,
+        so the client gets an error object instead of no answer at all
+        """
+        try:
+            return await self.query(word, d, k)
+        except OverflowError:
+            raise
+        except Exception as error:
+            raise QueryError(f"{type(error).__name__}: {error}") from error
+
+    async def _answer(self, request):
+        """
+        :param request: one line sent by a client
+        :return: the answer as a dictionary
+        """
+        start = perf_counter()
+        self.requests += 1
+        try:
+            request = json.loads(request)
+            if request.get("stats"):
+                answer = self.stats()
+            else:
+                word, d, k = request["word"], request.get("d"), request.get("k")
+                self._validate(word, d, k)
+                answer = Batch.result(word, await self._query_or_error(word, d, k))
+        except OverflowError as error:
+            self.rejected += 1
+            answer = {"error": str(error)}
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            self.errors += 1
+            answer = {"error": f"bad request: {error}"}
+        except QueryError as error:
+            self.errors += 1
+            answer = {"error": f"query failed: {error}"}
+        ms = (perf_counter() - start) * 1000
+        self._latencies.append(ms)
+        metrics.observe("server.latency_ms", ms)
+        answer["ms"] = round(ms, 3)
+        if isinstance(request, dict) and "id" in request:
+            answer["id"] = request["id"]
+        return answer
+
+    async def _handle(self, reader, writer):
+        """
+        answers the requests of one connection
+        at most Config.server_connection_pending requests of a connection are answered at the same time,
+        after that no more lines are read, so a client that sends faster than it reads is slowed down by the socket
+        """
+        slots = asyncio.Semaphore(Config.server_connection_pending)
+        tasks = set()
+
+        async def respond(line):
+            try:
+                answer = await self._answer(line)
+                writer.write(json.dumps(answer, ensure_ascii=False).encode("UTF-8") + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError):
+                    # line longer than Config.server_max_line_length or connection lost
+                    slots.release()
+                    break
+                if not line:
+                    slots.release()
+                    break
+                if not line.strip():
+                    slots.release()
+                    continue
+                task = asyncio.create_task(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def stats(self):
+        """
+        :return: counters of the server and the latencies of the last Config.server_latency_window requests
+        """
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+
+        return {"requests": self.requests, "coalesced": self.coalesced, "rejected": self.rejected,
+                "errors": self.errors, "pending": len(self._in_flight), "cache": self.cache.stats(),
+                "filter": {"rejected": dict(self.filtered), "exact": self.exact}, "metrics": metrics.snapshot(),
+                "latency_ms": {"mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                               "p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99),
+                               "max": percentile(1.0)}}
@@ -4,15 +4,40 @@
 # 4. Semester
 
 
-from model.Distances import LevenshteinDistance, HammingDistance, JaccardDistance, JaroWinklerDistance
+from model.Auxillary import Config
+from model.Cache import QueryCache
+from model.PivotTable import PivotTable
+from model.Metrics import metrics as default_metrics
+from model.Registry import registry
+from bisect import insort
+from heapq import heappush, heappop
+from time import perf_counter
 
 
 class View:
 
-    def __init__(self, tree, dist):
+    def __init__(self, tree, dist, cache_size=None, metrics=None):
         self.tree = tree
         self.dist = dist
-        self._dynamic_matches = {}
+        # the metric is looked up once, its functions are then called directly
+        self.metric = registry.get(dist)
+        self._distance = self.metric.bounded
+        self._distances = self.metric.bounded_many
+        self._counter = f"distance.{self.metric.name}"
+        # distance calls, visited and pruned nodes and query latencies are reported here
+        self.metrics = metrics or default_metrics
+        # matches of previous queries, see QueryCache
+        self.cache = QueryCache(cache_size)
+        # cheap lower bounds that are tried before the exact distance, and how many words each one ruled out
+        self.lower_bounds = self.metric.lower_bounds
+        self.rejected = {name: 0 for name, _ in self.lower_bounds}
+        # a pivot table rules out words with its pivots first (a Scan has none)
+        if isinstance(tree, PivotTable) and tree.prunes:
+            self.rejected = {"pivot": 0, **self.rejected}
+        # number of exact distances calculated
+        self.exact = 0
+        # the query word encoded for the signatures of an index, see signed_distances()
+        self._query = None
 
     def main(self):
         print("Now you will be asked to input a word and a maximum distance. "
@@ -32,14 +57,17 @@ class View:
         # a space bar terminates the program
         if word.startswith(" "):
             quit("Program finished.")
+        d = input("Enter the maximum distance (or k and a number, e.g. k5, for the closest words): ")
         try:
-            d: int = int(input("Enter the maximum distance: "))
+            # "k5" asks for the 5 closest words instead of all words within a distance
+            if d.startswith("k"):
+                result = self.nearest(word, int(d[1:]))
+            else:
+                result = self.get_matches(word, int(d))
         # catching bad inputs
         except ValueError:
             print("max. distance must be integer and cannot be empty!")
             return
-        # finding all matches
-        result = self.get_matches(word, d)
         if not result:
             print("No matches found.")
         else:
@@ -50,106 +78,258 @@ class View:
                 print("1 Match was found.")
             print(*result, sep=", ", end=".\n")
 
-    def distance(self, w1, w2):
-        """ returns respective dist of word pair """
-        if self.dist.startswith("lev"):
-            return LevenshteinDistance.dist(w1, w2)
-        elif self.dist.startswith("ham"):
-            return HammingDistance.dist(w1, w2)
-        elif self.dist.startswith("jar"):
-            return JaroWinklerDistance.jaro_Winkler(w1, w2)
-        elif self.dist.startswith("jac"):
-            return JaccardDistance.J(w1, w2)
-        else:
-            raise TypeError
-
-    def _check_for_previous_matches(self, word, d):
-        result = {}
-        matches = self._dynamic_matches
-        pair = (word, d)
-        # checking if this exact input has been used before
-        if pair in matches.keys():
-            print("Matches for this input have been calculated previously.")
-            # True because a perfect match has been found
-            return matches[pair], True
-        else:
-            # going through the stored matches to see if the queue word has been used before
-            # but with a higher distance
-            for pair in matches.keys():
-                if pair[0] == word and int(pair[1]) > d:
-                    print("Matches for this word with a larger distance have been calculated previously. "
-                          "Returning those that fit this input...")
-                    for word, dist in matches[pair].items():
-                        # all words that matched the queue word previously but have a distance
-                        # that also satisfies the current input will be returned
-                        if dist <= d:
-                            result[word] = dist
-            # updating the class variable
-            self._dynamic_matches[word] = result
-            return (result, True) if result else (result, False)
+    def distance(self, w1, w2, max_dist=None):
+        """
+        returns respective dist of word pair
+        with max_dist, metrics with a threshold variant (Levenshtein) only calculate the distance up to that bound
+        and return max_dist + 1 for anything greater
+        """
+        self.metrics.count(self._counter)
+        return self._distance(w1, w2, max_dist)
+
+    def distances(self, word, candidates, max_dist=None):
+        """
+        returns respective dist of every candidate to the word, calculated in one batch
+        max_dist can also be a list with one bound per candidate
+        """
+        self.metrics.count(self._counter, len(candidates))
+        return self._distances(word, candidates, max_dist)
+
+    def signed_distances(self, word, index, ids, max_dist=None):
+        """
+        returns respective dist of the words of an index (NodeStore or PivotTable) with the given ids, calculated in
+        one batch like distances()
+        metrics with a signature kernel (Metric.signed) compare the signatures the index keeps for its words
+        with the query word, which is only encoded once per query, the other metrics get the names of the words
+        """
+        if self.metric.signed is None:
+            return self.distances(word, [index.name(i) for i in ids], max_dist)
+        self.metrics.count(self._counter, len(ids))
+        signatures = index.signatures()
+        if self._query is None or self._query[0] is not signatures or self._query[1].word != word:
+            self._query = (signatures, signatures.query(word))
+        return self.metric.signed(self._query[1], signatures, ids, index.name, max_dist)
+
+    def _filter(self, word, names, limits):
+        """
+        runs the lower bounds one after another on the candidates that are left, cheapest first
+        a candidate is ruled out once a bound exceeds its limit, the distance up to which it is needed
+        (for a node of the tree that is d plus the largest weight of its edges, since its children lie in the band
+        of d around its distance, for a leaf just d)
+        short lists go straight to the exact distance: the scalar kernel stops at the difference in length and at
+        the limit by itself, so the bounds would only add their own cost (see Config.cascade_min_size)
+        :param names: the candidate words
+        :param limits: list with the limit of every candidate
+        :return: positions of the candidates whose exact distance is needed
+        """
+        positions = list(range(len(names)))
+        if len(names) >= Config.cascade_min_size:
+            for stage, lower_bound in self.lower_bounds:
+                bounds = lower_bound(word, [names[i] for i in positions]).tolist()
+                kept = [i for i, bound in zip(positions, bounds) if bound <= limits[i]]
+                self.rejected[stage] += len(positions) - len(kept)
+                self.metrics.count(f"filter.{stage}", len(positions) - len(kept))
+                positions = kept
+                if not positions:
+                    break
+        self.exact += len(positions)
+        return positions
+
+    def filter_stats(self, reset=False):
+        """
+        returns how many words each lower bound ruled out and how many exact distances were calculated
+        :param reset: start counting from 0 again afterwards
+        """
+        stats = {"rejected": dict(self.rejected), "exact": self.exact}
+        if reset:
+            self.rejected = dict.fromkeys(self.rejected, 0)
+            self.exact = 0
+        return stats
+
+    def _count_pivot(self, table, visited):
+        """
+        counts the distances to the pivots and the words of a pivot table a query looked at or ruled out,
+        the words of the table count as its nodes
+        :param visited: number of words the distance was calculated to (or that were passed on to the lower bounds)
+        """
+        # a Scan and tables of metrics that break the triangle inequality do not look at their pivots
+        if table.prunes:
+            self.metrics.count(self._counter, len(table.pivots))
+            self.rejected["pivot"] += table.length - visited
+            self.metrics.count("filter.pivot", table.length - visited)
+        self.metrics.count("query.nodes_visited", visited)
+        self.metrics.count("query.nodes_pruned", table.length - visited)
 
     def get_matches(self, word, d):
         """
-        checks if a similar queue has been used before
+        checks if the same word has been queried before with the same or a larger distance
         and if that is the case, matches will be obtained from that previous queue
         if not, calls the recursive function _get_matches()
         and sorts the matches by increasing edit dist
         """
-        result = self._check_for_previous_matches(word, d)
-        # if the second value (index 1) of the result is TRUE, that means that from a previous input queue
-        # the matches were obtained and did not have to be recalculated
-        if result[1]:
-            # sorting the results by increasing distance, so that words closer to the queue show up first
-            result = sorted(result[0], key=result[0].get)
-        else:
+        matches = self.cache.get(word, d)
+        if matches is None:
             # if there was no related previous queue, matches have to be calculated from scratch
-            result = self._get_matches(word, d, self.tree)
-            # updating the dictionary
-            self._dynamic_matches[(word, d)] = result
-            result = sorted(result, key=result.get)
-        try:
-            # if the queue word is actually in the tree, it ends up in the list of matches with a distance of 0,
-            # which places it at index 0
-            # but it should not be shown in that case
-            if result[0] == word:
-                result = result[1:]
-            return result
-        # an Index Error will occur if no matches have been found, but the program should not terminate because of that
-        except IndexError:
-            pass
-
-    def _get_matches(self, word: str, d: int, node):
+            matches = self.search(word, d=d)
+            self.cache.put(word, d, matches)
+        # sorting the results by increasing distance, so that words closer to the queue show up first
+        # if the queue word is actually in the tree, it ends up in the list of matches, but it should not be shown
+        return [match for match in sorted(matches, key=matches.get) if match != word]
+
+    def nearest(self, word, k):
+        """
+        finds the k words of the tree that are closest to the given word
+        words with the same distance are ordered alphabetically, so ties are always resolved the same way
+        the word itself is left out if it is part of the tree, just like in get_matches()
+        :return: list of the k closest words, sorted by increasing edit dist
+        """
+        return list(self.search(word, k=k))
+
+    def search(self, word, d=None, k=None):
+        """
+        runs a range query (d) or a k nearest neighbour query (k) without the cache and reports its latency
+        :return: dictionary of the matches and their distance
+        """
+        start = perf_counter()
+        if k is not None:
+            matches = self._nearest(word, k)
+            kind = "nearest"
+        else:
+            matches = self._get_matches(word, d, self.tree)
+            kind = "range"
+        self.metrics.count(f"query.{kind}")
+        self.metrics.observe(f"query.{kind}.latency_ms", (perf_counter() - start) * 1000)
+        return matches
+
+    def _nearest(self, word: str, k: int):
+        """
+        best-first search for the k closest words
+        all words below a child with weight w have the distance w to its parent,
+        so |dist(word, parent) - w| is a lower bound for every word in that subtree
+        the subtrees are visited in order of that bound, and once k words have been found,
+        the search radius shrinks to the distance of the k-th best one
+        :param word: the word the user put in
+        :param k: number of words to return
+        :return: dictionary in which the keys are the k closest words and the values their edit dist,
+        in order of increasing edit dist
+        """
+        # a pivot table visits its words in order of their pivot bound, the distances are calculated and counted here
+        if isinstance(self.tree, PivotTable):
+            table = self.tree
+            visited = 0
+
+            def distances(word, ids):
+                nonlocal visited
+                visited += len(ids)
+                self.exact += len(ids)
+                return self.signed_distances(word, table, ids)
+
+            matches = table.nearest(word, k, distances)
+            self._count_pivot(table, visited)
+            return matches
+        # (distance, word) pairs of the best words so far, sorted
+        best = []
+        if k <= 0:
+            return {}
+
+        def offer(node, dist):
+            name = node.name
+            if name != word and not node.deleted and (len(best) < k or (dist, name) < best[-1]):
+                insort(best, (dist, name))
+                if len(best) > k:
+                    best.pop()
+
+        root = self.tree
+        dist_to_root = self.distance(word, root.name)
+        self.exact += 1
+        offer(root, dist_to_root)
+        # heap of (lower bound, counter, node, distance to node), the counter keeps the order deterministic
+        queue = [(0, 0, root, dist_to_root)]
+        counter = 1
+        while queue:
+            lower_bound, _, node, dist_to_node = heappop(queue)
+            # while fewer than k words were found, every subtree has to be looked at
+            radius = best[-1][0] if len(best) == k else None
+            if radius is not None and lower_bound > radius:
+                # every subtree left in the queue is out of reach
+                self.metrics.count("query.nodes_pruned", len(queue) + 1)
+                break
+            self.metrics.count("query.nodes_visited")
+            if radius is None:
+                children = node.children_in_range(float("-inf"), float("inf"))
+                bound = None
+                self.exact += len(children)
+            else:
+                children = node.children_in_range(dist_to_node - radius, dist_to_node + radius)
+                self.metrics.count("query.nodes_pruned", node.child_count - len(children))
+                bound = [radius + child.max_child_weight for child in children]
+                positions = self._filter(word, [child.name for child in children], bound)
+                children, bound = [children[i] for i in positions], [bound[i] for i in positions]
+            if not children:
+                continue
+            distances = self.signed_distances(word, node.store, [child.id for child in children], bound).tolist()
+            for child, dist_to_child in zip(children, distances):
+                offer(child, dist_to_child)
+                if not child.is_leaf:
+                    heappush(queue, (max(lower_bound, abs(dist_to_node - child.weight)), counter, child, dist_to_child))
+                    counter += 1
+        return {name: dist for dist, name in best}
+
+    def _get_matches(self, word: str, d: int, node, dist_to_current=None):
         """
         function to find all words that have less or equal dist than the max. dist d to a given word
         :param word: the word the user put in
         :param d: maximum distance chosen by user
         :param node: the current node the function is looking at
+        :param dist_to_current: distance between word and node if the caller already calculated it
         :return: dictionary in which the keys are the matches and the values are the edit dist to the queue word
         """
 
+        # a pivot table rules out most words with its pivots, the remaining ones go through the lower bounds
+        if isinstance(node, PivotTable):
+            ids = node.candidate_ids(word, d)
+            self._count_pivot(node, len(ids))
+            # the names are only needed for the lower bounds and the matches
+            if self.lower_bounds:
+                ids = ids[self._filter(word, [node.name(i) for i in ids], [d] * len(ids))]
+            else:
+                self.exact += len(ids)
+            distances = self.signed_distances(word, node, ids, d).tolist()
+            return {node.name(i): dist for i, dist in zip(ids.tolist(), distances) if dist <= d}
+
         # dictionary with the matches and their distance so that later the output can be sorted increasingly
         list_of_matches = {}
 
         current_node = node
         # distance between user word and current node
-        dist_to_current = self.distance(word, current_node.name)
+        # beyond max_child_weight + d no child can be in the band anymore, so the distance is only needed up to there
+        if dist_to_current is None:
+            dist_to_current = self.distance(word, current_node.name, d + current_node.max_child_weight)
+            self.exact += 1
         # if its lower or equal to the maximum distance d, it can be appended to the result list right away
-        if dist_to_current <= d:
+        # deleted words are still part of the tree, but are not returned
+        if dist_to_current <= d and not current_node.deleted:
             list_of_matches[current_node.name] = dist_to_current
-        # iterating through its children
-        index = 0
-        while index < len(current_node.children):
-            child = current_node.children[index]
-            dist = child.weight
-            # look at all nodes that have a distance with a difference of d
-            # to the distance between the parent and user word
-            if (dist_to_current - d) <= dist <= (dist_to_current + d):
-                # add node to list of matches if distance to user word is lower or equal to the max dist
-                if self.distance(child.name, word) <= d:
-                    list_of_matches[child.name] = dist
-                # run function recursively if not looking at a leaf
-                if not child.is_leaf:
-                    list_of_matches.update(self._get_matches(word, d, node=child))
-            index += 1
+        # only the children that have a distance with a difference of at most d
+        # to the distance between the parent and user word are looked at
+        children = current_node.children_in_range(dist_to_current - d, dist_to_current + d)
+        self.metrics.count("query.nodes_visited")
+        self.metrics.count("query.nodes_pruned", current_node.child_count - len(children))
+        # a child is only needed up to d + its largest edge weight, for a leaf that is just d
+        bounds = [d + child.max_child_weight for child in children]
+        # children that the lower bounds rule out are dropped before any exact distance is calculated
+        positions = self._filter(word, [child.name for child in children], bounds)
+        if not positions:
+            return list_of_matches
+        children, bounds = [children[i] for i in positions], [bounds[i] for i in positions]
+        # the distances to these children are calculated in one batch
+        # and each one is used both for the match and for the children of that child
+        distances = self.signed_distances(word, node.store, [child.id for child in children], bounds).tolist()
+        for child, dist_to_child in zip(children, distances):
+            if dist_to_child <= d and not child.deleted:
+                list_of_matches[child.name] = dist_to_child
+            # run function recursively if not looking at a leaf
+            if not child.is_leaf:
+                list_of_matches.update(self._get_matches(word, d, node=child, dist_to_current=dist_to_child))
         # return the final dictionary
         return list_of_matches
@@ -5,22 +5,65 @@
 
 
 from model.Auxillary import Art
+from model.Registry import registry
 from Controller import Controller
+from contextlib import redirect_stdout
 import argparse
+import sys
 
 
 def main():
-    print(Art.bk_tree_generator)
     # initiating parser to read command line input
     parser = argparse.ArgumentParser(description="processes the input")
     # adding arguments for file, edit distance and mode (demo or normal)
     parser.add_argument("--file", "-f", type=str, required=True,
                         help="the full name of the text file containing the word list")
     parser.add_argument("--mode", "-m", type=str, required=False,
-                        help="'demo' only plots the graph but doesnt save the files, "
+                        help="'demo' doesnt save the files, "
                              "leaving it blank results in files being saved")
     parser.add_argument("--dist", "-d", type=str, required=False,
                         help="specify which metric for the edit distance you want to use (levenshtein or hamming)")
+    parser.add_argument("--separator", type=str, required=False,
+                        help="string between the words of the word list (default: guessed, new line, comma or space)")
+    parser.add_argument("--workers", "-w", type=int, required=False,
+                        help="number of processes used to build long word lists (default: number of cpus)")
+    parser.add_argument("--add", type=str, required=False,
+                        help="file with words that are added to the saved tree of the word list")
+    parser.add_argument("--remove", type=str, required=False,
+                        help="file with words that are removed from the saved tree of the word list")
+    parser.add_argument("--queries", "-q", type=str, required=False,
+                        help="batch mode: file with one query word per line ('-' reads from stdin), "
+                             "the results are written as JSON lines instead of starting the interactive mode")
+    parser.add_argument("--radius", "-r", type=int, required=False,
+                        help="batch mode: return all words within this maximum distance")
+    parser.add_argument("--k", "-k", type=int, required=False,
+                        help="batch mode: return the k closest words")
+    parser.add_argument("--out", "-o", type=str, required=False,
+                        help="batch mode: file the results are written to (default: stdout)")
+    parser.add_argument("--pivot", "-p", type=str, required=False, choices=["first", "fanout", "visits"],
+                        help="how the root of a new tree is chosen: the first word of the sorted list (default), "
+                             "the sampled word that splits the list into the most even subtrees (fanout) "
+                             "or the one that lets typical queries skip the most words (visits)")
+    parser.add_argument("--engine", "-e", type=str, required=False, choices=["bktree", "pivot", "scan"],
+                        help="index used for the queries: a BK-tree, a table of distances to a few pivot words or "
+                             "a scan of all words (default: bktree for levenshtein, scan for the others, "
+                             "which finds every match)")
+    parser.add_argument("--serve", "-s", type=int, required=False,
+                        help="server mode: answer queries as JSON lines on this local port instead of "
+                             "starting the interactive mode")
+    parser.add_argument("--metrics", type=str, required=False,
+                        help="JSON file the metrics of the run (distance calls, query latencies, build phases) "
+                             "are written to")
+    parser.add_argument("--plot", type=str, required=False, choices=["show", "png", "svg", "dot"],
+                        help="draw the graph of the tree: 'show' opens a window and 'png' saves it in the output "
+                             "directory (also done if there is no display), both only for fewer than 30 nodes, "
+                             "'svg' and 'dot' (Graphviz) write files for trees of any size")
+    parser.add_argument("--plot-root", type=str, required=False,
+                        help="only draw the subtree below this word")
+    parser.add_argument("--plot-depth", type=int, required=False,
+                        help="only draw this many levels below the root (or --plot-root)")
+    parser.add_argument("--verify", action="store_true",
+                        help="check a saved tree for consistency when it is loaded (reads the whole index file)")
     args = parser.parse_args()
 
     # reading the arguments
@@ -28,17 +71,38 @@ def main():
     dist = args.dist
     save = args.mode
 
+    # separators like new lines or tabs can be given as escape sequences
+    separator = {"\\n": "\n", "\\t": "\t"}.get(args.separator, args.separator)
+
     # testing if chosen metric is viable
-    metrics = ["lev", "ham", "jac", "jar"]
     if dist:
-        assert dist[:3] in metrics, \
+        assert dist in registry, \
             "chosen distance metric is not supported. " \
             "choose levenshtein (lev), hamming (ham), " \
-            "jaccard (jac) or jaro winkler (jar)"
+            "jaccard (jac) or jaro winkler (jar)" + \
+            "".join(f", {name}" for name in registry.names()[4:])
+
+    queries = out = None
+    if args.queries:
+        assert (args.radius is None) != (args.k is None), "batch mode needs either --radius or --k"
+        queries = sys.stdin if args.queries == "-" else open(args.queries, encoding="UTF-8")
+        out = open(args.out, "w", encoding="UTF-8") if args.out else sys.stdout
 
-    # running the controller with the parsed arguments
-    controller = Controller(path=file, demo=save, dist=dist)
-    controller.main()
+    # when the results of the batch mode go to stdout, all other messages go to stderr
+    with redirect_stdout(sys.stderr if out is sys.stdout else sys.stdout):
+        print(Art.bk_tree_generator)
+        # running the controller with the parsed arguments
+        controller = Controller(path=file, demo=save, dist=dist, workers=args.workers, add=args.add,
+                                remove=args.remove, queries=queries, out=out, radius=args.radius, k=args.k,
+                                serve=args.serve, pivot=args.pivot,
+                                engine=args.engine, separator=separator,
+                                metrics_path=args.metrics, plot=args.plot,
+                                plot_root=args.plot_root, plot_depth=args.plot_depth, verify=args.verify)
+        controller.main()
+    if queries is not None and queries is not sys.stdin:
+        queries.close()
+    if out is not None and out is not sys.stdout:
+        out.close()
 
 
 if __name__ == "__main__":
@@ -5,8 +5,8 @@
 
 
 import multiprocessing as mp
-from itertools import cycle
-from string import punctuation
+from math import ceil
+import unicodedata
 
 
 class Methods:
@@ -14,34 +14,86 @@ class Methods:
     @staticmethod
     def clean_list(L):
         """
-        :param L: the original word list
-        :return: word list without special characters and no duplicates
+        :param L: the original word list (any iterable of words, e.g. the generator of read_words)
+        :return: sorted word list without special characters and no duplicates
         """
-        assert isinstance(L, list), "not a list"
-        assert len(L) > 1, "not enough words"
-        for word in range(len(L) - 1):
-            for _ in punctuation:
-                if _ in L[word]:
-                    L.remove(L[word])
-        return list(sorted(set([w for w in L if w.isalpha()])))
+        words = sorted(set(Methods.clean_words(L)))
+        assert len(words) > 0, "not enough words"
+        return words
 
     @staticmethod
-    def chunkify(L):
+    def clean_words(words):
         """
-        divides the word list into chunks if its very long
-        so that the tree can be generated through multithreading
+        normalizes the words one by one: surrounding white space is removed and letters with accents are put
+        in their composed form (NFC), so that the same word is always spelled with the same characters
+        words that contain anything but letters are skipped
+        :param words: iterable of words
+        :return: generator of the cleaned words, duplicates are not removed
+        """
+        for word in words:
+            word = unicodedata.normalize("NFC", word.strip())
+            if word.isalpha():
+                yield word
+
+    @staticmethod
+    def read_words(path, separator=None):
+        """
+        streams the words of a text file, the file is read in blocks of Config.read_block_size characters,
+        so memory does not grow with the size of the file
+        :param path: path of the text file
+        :param separator: string between two words, if it is not given, it is guessed from the beginning of the file
+        (new line, comma or else any white space)
+        :return: generator of the words as they appear in the file, without any cleaning
+        """
+        with open(file=path, encoding="UTF-8") as file:
+            # the separator is guessed from the first 50 characters, so the first block holds at least those
+            block = file.read(max(Config.read_block_size, 50))
+            if separator is None:
+                separator = Methods.guess_separator(block[:50])
+            # the last word of a block may continue in the next one
+            rest = ""
+            while block:
+                text = rest + block
+                words = text.split(separator)
+                # splitting at any white space drops the empty word after a trailing space
+                if separator is None and text[-1].isspace():
+                    rest = ""
+                else:
+                    rest = words.pop() if words else ""
+                yield from words
+                block = file.read(Config.read_block_size)
+            if rest:
+                yield rest
+
+    @staticmethod
+    def guess_separator(text):
+        """
+        :param text: the beginning of a word list
+        :return: the separator for str.split(), None standing for any white space
+        """
+        if "\n" in text:
+            return "\n"
+        elif "," in text:
+            return ","
+        return None
+
+    @staticmethod
+    def chunkify(L, workers=None):
+        """
+        divides the word list into contiguous chunks so that it can be processed by multiple processes
+        the number of chunks adapts to the length of the list: a few chunks per worker to spread the load evenly,
+        but none smaller than Config.min_chunk_size, so short lists stay in a single chunk
         :param L: list of words
-        :return: either list of chunks or original list
+        :param workers: number of processes, defaults to the number of cpus
+        :return: list of chunks
         """
-        if len(L) > 1000:
-            no_of_chunks = Methods.thread_count()
-            chunks = [[] for _ in range(no_of_chunks)]
-            for element, chunk in zip(L, cycle(chunks)):
-                chunk.append(element)
-            print(f"Generated {no_of_chunks} chunks with an average size of {len(chunks[0])} items.")
-            return chunks
-        else:
-            return L
+        workers = workers or Methods.thread_count()
+        no_of_chunks = max(1, min(workers * Config.chunks_per_worker, len(L) // Config.min_chunk_size))
+        size = ceil(len(L) / no_of_chunks) or 1
+        chunks = [L[start:start + size] for start in range(0, len(L), size)]
+        if len(chunks) > 1:
+            print(f"Generated {len(chunks)} chunks with an average size of {size} items.")
+        return chunks
 
     @staticmethod
     def thread_count():
@@ -62,7 +114,44 @@ class Methods:
 
 
 class Config:
+    # graphs drawn with matplotlib are limited to this many nodes, svg and dot files are not limited
     max_items: int = 30
+    # word lists are read in blocks of this many characters, the separator between the words is guessed if it is None
+    read_block_size: int = 1 << 20
+    separator = None
+    # generated trees are stored here, the least recently used ones are removed above cache_max_bytes
+    output_dir: str = "output"
+    cache_max_bytes: int = 2 * 1024 ** 3
+    # number of query words whose matches are kept by the View
+    query_cache_size: int = 10000
+    # batch mode: queries per task sent to a worker, and how many recent queries are remembered for deduplication
+    batch_chunk_size: int = 64
+    batch_dedup_size: int = 1000000
+    # batches with fewer candidates are computed with the scalar kernels, larger ones are split into blocks
+    min_batch_size: int = 8
+    batch_block_size: int = 65536
+    # the lower bounds of a metric are only tried on at least this many candidates at once
+    cascade_min_size: int = 8
+    # word lists longer than this are built in multiple processes
+    parallel_build_size: int = 1000
+    # root distances are calculated in chunks of at least this size, a few chunks per worker
+    min_chunk_size: int = 5000
+    chunks_per_worker: int = 4
+    # root selection: number of sampled root candidates, number of sampled words they are rated with
+    # and seed of the sampling (the candidates are rated for the typical query radius of the metric, Metric.radius)
+    pivot_candidates: int = 32
+    pivot_sample_size: int = 1000
+    pivot_seed: int = 0
+    # pivot table engine: number of pivot words and words whose distance is calculated at once in a k-nearest search
+    # (the scan engine compares Config.batch_block_size words at once)
+    pivot_table_size: int = 16
+    pivot_block_size: int = 256
+    # server mode: queries calculated at the same time before new ones are turned down,
+    # concurrent requests per connection, longest request line and number of latencies kept for the statistics
+    server_max_pending: int = 256
+    server_connection_pending: int = 32
+    server_max_line_length: int = 65536
+    server_latency_window: int = 10000
 
 
 class Art:
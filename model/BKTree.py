@@ -5,177 +5,469 @@
 
 
 from model.Auxillary import Methods, Config
-from model.Distances import LevenshteinDistance, HammingDistance, JaccardDistance, JaroWinklerDistance
-from model.Visualizer import Visualizer
-from TreeNode import TreeNode
-from threading import Thread, Lock
-from multiprocessing import Process, Manager
+from model.Registry import registry
+from model.NodeStore import NodeStore
+from model.Renderer import TreeRenderer
+from model.Metrics import metrics as default_metrics
+from multiprocessing import Pool
+from array import array
+from itertools import islice
+from random import Random
+from time import perf_counter
+import numpy
+
+
+def chunk_distances(job):
+    """
+    calculates the distance of a chunk of words to one word (the root of a tree or a pivot of a table),
+    runs in a worker process of BKTree._multiprocessing and PivotTable._choose_pivots
+    :param job: tuple of the word, the chunk and the edit distance
+    :return: integer array with the distance of every word of the chunk, in the same order
+    """
+    root, chunk, edit_dist = job
+    return BKTree.batch_function(edit_dist)(root, chunk)
+
+
+def _build_subtree(job):
+    """
+    builds the subtree of all words that share the same distance to the root,
+    runs in a worker process of BKTree._multiprocessing_build
+    :param job: tuple of the words of the bucket (the first one is the subtree root) and the edit distance
+    :return: names, parents and weights of the subtree, node 0 being its root, and the number of distance calls
+    """
+    words, edit_dist = job
+    function = BKTree.distance_function(edit_dist)
+    calls = 0
+
+    def distance(w1, w2):
+        nonlocal calls
+        calls += 1
+        return function(w1, w2)
+
+    store = NodeStore()
+    store.add_node(name=words[0], parent=-1, weight=0)
+    for word in words[1:]:
+        BKTree.insert_into(store, distance, word, node=0, dist_to_node=distance(word, words[0]))
+    return store.names(), store.parents, store.weights, calls
 
 
 class BKTree:
-    def __init__(self, word_list, edit_dist):
+    # strategies for choosing the root, see choose_root()
+    pivots = ["first", "fanout", "visits"]
+
+    def __init__(self, word_list, edit_dist, workers=None, pivot=None, metrics=None, cleaned=False):
+        # distance calls, phase timings and the build throughput are reported here
+        self.metrics = metrics or default_metrics
         # used for status messages
         self.count = 0
-        self.fix_count = []
-        self.word_list = Methods.clean_list(word_list)
-        self.edit_dist = edit_dist
+        # a list that went through Methods.clean_list already (like the one of the Controller) is only copied
+        if cleaned:
+            self.word_list = list(word_list)
+        else:
+            with self.metrics.phase("clean"):
+                self.word_list = Methods.clean_list(word_list)
+        self._bind(edit_dist)
         self.length = len(self.word_list)
-        # defining the tree root as the first word of the list
-        self.root = TreeNode(name=self.word_list[0], weight=0)
+        # number of processes for long lists, 1 builds the tree in the main process
+        self.workers = workers or Methods.thread_count()
+        self.store = NodeStore()
+        # the root is the first word of the list, unless a strategy picks a better one
+        self.pivot = pivot or "first"
+        self.pivot_score = None
+        if self.pivot != "first":
+            index, self.pivot_score = self.choose_root(self.word_list, self.edit_dist, self.pivot)
+            self.word_list.insert(0, self.word_list.pop(index))
+            print(f"Chose '{self.word_list[0]}' as the root ({self.pivot}: {self.pivot_score}).")
+        self.root = self.store.add_node(name=self.word_list[0], parent=-1, weight=0)
         # splitting the word list into chunks
-        self.chunks = Methods.chunkify(self.word_list[1:])
-        # creating a dictionary with each word and its distance to the root
-        self.dist_to_root = self._distances_to_root()
-        self.tree = self.create_bktree()
-        self.graph = self.get_graph()
+        self.chunks = Methods.chunkify(self.word_list[1:], self.workers)
+        # the distance of each word to the root, in the order of word_list[1:]
+        start = perf_counter()
+        with self.metrics.phase("root_distances"):
+            self.dist_to_root = self._distances_to_root()
+        with self.metrics.phase("insert"):
+            self.tree = self.create_bktree()
+        # metrics that compare signatures get them right away, so that the first query does not wait for them
+        if self.metric.signed is not None:
+            with self.metrics.phase("signatures"):
+                self.store.signatures()
+        self.metrics.gauge("build.words_per_second", round(self.length / max(perf_counter() - start, 1e-9)))
+        # the scratch data is only needed while building
+        del self.word_list, self.chunks, self.dist_to_root
         self.max_depth = self._get_max_depth()
 
+    @classmethod
+    def from_store(cls, store, edit_dist):
+        """
+        wraps an existing tree, e.g. one opened from an index file, so that words can be added and removed
+        without building the tree again
+        :param store: NodeStore of the tree
+        :param edit_dist: the distance metric the tree was built with
+        :return: BKTree object
+        """
+        tree = cls.__new__(cls)
+        tree.metrics = default_metrics
+        tree.count = 0
+        tree._bind(edit_dist)
+        tree.workers = 1
+        tree.pivot = None
+        tree.pivot_score = None
+        tree.store = store
+        tree.root = 0
+        tree.length = len(store) - sum(store.deleted)
+        tree.tree = store.node(tree.root)
+        tree.max_depth = tree._get_max_depth()
+        return tree
+
+    def _bind(self, edit_dist):
+        """ looks the metric up in the registry once, its functions are then called directly """
+        self.edit_dist = edit_dist
+        self.metric = registry.get(edit_dist)
+        self._distance = self.metric.dist
+        self._distances = self.metric.many
+        self._counter = f"distance.{self.metric.name}"
+
+    @staticmethod
+    def choose_root(word_list, edit_dist, strategy):
+        """
+        picks the root out of a sample of candidates, each candidate is rated by its distances to a sample of the words
+        (both samples are drawn with Config.pivot_seed, so the same list always gets the same root)
+        "fanout": the root whose distances are spread over the most edges, as evenly as possible
+        (the entropy of the distances), so that the words are split into many small subtrees
+        "visits": the root below which a query with the typical radius of the metric (Metric.radius)
+        has to look at the smallest share of the words, using the sampled words as queries
+        :param word_list: the cleaned word list
+        :param edit_dist: name of the distance metric
+        :param strategy: "fanout" or "visits"
+        :return: tuple of the index of the chosen root in word_list and its rating
+        """
+        if strategy not in BKTree.pivots[1:]:
+            raise ValueError(f"unknown root selection strategy '{strategy}', choose one of {BKTree.pivots}")
+        random = Random(Config.pivot_seed)
+        indices = range(len(word_list))
+        candidates = random.sample(indices, min(Config.pivot_candidates, len(word_list)))
+        sample = [word_list[i] for i in random.sample(indices, min(Config.pivot_sample_size, len(word_list)))]
+        metric = registry.get(edit_dist)
+        radius = metric.radius
+        distances = metric.many
+        best = None
+        for index in candidates:
+            counts = numpy.bincount(distances(word_list[index], sample))
+            if strategy == "fanout":
+                shares = counts[counts > 0] / len(sample)
+                score = round(float(-(shares * numpy.log2(shares)).sum()), 4)
+            else:
+                # a query with distance q to the root visits the edges between q - radius and q + radius
+                below = numpy.concatenate([[0], numpy.cumsum(counts)])
+                q = numpy.repeat(numpy.arange(len(counts)), counts)
+                visited = below[numpy.minimum(q + radius + 1, len(counts))] - below[numpy.maximum(q - radius, 0)]
+                score = -round(float(visited.mean()) / len(sample), 4)
+            if best is None or score > best[1]:
+                best = (index, score)
+        index, score = best
+        return index, abs(score)
+
+    def statistics(self):
+        """
+        :return: dictionary with the root selection and the shape of the tree
+        """
+        store = self.store
+        depths = store.depths()
+        inner = [i for i in range(len(store)) if store.child_count(i)]
+        return {"pivot": self.pivot, "pivot_score": self.pivot_score, "root": store.name(self.root),
+                "nodes": len(store), "max_depth": max(depths), "mean_depth": round(sum(depths) / len(depths), 2),
+                "root_children": store.child_count(self.root),
+                "mean_children": round((len(store) - 1) / len(inner), 2) if inner else 0}
+
+    def _find(self, word):
+        """
+        follows the path a word takes when it is inserted, if the word is part of the tree it lies on that path
+        :return: tuple of the last node on the path, the distance of the word to that node and
+        whether that node is the word itself
+        """
+        store = self.store
+        node = self.root
+        dist_to_node = self.get_distance(word, store.name(node))
+        while store.name(node) != word:
+            child = store.child_with_weight(node, dist_to_node)
+            if child is None:
+                return node, dist_to_node, False
+            node = child
+            dist_to_node = self.get_distance(word, store.name(node))
+        return node, dist_to_node, True
+
+    def insert(self, word):
+        """
+        adds a word to the finished tree, a word that was deleted before is simply restored
+        :return: True if the tree changed
+        """
+        node, dist_to_node, found = self._find(word)
+        if found and not self.store.deleted[node]:
+            return False
+        self.store.thaw()
+        if found:
+            self.store.deleted[node] = 0
+        else:
+            self.store.add_node(name=word, parent=node, weight=dist_to_node)
+        self.length += 1
+        return True
+
+    def delete(self, word):
+        """
+        removes a word from the finished tree
+        the node can't be unlinked because the words below it were sorted in by their distance to it,
+        so it stays in the tree as a tombstone that is skipped by queries until compact() is called
+        :return: True if the tree changed
+        """
+        node, _, found = self._find(word)
+        if not found or self.store.deleted[node]:
+            return False
+        self.store.thaw()
+        self.store.deleted[node] = 1
+        self.length -= 1
+        return True
+
+    def compact(self):
+        """
+        removes the tombstones left by delete()
+        all words below a deleted node share the path from the root to its parent,
+        so the subtree is taken out and its remaining words are inserted again starting at that parent
+        only when the root itself was deleted, the tree is built again from all remaining words
+        :return: number of words that had to be inserted again
+        """
+        old = self.store
+        n = len(old)
+        if not any(old.deleted):
+            return 0
+        if self.length == 0:
+            raise ValueError("cannot remove every word of the tree")
+        # top[i] is the highest deleted node above (or at) node i, -1 if there is none
+        # parents always have a lower id than their children, so one pass in order of the ids is enough
+        top = array("i", [-1]) * n
+        for i in range(n):
+            if i > 0 and top[old.parents[i]] >= 0:
+                top[i] = top[old.parents[i]]
+            elif old.deleted[i]:
+                top[i] = i
+
+        store = NodeStore()
+        reinserted = 0
+        if old.deleted[self.root]:
+            words = [old.name(i) for i in range(n) if not old.deleted[i]]
+            store.add_node(name=words[0], parent=-1, weight=0)
+            for word in words[1:]:
+                self.insert_into(store, self.get_distance, word, node=0,
+                                 dist_to_node=self.get_distance(word, words[0]))
+            reinserted = len(words)
+        else:
+            new_ids = array("i", [-1]) * n
+            for i in range(n):
+                if top[i] < 0:
+                    parent = new_ids[old.parents[i]] if i > 0 else -1
+                    new_ids[i] = store.add_node(name=old.name(i), parent=parent, weight=old.weights[i])
+            for i in range(n):
+                if top[i] >= 0 and not old.deleted[i]:
+                    self.insert_into(store, self.get_distance, old.name(i), node=new_ids[old.parents[top[i]]],
+                                     dist_to_node=old.weights[top[i]])
+                    reinserted += 1
+        store.freeze()
+        self.store = store
+        self.tree = store.node(self.root)
+        self.max_depth = self._get_max_depth()
+        return reinserted
+
+    def names(self):
+        """ returns the words of the tree that were not deleted """
+        store = self.store
+        return [store.name(i) for i in range(len(store)) if not store.deleted[i]]
+
+    def save(self, path):
+        """ writes the tree to a binary index file, see NodeStore.save """
+        self.store.save(path, metric=self.metric.name)
+
+    def write_text(self, f):
+        """ writes the tree to an open text file, one line per node, see NodeStore.write_text """
+        return self.store.write_text(f, root=self.root)
+
+    @classmethod
+    def read_text(cls, f, edit_dist):
+        """
+        rebuilds a tree from a text file written by write_text(), no distances are calculated
+        :param f: text file opened for reading
+        :param edit_dist: the distance metric the tree was built with
+        :return: BKTree object
+        """
+        return cls.from_store(NodeStore.read_text(f), edit_dist)
+
     def _distances_to_root(self):
         print("Calculating root distance for every word...")
-        if len(self.chunks) == Methods.thread_count():
+        if self.workers > 1 and len(self.chunks) > 1:
             distances = self._multiprocessing()
         else:
-            distances = {}
-            self._distance_to_root(L=self.chunks, dist_dict=distances)
+            distances = self.get_distances(self.word_list[0], self.word_list[1:])
         print("Done.")
-        return distances
-
-    def _distance_to_root(self, L: list, dist_dict: dict):
-        root = self.word_list[0]
-        index = 0
-        while index < len(L):
-            word = L[index]
-            dist_dict[word] = self.get_distance(word, root)
-            index += 1
+        return distances.tolist()
 
     def _multiprocessing(self):
-        # creating a value dictionary
-        manager = Manager()
-        distances = manager.dict()
-        # each chunk of the word list will be processed by a separate process
-        processes = [Process(target=self._distance_to_root, args=(chunk, distances)) for chunk in self.chunks]
-        for process in processes:
-            process.daemon = True
-            process.start()
-        for process in processes:
-            process.join()
-        return distances
+        """
+        each chunk of the word list is processed by a worker of a process pool,
+        the workers return their distances as one array per chunk, which are put together in order
+        """
+        root = self.word_list[0]
+        with Pool(min(self.workers, len(self.chunks))) as pool:
+            results = pool.map(chunk_distances, [(root, chunk, self.edit_dist) for chunk in self.chunks], chunksize=1)
+        self.metrics.count(self._counter, len(self.word_list) - 1)
+        return numpy.concatenate(results)
 
     def create_bktree(self):
         """
         calls the _create_bktree_recursive function which actually builds the tree
-        if the word list is long enough it will call the function in multiple threads to save time
-        short lists will be processed in a single thread
-        :return: tree object
+        if the word list is long enough, the subtrees below the root are built in multiple processes to save time
+        short lists will be processed in a single process
+        :return: view on the root node of the finished tree
         """
-        chunks = self.chunks
-        if len(chunks) == Methods.thread_count():
-            return self._multithreading(chunks)
+        if self.workers > 1 and self.length > Config.parallel_build_size:
+            self._multiprocessing_build()
         else:
-            self._create_bktree_recursive(self.word_list[1:])
-            return self.root
-
-    def _multithreading(self, chunks):
-        # creating a thread for each chunk
-        threads = [Thread(target=self._create_bktree_recursive, args=(chunk,)) for chunk in chunks]
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
-        return self.root
+            self._create_bktree_recursive(self.word_list[1:], self.dist_to_root)
+        # packing the nodes into their compact form once all words are inserted
+        self.store.freeze()
+        return self.store.node(self.root)
 
-    def _create_bktree_recursive(self, L):
+    def _multiprocessing_build(self):
         """
-        recursive function that builds the tree with help of bk_parent
+        every word with the same distance to the root ends up below the same child of the root,
+        so each of these buckets is an independent subtree that can be built in its own process
+        the subtrees are grafted under the root in order of their distance, which gives
+        exactly the tree the single process build would give, no matter how many workers are used
+        """
+        buckets = {}
+        for word, dist in zip(self.word_list[1:], self.dist_to_root):
+            buckets.setdefault(dist, []).append(word)
+        weights = sorted(buckets)
+        # the largest buckets are handed out first so that no worker is left with a big one at the end
+        jobs = sorted(weights, key=lambda weight: len(buckets[weight]), reverse=True)
+        print(f"Building {len(jobs)} subtrees in {self.workers} processes...")
+        with Pool(self.workers) as pool:
+            subtrees = dict(zip(jobs, pool.map(_build_subtree, [(buckets[weight], self.edit_dist) for weight in jobs],
+                                               chunksize=1)))
+        for weight in weights:
+            names, parents, edges, calls = subtrees.pop(weight)
+            self.store.graft(names, parents, edges, parent=self.root, weight=weight)
+            self.metrics.count(self._counter, calls)
+            self.count += len(buckets[weight])
+            print(f"{self.count} / {self.length} words parsed.")
+
+    def _create_bktree_recursive(self, L, distances):
+        """
+        function that builds the tree with help of _find_parent_node
         :param L: word list
+        :param distances: distance of each word of L to the root
         :return: tree object
         """
-        # the object is locked whenever a thread is modifying it to avoid clashing
-        locker = Lock()
         index = 0
         while index < len(L):
             word = L[index]
-            with locker:
-                self.count += 1
-                # bk_parent function is called to find the node to which the word has to bind to
-                self._find_parent_node(word, self.root)
-            # for every 1000 words being processed a status message is printed
-            if self.count % 10000 == 0 and self.count not in self.fix_count:
-                self.fix_count.append(self.count)
+            self.count += 1
+            # _find_parent_node function is called to find the node to which the word has to bind to
+            self._find_parent_node(word, distances[index])
+            # for every 10000 words being processed a status message is printed
+            if self.count % 10000 == 0:
                 print(f"{self.count} / {self.length} words parsed.")
                 print(Methods.progress_bar(self.count, self.length))
             index += 1
         return self.root
 
-    def _find_parent_node(self, word, root, level=0):
+    def _find_parent_node(self, word, dist_to_root):
         """
-        recursive function that finds the right parent for a word and adds it to its children
+        finds the right parent for a word and adds it to its children
         :param word: the currently processed word
-        :param root: the node that's being looked at, not always the root of the entire tree
+        :param dist_to_root: the distance between word and root
         :return: word becomes child node of the parent that was determined
         """
-        current_node = root
-        if level == 0:
-            dist_to_current = self.dist_to_root[word]
-        else:
-            dist_to_current = self.get_distance(word, current_node.name)
-        if not current_node.is_leaf:
-            index = 0
-            while index < len(current_node.children):
-                node = current_node.children[index]
-                index += 1
-                # if there already is an edge with the same distance,
-                # recursively iterate through the children of that node
-                if node.weight == dist_to_current:
-                    current_node = node
-                    return self._find_parent_node(word, current_node, level + 1)
-        # once the right parent node is found, the new distance is calculated
-        # and the word is added to the children of that node
-        dist_to_current = self.get_distance(word, current_node.name)
-        current_node.add_child(name=word, weight=dist_to_current)
+        self.insert_into(self.store, self.get_distance, word, node=self.root, dist_to_node=dist_to_root)
+
+    @staticmethod
+    def insert_into(store, distance, word, node, dist_to_node):
+        """
+        walks down from a node to the right parent for a word and adds the word to its children
+        :param store: NodeStore that is being built
+        :param distance: function that calculates the distance of two words
+        :param word: the currently processed word
+        :param node: the node the search starts at
+        :param dist_to_node: the distance between word and node
+        :return: id of the new node
+        """
+        # if there already is an edge with the same distance,
+        # continue with the child at the end of that edge
+        child = store.child_with_weight(node, dist_to_node)
+        while child is not None:
+            node = child
+            dist_to_node = distance(word, store.name(node))
+            child = store.child_with_weight(node, dist_to_node)
+        # once the right parent node is found, the word is added to its children
+        return store.add_node(name=word, parent=node, weight=dist_to_node)
 
     def get_distance(self, w1, w2):
         """
         calls the respective function to calculate the chosen distance metric of the pair of words
         :return: the calculated edit distance
         """
-        if self.edit_dist.startswith("lev"):
-            return LevenshteinDistance.dist(w1, w2)
-        elif self.edit_dist.startswith("ham"):
-            return HammingDistance.dist(w1, w2)
-        elif self.edit_dist.startswith("jac"):
-            return JaccardDistance.J(w1, w2)
-        elif self.edit_dist.startswith("jar"):
-            return JaroWinklerDistance.jaro_Winkler(w1, w2)
-        else:
-            raise TypeError
+        self.metrics.count(self._counter)
+        return self._distance(w1, w2)
 
-    def get_graph(self):
-        if len(self.word_list) >= Config.max_items:
-            print("The word list is too long for a graph to be generated. "
-                  "Limit is 30. However the tree will be stored "
-                  "in a text file.")
-        else:
-            vis = Visualizer(self.tree)
-            return vis.graph
+    @staticmethod
+    def distance_function(edit_dist):
+        """
+        :param edit_dist: name of the distance metric
+        :return: the function that calculates that metric for a pair of words
+        """
+        return registry.get(edit_dist).dist
 
-    def _get_max_depth(self) -> int:
-        max_depth = 0
-        depth_of_current_branch = 0
+    def get_distances(self, word, candidates):
+        """
+        calls the batch version of the chosen distance metric
+        :return: integer array with the distance of every candidate to the word
+        """
+        self.metrics.count(self._counter, len(candidates))
+        return self._distances(word, candidates)
 
-        node_depth_tuple = [(self.tree, depth_of_current_branch)]
+    @staticmethod
+    def batch_function(edit_dist):
+        """
+        :param edit_dist: name of the distance metric
+        :return: the function that calculates that metric between one word and a list of candidates
+        """
+        return registry.get(edit_dist).many
 
-        # traversing through the tree
-        while node_depth_tuple:
-            current_neighbour = node_depth_tuple.pop()
-            current_children = current_neighbour[0].children
-            depth_of_current_branch = current_neighbour[1]
-            depth_of_current_branch += 1
+    def renderer(self, root=None, max_depth=None):
+        """
+        :param root: word whose subtree is drawn, the whole tree if it is None
+        :param max_depth: number of levels below root that are drawn, None draws all of them
+        :return: TreeRenderer for the tree or the part of it
+        :raise KeyError: if root is not part of the tree
+        """
+        node = self.root
+        if root is not None:
+            node, _, found = self._find(root)
+            if not found:
+                raise KeyError(root)
+        return TreeRenderer(self.store, node, max_depth)
 
-            if len(current_children) == 0:
-                max_depth = depth_of_current_branch if depth_of_current_branch > max_depth else max_depth
-            else:
-                for child in current_children:
-                    node_depth_tuple.append((child, depth_of_current_branch))
+    def get_graph(self, headless=False, root=None, max_depth=None):
+        """
+        draws the tree (or the part of it chosen like in renderer()), matplotlib is only imported here
+        :param headless: draw without opening a window (Agg backend), e.g. to save the graph as a png
+        :return: matplotlib.pyplot with the drawn graph, None if there are too many nodes to draw
+        """
+        renderer = self.renderer(root, max_depth)
+        # the walk stops at the limit, so large trees are not walked just to find out that they are too large
+        if sum(1 for _ in islice(renderer.walk(), Config.max_items)) >= Config.max_items:
+            print(f"There are too many nodes for a graph to be drawn. Limit is {Config.max_items}. "
+                  "Draw a part of the tree with --plot-root and --plot-depth or write an svg or dot file instead.")
+            return None
+        from model.Visualizer import Visualizer
+        return Visualizer(renderer, headless=headless).graph
 
-        return max_depth - 1
+    def _get_max_depth(self) -> int:
+        return max(self.store.depths())
@@ -0,0 +1,204 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Auxillary import Config
+from model.NodeStore import IndexFormat
+from model.Registry import registry
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+
+class BuildCache:
+    """
+    Content-addressed cache for the files generated for a tree (index, text version and graph)
+    the files are named after a hash of the cleaned word list, the metric and the index format version,
+    so an edited list never reuses an old tree and two lists with the same name never collide
+    a manifest remembers the key of every word list file together with its size and modification time,
+    so an unchanged file is recognized without reading or cleaning it again
+    the directory is kept below a size limit by removing the least recently used trees
+    """
+
+    manifest_name = "manifest.json"
+    # files that belong to a tree, {key} is replaced by the cache key
+    artifacts = ["{key}.bkidx", "{key}_result.txt", "{key}.png", "{key}.svg", "{key}.dot"]
+
+    def __init__(self, directory="output", max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes if max_bytes is not None else Config.cache_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    @staticmethod
+    def key(word_list, metric, options=()):
+        """
+        :param word_list: the cleaned word list
+        :param metric: name of the distance metric
+        :param options: build options that change the tree, e.g. the strategy the root was chosen with
+        (options left at their default are not listed, so those trees keep the keys they had before the option existed)
+        :return: hex digest identifying the tree built from that list with that metric
+        """
+        digest = hashlib.sha256(f"{registry.get(metric).name}\0{IndexFormat.version}\0".encode("UTF-8"))
+        for option in options:
+            digest.update(f"{option}\0".encode("UTF-8"))
+        for word in word_list:
+            digest.update(word.encode("UTF-8"))
+            digest.update(b"\n")
+        return digest.hexdigest()[:32]
+
+    @staticmethod
+    def diff_key(base, added, removed):
+        """
+        :param base: key of the saved tree the changes are applied to
+        :param added: the cleaned words that are added
+        :param removed: the cleaned words that are removed
+        :return: hex digest identifying the tree with these changes, the word list file keeps the key of its content
+        """
+        digest = hashlib.sha256(f"{base}\0".encode("UTF-8"))
+        for sign, words in (("+", added), ("-", removed)):
+            for word in sorted(set(words)):
+                digest.update(f"{sign}{word}\n".encode("UTF-8"))
+        return digest.hexdigest()[:32]
+
+    def index_path(self, key):
+        return os.path.join(self.directory, f"{key}.bkidx")
+
+    def has(self, key):
+        return os.path.exists(self.index_path(key))
+
+    def lookup(self, path, metric, options=()):
+        """
+        :return: the key of a word list file that has not changed since it was last used, otherwise None
+        """
+        entry = self.manifest.get(self._entry_name(path, metric, options))
+        if entry and entry["stat"] == self._stat(path) and self.has(entry["key"]):
+            return entry["key"]
+        return None
+
+    def previous(self, path, metric, options=()):
+        """
+        :return: the key the word list file had when it was last used, even if it changed since then
+        """
+        entry = self.manifest.get(self._entry_name(path, metric, options))
+        if entry and self.has(entry["key"]):
+            return entry["key"]
+        return None
+
+    def remember(self, path, metric, key, options=()):
+        """ stores the key of a word list file in the manifest """
+        self.manifest[self._entry_name(path, metric, options)] = {"stat": self._stat(path), "key": key}
+        self._write_manifest()
+
+    def touch(self, key):
+        """ marks a tree as used, the modification time of its index decides the order of eviction """
+        if self.has(key):
+            os.utime(self.index_path(key))
+
+    def evict(self, keep=None):
+        """
+        removes the least recently used trees until the directory is below the size limit
+        :param keep: key of a tree that must not be removed
+        :return: list of the removed keys
+        """
+        sizes = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".bkidx"):
+                key = name[:-len(".bkidx")]
+                sizes[key] = sum(os.path.getsize(path) for path in self._artifact_paths(key))
+        total = sum(sizes.values())
+        removed = []
+        for key in sorted(sizes, key=lambda key: os.path.getmtime(self.index_path(key))):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in self._artifact_paths(key):
+                os.remove(path)
+            total -= sizes[key]
+            removed.append(key)
+        if removed:
+            self.manifest = {name: entry for name, entry in self.manifest.items() if entry["key"] not in removed}
+            self._write_manifest()
+        return removed
+
+    def _artifact_paths(self, key):
+        paths = [os.path.join(self.directory, artifact.format(key=key)) for artifact in self.artifacts]
+        return [path for path in paths if os.path.exists(path)]
+
+    @staticmethod
+    def _entry_name(path, metric, options=()):
+        return "|".join([os.path.abspath(path), registry.get(metric).name, *options])
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, self.manifest_name), encoding="UTF-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, self.manifest_name)
+        with open(f"{path}.tmp", "w", encoding="UTF-8") as f:
+            json.dump(self.manifest, f)
+        os.replace(f"{path}.tmp", path)
+
+
+class QueryCache:
+    """
+    Bounded cache for the results of range queries, indexed by the query word
+    only the largest radius calculated so far is kept for each word, every smaller radius is answered
+    by filtering those matches, since they contain all words within the smaller radius
+    when the cache is full, the word that was queried least recently is removed
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries if max_entries is not None else Config.query_cache_size
+        # word -> (radius, matches), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, word, d):
+        """
+        :return: dictionary of the matches within d and their distance, None if they are not cached
+        """
+        entry = self._entries.get(word)
+        if entry is None or entry[0] < d:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(word)
+        self.hits += 1
+        radius, matches = entry
+        if radius == d:
+            return matches
+        return {match: dist for match, dist in matches.items() if dist <= d}
+
+    def put(self, word, d, matches):
+        """ stores the matches of a query unless matches for a larger radius are already cached """
+        if self.max_entries <= 0:
+            return
+        entry = self._entries.get(word)
+        if entry is not None and entry[0] >= d:
+            return
+        self._entries[word] = (d, matches)
+        self._entries.move_to_end(word)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "max_entries": self.max_entries}
@@ -5,55 +5,364 @@
 
 
 import numpy
-from math import floor, ceil
+from collections import Counter, namedtuple
+from operator import ne
+from model.Auxillary import Config
+
+
+class CodePoints:
+    """
+    Encodes words as arrays of unicode code points for the batch kernels
+    a list of words becomes a matrix with one row per word, padded with zeros
+    """
+
+    @staticmethod
+    def encode(words):
+        """
+        :param words: list of words
+        :return: tuple of the padded code point matrix and the length of every word
+        """
+        lengths = numpy.fromiter(map(len, words), dtype=numpy.int64, count=len(words))
+        width = max(int(lengths.max(initial=0)), 1)
+        codes = numpy.array(words, dtype=f"<U{width}").view(numpy.uint32).reshape(len(words), width)
+        return codes.astype(numpy.int64), lengths
+
+    @staticmethod
+    def encode_word(word):
+        return numpy.frombuffer(word.encode("UTF-32-LE"), dtype=numpy.uint32).astype(numpy.int64)
+
+    @staticmethod
+    def batched(kernel, scalar, word, candidates):
+        """
+        runs a batch kernel over the candidates in blocks of Config.batch_block_size,
+        very small batches are cheaper to compute with the scalar kernel
+        :param kernel: function(word, codes, lengths, candidates) returning the distances of one block
+        :param scalar: function(candidate, word) returning a single distance
+        :return: integer array with the distance of every candidate
+        """
+        if len(candidates) < Config.min_batch_size:
+            return numpy.array([scalar(candidate, word) for candidate in candidates], dtype=numpy.int64)
+        block = Config.batch_block_size
+        results = []
+        for start in range(0, len(candidates), block):
+            chunk = candidates[start:start + block]
+            codes, lengths = CodePoints.encode(chunk)
+            results.append(kernel(word, codes, lengths, chunk))
+        return numpy.concatenate(results)
+
+    @staticmethod
+    def apply_exact(values, function):
+        """
+        applies a python function to every distinct value of an array,
+        used to round exactly like the scalar kernels do (numpy rounds slightly differently)
+        """
+        distinct, inverse = numpy.unique(values, return_inverse=True)
+        mapped = numpy.array([function(value) for value in distinct.tolist()], dtype=numpy.int64)
+        return mapped[inverse.reshape(-1)]
+
+
+# a query word encoded for one Signatures: the bitmasks of its letters in the alphabet of the index,
+# the number of its distinct letters outside of that alphabet and its length
+QuerySignature = namedtuple("QuerySignature", ["word", "masks", "extra", "length"])
+
+
+class Signatures:
+    """
+    Signatures of the words of an index, calculated once and saved with it, so that the Jaccard and Hamming
+    kernels can compare a query word with them instead of encoding the names again for every query:
+    the length of every word and its letters as bitmasks over an alphabet of the (at most 64) most frequent letters
+    of the index, in layers: the first mask holds the letters that occur at least once, the second the ones that
+    occur at least twice and so on
+    words with letters outside the alphabet or repeated more often than there are layers are flagged as not exact,
+    the kernels calculate their distance from the name instead
+    """
+
+    # number of letters in the alphabet (bits of a mask) and number of masks per word
+    size = 64
+    layers = 4
+    # (attribute, dtype, length as a function of the number of words) in the index files
+    arrays = [("alphabet", numpy.uint32, lambda n: Signatures.size),
+              ("masks", numpy.uint64, lambda n: n * Signatures.layers),
+              ("lengths", numpy.int32, lambda n: n),
+              ("exact", numpy.uint8, lambda n: n)]
+
+    def __init__(self, alphabet, masks, lengths, exact):
+        """
+        :param alphabet: the code points of the alphabet, sorted and padded with the largest uint32
+        (which is no code point) to Signatures.size
+        :param masks: uint64 array with one row of Signatures.layers masks per word
+        :param lengths: int32 array with the length of every word
+        :param exact: uint8 array, 1 for the words whose masks hold all of their letters
+        """
+        self.alphabet = alphabet
+        self.masks = masks
+        self.lengths = lengths
+        self.exact = exact
+        self._bits = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, words):
+        """
+        :param words: list of words, the most frequent letters in them become the alphabet
+        :return: Signatures of the words
+        """
+        letters = [ord(letter) for letter, _ in Counter("".join(words)).most_common(cls.size)]
+        alphabet = numpy.full(cls.size, numpy.iinfo(numpy.uint32).max, dtype=numpy.uint32)
+        alphabet[:len(letters)] = sorted(letters)
+        return cls(alphabet, *cls._encode(alphabet, words))
+
+    def extend(self, words):
+        """
+        :return: Signatures with the given words appended, in the same alphabet
+        """
+        masks, lengths, exact = self._encode(self.alphabet, words)
+        return Signatures(self.alphabet, numpy.concatenate([self.masks, masks]),
+                          numpy.concatenate([self.lengths, lengths]), numpy.concatenate([self.exact, exact]))
+
+    def take(self, ids):
+        """
+        :return: Signatures of the words with the given ids, in the same alphabet
+        """
+        return Signatures(self.alphabet, self.masks[ids], self.lengths[ids], self.exact[ids])
+
+    @staticmethod
+    def _encode(alphabet, words):
+        """
+        the masks are filled column by column: the bit of a letter goes into the first layer that does not have it yet
+        :return: tuple of the masks, lengths and exact flags of the words
+        """
+        layers = Signatures.layers
+        results = []
+        for start in range(0, len(words), Config.batch_block_size):
+            codes, lengths = CodePoints.encode(words[start:start + Config.batch_block_size])
+            positions = numpy.minimum(numpy.searchsorted(alphabet, codes), len(alphabet) - 1)
+            valid = numpy.arange(codes.shape[1]) < lengths[:, None]
+            known = (alphabet[positions] == codes) & valid
+            bits = numpy.where(known, numpy.left_shift(numpy.uint64(1), positions.astype(numpy.uint64)),
+                               numpy.uint64(0))
+            masks = numpy.zeros((len(codes), layers), dtype=numpy.uint64)
+            overflow = numpy.zeros(len(codes), dtype=bool)
+            for column in range(codes.shape[1]):
+                carry = bits[:, column]
+                for layer in range(layers):
+                    present = masks[:, layer] & carry
+                    masks[:, layer] |= carry
+                    carry = present
+                overflow |= carry != 0
+            exact = ~overflow & ~(valid & ~known).any(axis=1)
+            results.append((masks, lengths.astype(numpy.int32), exact.astype(numpy.uint8)))
+        if not results:
+            return (numpy.zeros((0, layers), dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int32),
+                    numpy.zeros(0, dtype=numpy.uint8))
+        return tuple(numpy.concatenate(parts) for parts in zip(*results))
+
+    def query(self, word):
+        """
+        encodes a query word once, the kernels then compare it with any number of signatures
+        :return: QuerySignature of the word
+        """
+        if self._bits is None:
+            self._bits = {chr(code): 1 << bit for bit, code in enumerate(self.alphabet.tolist()) if code <= 0x10FFFF}
+        masks = [0] * self.layers
+        extra = set()
+        for letter in word:
+            bit = self._bits.get(letter)
+            if bit is None:
+                extra.add(letter)
+                continue
+            for layer in range(self.layers):
+                if not masks[layer] & bit:
+                    masks[layer] |= bit
+                    break
+        return QuerySignature(word, numpy.array(masks, dtype=numpy.uint64), len(extra), len(word))
+
+    @staticmethod
+    def popcount(values):
+        """ number of set bits of every value of an uint64 array """
+        if hasattr(numpy, "bitwise_count"):
+            return numpy.bitwise_count(values).astype(numpy.int64)
+        # numpy before 2.0: the bits of every byte are looked up in a table
+        table = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.int64)
+        return table[values[..., None].view(numpy.uint8)].sum(axis=-1)
+
+    def to_arrays(self):
+        """ :return: the arrays in the order of Signatures.arrays, as they are written to an index file """
+        return [self.alphabet, self.masks.reshape(-1), self.lengths, self.exact]
+
+    @classmethod
+    def from_buffer(cls, buffer, position, n):
+        """
+        reads the arrays written by to_arrays() without copying them, each one starting at a multiple of 8 bytes
+        :param buffer: memory map of an index file
+        :param position: offset of the first array
+        :param n: number of words
+        :return: tuple of the Signatures and the offset behind the last array
+        """
+        arrays = []
+        for _, dtype, length in cls.arrays:
+            count = length(n)
+            end = position + count * numpy.dtype(dtype).itemsize
+            if end > len(buffer):
+                raise ValueError("index file is truncated")
+            arrays.append(numpy.frombuffer(buffer, dtype=dtype, count=count, offset=position))
+            position = end + -end % 8
+        alphabet, masks, lengths, exact = arrays
+        return cls(alphabet, masks.reshape(n, cls.layers), lengths, exact), position
+
+
+class LowerBounds:
+    """
+    Cheap lower bounds of the distances, used by the search to rule out words before the exact distance is calculated
+    each one takes the query word and a list of candidates and returns an integer array like the batch kernels
+    """
+
+    @staticmethod
+    def length(word, candidates):
+        """
+        difference in length: every missing or surplus letter costs at least one edit
+        """
+        return numpy.abs(numpy.fromiter(map(len, candidates), dtype=numpy.int64, count=len(candidates)) - len(word))
+
+    @staticmethod
+    def bag(word, candidates):
+        """
+        bag distance: the larger of the number of letters of the word that the candidate lacks and the number of
+        letters of the candidate the word lacks (counted with repetitions, ignoring the order),
+        every edit fixes at most one letter of each side
+        """
+        letters = Counter(word)
+
+        def scalar(candidate, _):
+            left = letters.copy()
+            surplus = 0
+            for letter in candidate:
+                if left.get(letter):
+                    left[letter] -= 1
+                else:
+                    surplus += 1
+            # letters of the word the candidate lacks: all that were not matched by a letter of the candidate
+            return max(surplus, len(word) - len(candidate) + surplus)
+
+        def kernel(word, codes, lengths, _):
+            query, counts = numpy.unique(CodePoints.encode_word(word), return_counts=True)
+            # occurrences of every distinct letter of the word in each candidate
+            occurrences = (codes[:, :, None] == query[None, None, :]).sum(axis=1)
+            shared = numpy.minimum(occurrences, counts).sum(axis=1)
+            return numpy.maximum(lengths, len(word)) - shared
+
+        return CodePoints.batched(kernel, scalar, word, candidates)
 
 
 class LevenshteinDistance:
+    # lower bounds tried before the exact distance, cheapest first
+    lower_bounds = [("length", LowerBounds.length), ("bag", LowerBounds.bag)]
 
     @staticmethod
-    def dist(w1, w2):
+    def dist(w1, w2, max_dist=None):
         """
         This method calculates the Levenshtein distance between two words
-        by creating a matrix that contains the distances between all the prefixes of the two words
-        using a dynamic programming approach
+        using a dynamic programming approach over the distances between all the prefixes of the two words,
+        only the previous row of the matrix is kept
+        if max_dist is given, only the diagonal band of width max_dist is filled
+        and the calculation stops as soon as a whole row exceeds max_dist
         :param w1: word of parent node
         :param w2: word of child node (interchangeable)
-        :return: Levenshtein distance between the two words
+        :param max_dist: optional upper bound, distances above it are not calculated exactly
+        :return: Levenshtein distance between the two words, or max_dist + 1 if it is greater than max_dist
         """
-
-        # initiating the matrix
-        matrix = numpy.zeros((len(w1) + 1, len(w2) + 1))
+        if w1 == w2:
+            return 0
+        len1, len2 = len(w1), len(w2)
+        # the distance can never exceed the length of the longer word, so without a bound the band is the whole matrix
+        if max_dist is None:
+            max_dist = max(len1, len2)
+        # the distance is at least the difference in length
+        elif abs(len1 - len2) > max_dist:
+            return max_dist + 1
+        # every cell above the bound is capped at max_dist + 1, which also stands for the cells outside the band
+        too_far = max_dist + 1
 
         # first row is filled with values starting from 0
-        for i in range(len(w1) + 1):
-            matrix[i][0] = i
-        # first column is filled with values starting from 0
-        for j in range(len(w2) + 1):
-            matrix[0][j] = j
-
-        # iterating through each cell of the matrix excluding first row and column
-        for i in range(1, len(w1) + 1):
-            for j in range(1, len(w2) + 1):
-                # inside the loops the distances are calculated for all combinations of prefixes from the two words
+        previous = [j if j <= max_dist else too_far for j in range(len2 + 1)]
+
+        for i in range(1, len1 + 1):
+            current = [too_far] * (len2 + 1)
+            current[0] = i if i <= max_dist else too_far
+            row_min = current[0]
+            c1 = w1[i - 1]
+            # only the cells with |i - j| <= max_dist can hold a distance within the bound
+            for j in range(max(1, i - max_dist), min(len2, i + max_dist) + 1):
                 # if the two characters are equal,
                 # the distance is equal to that of the cell to the top left of the current cell
-                if w1[i - 1] == w2[j - 1]:
-                    matrix[i][j] = matrix[i - 1][j - 1]
+                if c1 == w2[j - 1]:
+                    value = previous[j - 1]
                 else:
                     # if the two characters are not equal,
                     # the distance is the minimum of the cell bordering it to the left, top left, and top middle
                     # with an added cost of 1
-                    a = matrix[i][j - 1]
-                    b = matrix[i - 1][j]
-                    c = matrix[i - 1][j - 1]
-                    low = min(a, b, c)
-                    matrix[i][j] = low + 1
+                    value = min(previous[j - 1], previous[j], current[j - 1]) + 1
+                    if value > too_far:
+                        value = too_far
+                current[j] = value
+                if value < row_min:
+                    row_min = value
+            # the values can only grow from row to row, so once all of them exceed the bound, so does the distance
+            if row_min > max_dist:
+                return too_far
+            previous = current
+
+        # the Levenshtein distance is then located at the end of the last row
+        return previous[len2]
 
-        # the Levenshtein distance is then located at the bottom-right corner of the matrix
-        return int(matrix[len(w1)][len(w2)])
+    @staticmethod
+    def many(word, candidates, max_dist=None):
+        """
+        Calculates the Levenshtein distance between one word and many candidates at once
+        the rows of the matrix are calculated for all candidates together, the insertions of a row
+        are resolved with a cumulative minimum instead of a loop over the columns
+        :param word: the query word
+        :param candidates: list of words
+        :param max_dist: optional upper bound, like in dist(), or a list with a separate bound for every candidate
+        :return: integer array with the distance of every candidate
+        """
+        if isinstance(max_dist, list):
+            if len(candidates) < Config.min_batch_size:
+                return numpy.array([LevenshteinDistance.dist(candidate, word, bound)
+                                    for candidate, bound in zip(candidates, max_dist)], dtype=numpy.int64)
+            # the batch kernel works with a single bound, the largest one, and caps the results afterwards
+            return numpy.minimum(LevenshteinDistance.many(word, candidates, max(max_dist, default=0)),
+                                 numpy.array(max_dist, dtype=numpy.int64) + 1)
+
+        def kernel(word, codes, lengths, _):
+            query = CodePoints.encode_word(word)
+            columns = numpy.arange(codes.shape[1] + 1)
+            valid = columns[None, :] <= lengths[:, None]
+            # first row is filled with values starting from 0
+            previous = numpy.broadcast_to(columns, (len(codes), len(columns))).copy()
+            current = numpy.empty_like(previous)
+            for i in range(1, len(query) + 1):
+                current[:, 0] = i
+                # substitution (or match) and deletion
+                numpy.minimum(previous[:, :-1] + (codes != query[i - 1]), previous[:, 1:] + 1, out=current[:, 1:])
+                # insertion: current[j] = min(current[j], current[j - 1] + 1)
+                current = numpy.minimum.accumulate(current - columns, axis=1) + columns
+                previous, current = current, previous
+                if max_dist is not None and numpy.where(valid, previous, max_dist + 1).min() > max_dist:
+                    return numpy.full(len(codes), max_dist + 1, dtype=numpy.int64)
+            result = previous[numpy.arange(len(codes)), lengths]
+            if max_dist is not None:
+                numpy.minimum(result, max_dist + 1, out=result)
+            return result
+
+        return CodePoints.batched(kernel, lambda w1, w2: LevenshteinDistance.dist(w1, w2, max_dist),
+                                  word, candidates)
 
 
 class HammingDistance:
+    lower_bounds = [("length", LowerBounds.length)]
 
     @staticmethod
     def dist(w1, w2):
@@ -61,13 +370,14 @@ class HammingDistance:
         :param w1: word of parent node
         :param w2: word of child node (interchangeable)
         This method calculates the Hamming distance between two given words
-        using a simple iteration approach
         in contrary to the original hamming distance which only works for words of same length,
         this method also accounts for words that differ in length
         :return: calculated Hamming distance as integer
         """
-
-        res = 0
+        # for words of same length, each letter that is not identical increases distance by 1,
+        # they can only contain each other if they are equal, which gives 0 anyway
+        if len(w1) == len(w2):
+            return sum(map(ne, w1, w2))
 
         # if one word contains the other, the difference in length is their distance
         if w1 in w2:
@@ -75,30 +385,84 @@ class HammingDistance:
         if w2 in w1:
             return len(w1) - len(w2)
 
-        # for words of same length, each letter that is not identical increases distance by 1
-        if len(w1) == len(w2):
-            for i in range(len(w1)):
-                if w1[i] != w2[i]:
-                    res += 1
-            return res
-
-        # for words of different length
-        elif len(w1) != len(w2):
-
-            # the distance is at least the difference in length
-            res = max(len(w1), len(w2)) - min(len(w1), len(w2))
-
-            # then each letter which is not identical further increases the distance by 1
-            for i in range(min(len(w1), len(w2))):
-                if w1[i] != w2[i]:
-                    res += 1
-            return res
-        else:
-            # if two words arent of different length but not of same length either, something must be wrong
-            raise TypeError
+        # for words of different length the distance is at least the difference in length,
+        # then each letter which is not identical further increases the distance by 1
+        return abs(len(w1) - len(w2)) + sum(map(ne, w1, w2))
+
+    @staticmethod
+    def _kernel(word, codes, lengths, contained):
+        """
+        the distance is the difference in length plus the mismatches within the shorter length,
+        unless one word contains the other (contained), then it is just the difference in length
+        """
+        query = CodePoints.encode_word(word)
+        width = max(codes.shape[1], len(query))
+        padded_codes = numpy.zeros((len(codes), width), dtype=numpy.int64)
+        padded_codes[:, :codes.shape[1]] = codes
+        padded_query = numpy.zeros(width, dtype=numpy.int64)
+        padded_query[:len(query)] = query
+        shorter = numpy.minimum(lengths, len(query))
+        mismatches = ((padded_codes != padded_query) & (numpy.arange(width) < shorter[:, None])).sum(axis=1)
+        difference = numpy.abs(lengths - len(query))
+        return numpy.where(contained, difference, difference + mismatches)
+
+    @staticmethod
+    def many(word, candidates):
+        """
+        Calculates dist(candidate, word) for many candidates at once
+        :param word: the query word
+        :param candidates: list of words
+        :return: integer array with the distance of every candidate
+        """
+        def kernel(word, codes, lengths, chunk):
+            contained = numpy.fromiter((candidate in word or word in candidate for candidate in chunk),
+                                       dtype=bool, count=len(chunk))
+            return HammingDistance._kernel(word, codes, lengths, contained)
+
+        return CodePoints.batched(kernel, HammingDistance.dist, word, candidates)
+
+    @staticmethod
+    def signed(query, signatures, ids, name, max_dist=None):
+        """
+        Calculates dist(candidate, word) for words of an index from their Signatures
+        only words of a different length whose letters are a subset of the letters of the query word (or the other
+        way round) can contain it, so the substring check is only run on those
+        :param query: QuerySignature of the query word
+        :param signatures: Signatures of the index
+        :param ids: ids of the candidates in the index
+        :param name: function that returns the word of an id
+        :param max_dist: ignored, Hamming has no threshold variant
+        :return: integer array with the distance of every candidate
+        """
+        names = [name(i) for i in ids]
+        if len(names) < Config.min_batch_size:
+            return HammingDistance.many(query.word, names)
+        ids = numpy.asarray(ids)
+        word = query.word
+        lengths = signatures.lengths[ids].astype(numpy.int64)
+        letters = signatures.masks[ids, 0]
+        inside = (lengths < query.length) & ((letters & ~query.masks[0]) == 0)
+        around = (lengths > query.length) & ((query.masks[0] & ~letters) == 0)
+        if query.extra:
+            # letters outside of the alphabet can only be part of a word that is not exact
+            around &= signatures.exact[ids] == 0
+        contained = numpy.zeros(len(ids), dtype=bool)
+        for i in numpy.flatnonzero(inside).tolist():
+            contained[i] = names[i] in word
+        for i in numpy.flatnonzero(around).tolist():
+            contained[i] = word in names[i]
+        results = []
+        block = Config.batch_block_size
+        for start in range(0, len(names), block):
+            codes, _ = CodePoints.encode(names[start:start + block])
+            results.append(HammingDistance._kernel(word, codes, lengths[start:start + block],
+                                                   contained[start:start + block]))
+        return numpy.concatenate(results)
 
 
 class JaccardDistance:
+    # scaled similarities, there are no cheap lower bounds for them
+    lower_bounds = []
 
     @staticmethod
     def J(w1, w2):
@@ -109,118 +473,288 @@ class JaccardDistance:
         Jaccard Distance doesnt account for order of letters but merely for amount of shared letters
         between both words
         """
-        # for each word a list is generated containing all letters
-        set_A = [l for l in w1]
-        set_B = [l for l in w2]
-
-        # calculating the intersection of the two lists
-        temp = set(set_B)
-        intersection = [value for value in set_A if value in temp]
+        # the letters of word 2 and the letters of word 1 that also occur in it (counted with repetitions)
+        letters = set(w2)
+        intersection = len([letter for letter in w1 if letter in letters])
 
         # if the intersection is empty, return 0
-        if len(intersection) == 0:
+        if intersection == 0:
             return 0
 
-        # concatenate both lists
-        union = set(set_A + set_B)
-
         # jaccard distance is defined as 1 - J(A, B) where J(A, B) is the intersection divided by the union
         # of the two samples A and B, in our case the letters of word 1 and word 2
         # to make it more user friendly, the distance is multiplied by 1000
-        return int(1000 * round(len(intersection) / len(union), 3))
-
-
-class JaroWinklerDistance:
+        return int(1000 * round(intersection / len(letters.union(w1)), 3))
 
     @staticmethod
-    def jaro(s1, s2):
-        # If the s are equal
-        if s1 == s2:
-            return 1.0
+    def _scaled(intersection, union, factor):
+        """
+        applies the exact rounding of J() to every distinct (intersection, union) pair
+        :param factor: number larger than every union
+        """
+        return CodePoints.apply_exact(
+            intersection * factor + union,
+            lambda pair: 0 if pair // factor == 0 else int(1000 * round((pair // factor) / (pair % factor), 3)))
 
-        # Length of two s
-        len1 = len(s1)
-        len2 = len(s2)
+    @staticmethod
+    def many(word, candidates):
+        """
+        Calculates J(candidate, word) for many candidates at once
+        :param word: the query word
+        :param candidates: list of words
+        :return: integer array with the distance of every candidate
+        """
+        def kernel(word, codes, lengths, _):
+            query = numpy.unique(CodePoints.encode_word(word))
+            valid = numpy.arange(codes.shape[1]) < lengths[:, None]
+            # letters of the candidate that also occur in the word, counted with repetitions like in J()
+            shared = numpy.isin(codes, query) & valid
+            intersection = shared.sum(axis=1)
+            # distinct letters of each candidate: sorting the rows puts equal letters next to each other
+            order = numpy.argsort(numpy.where(valid, codes, -1), axis=1)
+            ordered = numpy.take_along_axis(codes, order, axis=1)
+            ordered_valid = numpy.take_along_axis(valid, order, axis=1)
+            first = ordered_valid.copy()
+            first[:, 1:] &= ordered[:, 1:] != ordered[:, :-1]
+            distinct = first.sum(axis=1)
+            distinct_shared = (first & numpy.isin(ordered, query)).sum(axis=1)
+            union = distinct + len(query) - distinct_shared
+            return JaccardDistance._scaled(intersection, union, codes.shape[1] + len(query) + 1)
+
+        return CodePoints.batched(kernel, JaccardDistance.J, word, candidates)
 
-        # Maximum distance upto which matching
-        # is allowed
-        max_dist = floor(max(len1, len2) / 2) - 1
+    @staticmethod
+    def signed(query, signatures, ids, name, max_dist=None):
+        """
+        Calculates J(candidate, word) for words of an index from their Signatures with popcounts:
+        the letters of a candidate that occur in the word, counted with repetitions, are the bits its layers share
+        with the letters of the word, the union is the bits of both first layers and the letters of the word
+        outside of the alphabet
+        :param query: QuerySignature of the query word
+        :param signatures: Signatures of the index
+        :param ids: ids of the candidates in the index
+        :param name: function that returns the word of an id, only needed for the words that are not exact
+        :param max_dist: ignored, Jaccard has no threshold variant
+        :return: integer array with the distance of every candidate
+        """
+        if len(ids) < Config.min_batch_size:
+            return numpy.array([JaccardDistance.J(name(i), query.word) for i in ids], dtype=numpy.int64)
+        ids = numpy.asarray(ids)
+        letters = query.masks[0]
+        masks = signatures.masks[ids]
+        intersection = Signatures.popcount(masks & letters).sum(axis=1)
+        union = Signatures.popcount(masks[:, 0] | letters) + query.extra
+        result = JaccardDistance._scaled(intersection, union, Signatures.size + query.extra + 1)
+        for i in numpy.flatnonzero(signatures.exact[ids] == 0).tolist():
+            result[i] = JaccardDistance.J(name(int(ids[i])), query.word)
+        return result
 
-        # Count of matches
-        match = 0
 
-        # Hash for matches
-        hash_s1 = [0] * len(s1)
-        hash_s2 = [0] * len(s2)
+class JaroWinklerDistance:
+    # the threshold variant of the kernel already stops early for words that are too far away
+    lower_bounds = []
+    # the similarity is scaled to distances from 0 to this value (Metric.value_range of "jar")
+    scale = 1000
 
-        # Traverse through the first word
-        for i in range(len1):
+    @staticmethod
+    def masks(word):
+        """
+        :return: dictionary with a bitmask of the positions of every letter of the word,
+        calculated once per query word and shared by all candidates
+        """
+        masks = {}
+        for j, letter in enumerate(word):
+            masks[letter] = masks.get(letter, 0) | (1 << j)
+        return masks
 
-            # Check if there is any matches
-            for j in range(max(0, i - max_dist),
-                           min(len2, i + max_dist + 1)):
+    @staticmethod
+    def score(match, t, len1, len2, prefix):
+        """
+        turns the counts of the matching into the integer distance, in exactly the steps of the original formula
+        :param match: number of matching letters
+        :param t: number of transpositions
+        :param prefix: length of the common prefix, at most 4
+        :return: distance between 0 and 1000
+        """
+        if match == 0:
+            jaro_dist = 0.0
+        else:
+            jaro_dist = (match / len1 + match / len2 + (match - t) / match) / 3.0
+        # If the jaro Similarity is above a threshold
+        if jaro_dist > 0.7:
+            jaro_dist += 0.1 * prefix * (1 - jaro_dist)
+        return int(JaroWinklerDistance.scale * (1 - round(jaro_dist, 4)))
 
-                # If there is a match
-                if s1[i] == s2[j] and hash_s2[j] == 0:
-                    hash_s1[i] = 1
-                    hash_s2[j] = 1
-                    match += 1
-                    break
+    @staticmethod
+    def _match(s1, s2, masks, misses_allowed):
+        """
+        greedy matching: every letter of s1 takes the first free equal letter of s2 within the matching window,
+        the free letters of s2 are a bitmask, so the window is searched with two shifts instead of a loop
+        :param masks: masks(s2)
+        :param misses_allowed: the matching stops once more letters of s1 found no partner
+        :return: tuple of the number of matches and the number of transpositions, None if it stopped early
+        """
+        window = max(len(s1), len(s2)) // 2 - 1
+        # positions of s2 that are taken
+        used = 0
+        matched = []
+        misses = 0
+        for i, letter in enumerate(s1):
+            free = masks.get(letter, 0) & ~used
+            if free:
+                # clearing the positions below and above the window
+                low = i - window
+                if low > 0:
+                    free = free >> low << low
+                free &= (1 << (i + window + 1)) - 1
+                if free:
+                    # the lowest bit is the first free position
+                    used |= free & -free
+                    matched.append(letter)
+                    continue
+            misses += 1
+            if misses > misses_allowed:
+                return None
+        # transpositions: the k-th matched letter of s1 is compared with the k-th matched letter of s2
+        t = 0
+        for letter in matched:
+            position = used & -used
+            if s2[position.bit_length() - 1] != letter:
+                t += 1
+            used ^= position
+        return len(matched), t // 2
 
+    @staticmethod
+    def jaro(s1, s2):
+        # If the s are equal
+        if s1 == s2:
+            return 1.0
+        match, t = JaroWinklerDistance._match(s1, s2, JaroWinklerDistance.masks(s2), len(s1))
         # If there is no match
         if match == 0:
             return 0.0
-
-        # Number of transpositions
-        t = 0
-        point = 0
-
-        # Count number of occurrences
-        # where two characters match but
-        # there is a third matched character
-        # in between the indices
-        for i in range(len1):
-            if hash_s1[i]:
-
-                # Find the next matched character
-                # in second
-                while hash_s2[point] == 0:
-                    point += 1
-
-                if s1[i] != s2[point]:
-                    t += 1
-                point += 1
-        t = t // 2
-
         # Return the Jaro Similarity
-        return (match / len1 + match / len2 +
+        return (match / len(s1) + match / len(s2) +
                 (match - t) / match) / 3.0
 
     @staticmethod
-    def jaro_Winkler(s1, s2):
-
-        jaro_dist = JaroWinklerDistance.jaro(s1, s2)
-
-        # If the jaro Similarity is above a threshold
-        if jaro_dist > 0.7:
-
-            # Find the length of common prefix
-            prefix = 0
-
-            for i in range(min(len(s1), len(s2))):
-
-                # If the characters match
-                if s1[i] == s2[i]:
-                    prefix += 1
-
-                # Else break
-                else:
-                    break
-
-            # Maximum of 4 characters are allowed in prefix
-            prefix = min(4, prefix)
-
-            # Calculate jaro winkler Similarity
-            jaro_dist += 0.1 * prefix * (1 - jaro_dist)
+    def jaro_Winkler(s1, s2, max_dist=None, masks=None):
+        """
+        :param max_dist: optional upper bound: as soon as the letters that found no partner show that the distance
+        exceeds it, the calculation stops and max_dist + 1 is returned
+        :param masks: masks(s2), if it was already calculated for another pair
+        :return: Jaro-Winkler distance between 0 and 1000
+        """
+        if s1 == s2:
+            return 0
+        len1, len2 = len(s1), len(s2)
+
+        # length of the common prefix, maximum of 4 characters are allowed
+        prefix = 0
+        for a, b in zip(s1, s2):
+            if a != b or prefix == 4:
+                break
+            prefix += 1
+
+        misses_allowed = len1
+        # every distance lies within 0..scale, so larger bounds cannot stop anything
+        if max_dist is not None and max_dist >= JaroWinklerDistance.scale:
+            max_dist = None
+        if max_dist is not None:
+            # the best case: every letter of the shorter word matches without transpositions
+            shorter = min(len1, len2)
+            if JaroWinklerDistance.score(shorter, 0, len1, len2, prefix) > max_dist:
+                return max_dist + 1
+            # fewest matches that could still be within max_dist, the similarity grows linearly with the matches,
+            # so the estimate is at most one off and corrected by counting up
+            similarity = 1 - (max_dist + 1) / JaroWinklerDistance.scale
+            # the prefix only raises similarities above 0.7
+            needed = (similarity - 0.1 * prefix) / (1 - 0.1 * prefix)
+            if needed <= 0.7:
+                needed = min(similarity, 0.7)
+            least = max(0, int((3 * needed - 1) / (1 / len1 + 1 / len2)) - 1)
+            while least < shorter and JaroWinklerDistance.score(least, 0, len1, len2, prefix) > max_dist:
+                least += 1
+            misses_allowed = len1 - least
+
+        result = JaroWinklerDistance._match(s1, s2, masks or JaroWinklerDistance.masks(s2), misses_allowed)
+        if result is None:
+            return max_dist + 1
+        distance = JaroWinklerDistance.score(result[0], result[1], len1, len2, prefix)
+        if max_dist is not None and distance > max_dist:
+            return max_dist + 1
+        return distance
 
-        return int(1000 * (1 - round(jaro_dist, 4)))
+    @staticmethod
+    def many(word, candidates, max_dist=None):
+        """
+        Calculates jaro_Winkler(candidate, word) for many candidates at once
+        the matching, transposition and prefix steps of the scalar version are done column by column
+        for all candidates together
+        :param word: the query word
+        :param candidates: list of words
+        :param max_dist: optional upper bound, like in jaro_Winkler(), or a list with a separate bound for every
+        candidate
+        :return: integer array with the distance of every candidate
+        """
+        if max_dist is not None:
+            bounds = max_dist if isinstance(max_dist, list) else [max_dist] * len(candidates)
+            if len(candidates) < Config.min_batch_size:
+                masks = JaroWinklerDistance.masks(word)
+                return numpy.array([JaroWinklerDistance.jaro_Winkler(candidate, word, bound, masks)
+                                    for candidate, bound in zip(candidates, bounds)], dtype=numpy.int64)
+            # the batch kernel has nothing to stop early, the results are only capped like in the scalar version
+            return numpy.minimum(JaroWinklerDistance.many(word, candidates),
+                                 numpy.array(bounds, dtype=numpy.int64) + 1)
+
+        def kernel(word, codes, lengths, chunk):
+            query = CodePoints.encode_word(word)
+            rows = len(codes)
+            len2 = len(query)
+            max_dist = numpy.maximum(lengths, len2) // 2 - 1
+
+            # greedy matching: every letter of the candidate takes the first free equal letter of the word
+            # that lies within the matching window
+            hash_s1 = numpy.zeros(codes.shape, dtype=bool)
+            hash_s2 = numpy.zeros((rows, len2), dtype=bool)
+            for i in range(codes.shape[1]):
+                found = i >= lengths
+                for j in range(max(0, i - int(max_dist.max())), len2):
+                    match = ~found & (codes[:, i] == query[j]) & ~hash_s2[:, j] & (abs(i - j) <= max_dist)
+                    hash_s2[:, j] |= match
+                    hash_s1[:, i] |= match
+                    found |= match
+            match = hash_s1.sum(axis=1)
+
+            # transpositions: the k-th matched letter of the candidate is compared with the k-th of the word
+            width = max(codes.shape[1], len2)
+            matched_1 = numpy.zeros((rows, width), dtype=numpy.int64)
+            matched_1[:, :codes.shape[1]] = numpy.take_along_axis(
+                codes, numpy.argsort(~hash_s1, axis=1, kind="stable"), axis=1)
+            matched_2 = numpy.zeros((rows, width), dtype=numpy.int64)
+            matched_2[:, :len2] = query[numpy.argsort(~hash_s2, axis=1, kind="stable")]
+            t = ((matched_1 != matched_2) & (numpy.arange(width) < match[:, None])).sum(axis=1) // 2
+
+            # Jaro similarity, evaluated in the same order as in jaro()
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                jaro_dist = (match / lengths + match / len2 + (match - t) / match) / 3.0
+            jaro_dist = numpy.where(match == 0, 0.0, jaro_dist)
+            # equal words are similar by definition, even when they are too short for the matching window
+            equal = numpy.fromiter((candidate == word for candidate in chunk), dtype=bool, count=rows)
+            jaro_dist = numpy.where(equal, 1.0, jaro_dist)
+
+            # common prefix of at most 4 letters
+            prefix = numpy.zeros(rows, dtype=numpy.int64)
+            still_equal = numpy.ones(rows, dtype=bool)
+            for i in range(min(4, codes.shape[1], len2)):
+                still_equal &= (codes[:, i] == query[i]) & (i < lengths)
+                prefix += still_equal
+            jaro_dist = numpy.where(jaro_dist > 0.7, jaro_dist + 0.1 * prefix * (1 - jaro_dist), jaro_dist)
+
+            scale = JaroWinklerDistance.scale
+            return CodePoints.apply_exact(jaro_dist, lambda value: int(scale * (1 - round(value, 4))))
+
+        masks = JaroWinklerDistance.masks(word)
+        return CodePoints.batched(kernel, lambda candidate, _: JaroWinklerDistance.jaro_Winkler(candidate, word,
+                                                                                                 masks=masks),
+                                  word, candidates)
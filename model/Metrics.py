@@ -0,0 +1,132 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+import json
+import os
+
+
+class Metrics:
+    """
+    Collects numbers about building and querying: counters (e.g. distance calls per metric, nodes visited),
+    histograms (e.g. query latencies), gauges (e.g. build throughput) and the time spent in each phase of the build
+    everything is a plain dictionary update, so the metrics can stay switched on
+    callbacks registered with subscribe() are called with (kind, name, value) for every update,
+    snapshot() returns everything as a dictionary and dump() writes it to a JSON file
+    """
+
+    # upper bounds of the histogram buckets (for latencies in milliseconds), the last bucket takes everything above
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        # name -> seconds
+        self.phases = {}
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        """
+        :param callback: function(kind, name, value), kind is "count", "observe", "gauge" or "phase"
+        :return: the callback, so that it can be unsubscribed later
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def _emit(self, kind, name, value):
+        for callback in self._callbacks:
+            callback(kind, name, value)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self._callbacks:
+            self._emit("count", name, n)
+
+    def observe(self, name, value):
+        """ adds a value to a histogram """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                                 "buckets": [0] * (len(self.buckets) + 1)}
+        histogram["count"] += 1
+        histogram["sum"] += value
+        if value > histogram["max"]:
+            histogram["max"] = value
+        histogram["buckets"][bisect_left(self.buckets, value)] += 1
+        if self._callbacks:
+            self._emit("observe", name, value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        if self._callbacks:
+            self._emit("gauge", name, value)
+
+    @contextmanager
+    def phase(self, name):
+        """ measures the time spent in a with block, repeated phases add up """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            if self._callbacks:
+                self._emit("phase", name, elapsed)
+
+    def snapshot(self):
+        """
+        :return: all metrics as a dictionary that can be turned into JSON,
+        histograms come with their bucket bounds and the mean of their values
+        """
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            histograms[name] = {**histogram, "buckets": list(histogram["buckets"]),
+                                "mean": histogram["sum"] / histogram["count"], "bounds": list(self.buckets)}
+        return {"counters": dict(self.counters), "histograms": histograms, "gauges": dict(self.gauges),
+                "phases": dict(self.phases)}
+
+    def take(self):
+        """ returns a snapshot and starts from zero again, used to send the metrics of a worker process """
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """ adds a snapshot, e.g. from a worker process, to these metrics """
+        for name, value in snapshot["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, other in snapshot["histograms"].items():
+            histogram = self.histograms.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0,
+                                                          "buckets": [0] * (len(self.buckets) + 1)})
+            histogram["count"] += other["count"]
+            histogram["sum"] += other["sum"]
+            histogram["max"] = max(histogram["max"], other["max"])
+            histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+        self.gauges.update(snapshot["gauges"])
+        for name, value in snapshot["phases"].items():
+            self.phases[name] = self.phases.get(name, 0.0) + value
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.phases = {}
+
+    def dump(self, path):
+        """ writes the snapshot to a JSON file """
+        with open(f"{path}.tmp", "w", encoding="UTF-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+
+# the metrics BKTree, View and the Controller report to unless they are given their own
+metrics = Metrics()
@@ -0,0 +1,484 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+import ast
+import io
+import mmap
+import numpy
+import os
+import struct
+import sys
+from model.Distances import Signatures
+
+
+class IndexFormat:
+    """
+    Layout of the binary index file written by NodeStore.save()
+    header: magic, format version, byte order, metric (8 bytes, ascii), number of nodes, size of the name blob
+    followed by the arrays of a frozen NodeStore, each one starting at a multiple of 8 bytes:
+    name_offsets (int64, n + 1), parents, weights, child_offsets (int32, n + 1), child_ids, child_weights
+    (int32, n - 1), since version 2 the deletion flags (uint8, n), since version 3 the signatures of the words
+    (see Signatures.arrays), and the utf-8 name blob
+    """
+    magic = b"BKIX"
+    version = 3
+    header = struct.Struct("<4sIc8sQQ")
+    # (attribute, typecode, length as a function of the number of nodes, first format version that has it)
+    arrays = [("name_offsets", "q", lambda n: n + 1, 1),
+              ("parents", "i", lambda n: n, 1),
+              ("weights", "i", lambda n: n, 1),
+              ("child_offsets", "i", lambda n: n + 1, 1),
+              ("child_ids", "i", lambda n: max(n - 1, 0), 1),
+              ("child_weights", "i", lambda n: max(n - 1, 0), 1),
+              ("deleted", "B", lambda n: n, 2)]
+
+    @staticmethod
+    def padding(size):
+        return -size % 8
+
+
+class NodeStore:
+    """
+    Compact struct-of-arrays storage for a BK-tree
+    every node is identified by an integer id (the root has id 0) and
+    parents, weights and names are kept in flat arrays instead of one object per word
+    while the tree is being built, children are found through a hash index keyed by (parent, weight);
+    freeze() then packs them into an offset table sorted by weight and drops the build-only data,
+    thaw() turns a frozen store back into a growable one
+    deleted words stay in the tree as routing nodes, they are only flagged in the deleted array
+    """
+
+    def __init__(self):
+        self.parents = array("i")
+        self.weights = array("i")
+        self.deleted = bytearray()
+        # build phase: plain list of names and the (parent, weight) -> child index
+        self._names = []
+        self._child_index = {}
+        # frozen phase: utf-8 name blob with offsets and a CSR style children table,
+        # child_weights holds the weight of every entry of child_ids so that ranges can be bisected
+        self.blob = b""
+        self.name_offsets = None
+        self.child_offsets = None
+        self.child_ids = None
+        self.child_weights = None
+        self.frozen = False
+        # signatures of the words for the Jaccard and Hamming kernels, see signatures()
+        self._signatures = None
+        # set when the store is a memory map of an index file
+        self.path = None
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add_node(self, name: str, parent: int, weight: int) -> int:
+        """
+        appends a node to the store
+        :param name: the word of the node
+        :param parent: id of the parent node, -1 for the root
+        :param weight: distance to the parent (will be shown on the edge)
+        :return: id of the new node
+        """
+        assert not self.frozen, "cannot add nodes to a frozen store"
+        node_id = len(self.parents)
+        self._names.append(name)
+        self.parents.append(parent)
+        self.weights.append(weight)
+        self.deleted.append(0)
+        if parent >= 0:
+            self._child_index[self._key(parent, weight)] = node_id
+        return node_id
+
+    def graft(self, names, parents, weights, parent: int, weight: int):
+        """
+        appends a subtree that was built in a separate store below one of the nodes of this store
+        :param names: names of the subtree nodes, node 0 being the subtree root
+        :param parents: parent ids within the subtree
+        :param weights: weights within the subtree
+        :param parent: id of the node in this store the subtree root is attached to
+        :param weight: weight of the edge between parent and subtree root
+        """
+        offset = len(self.parents)
+        self.add_node(name=names[0], parent=parent, weight=weight)
+        for i in range(1, len(names)):
+            self.add_node(name=names[i], parent=parents[i] + offset, weight=weights[i])
+
+    def names(self):
+        """ returns the names of all nodes in order of their id """
+        return [self.name(i) for i in range(len(self.parents))]
+
+    def signatures(self):
+        """
+        returns the Signatures of the words in order of their id, they are calculated when they are first needed
+        (or the store is saved) and then kept, words that are added later are appended in the same alphabet
+        """
+        if self._signatures is None:
+            self._signatures = Signatures.build(self.names())
+        elif len(self._signatures) < len(self.parents):
+            added = [self.name(i) for i in range(len(self._signatures), len(self.parents))]
+            self._signatures = self._signatures.extend(added)
+        return self._signatures
+
+    @staticmethod
+    def _key(parent: int, weight: int) -> int:
+        # a single int is a lot cheaper to hash and store than a tuple
+        return (parent << 32) | weight
+
+    def name(self, node_id: int) -> str:
+        if not self.frozen:
+            return self._names[node_id]
+        offsets = self.name_offsets
+        return str(self.blob[offsets[node_id]:offsets[node_id + 1]], "UTF-8")
+
+    def children(self, node_id: int):
+        """
+        returns the ids of the children of a node, ordered by weight once the store is frozen
+        while building this needs a scan over all nodes, so it is only meant for inspection
+        """
+        if not self.frozen:
+            return [i for i in range(1, len(self.parents)) if self.parents[i] == node_id]
+        return self.child_ids[self.child_offsets[node_id]:self.child_offsets[node_id + 1]]
+
+    def child_count(self, node_id: int) -> int:
+        if not self.frozen:
+            return len(self.children(node_id))
+        return self.child_offsets[node_id + 1] - self.child_offsets[node_id]
+
+    def child_with_weight(self, node_id: int, weight: int):
+        """
+        :return: id of the child that is connected to the node by an edge of the given weight, None if there is none
+        """
+        if not self.frozen:
+            return self._child_index.get(self._key(node_id, weight))
+        start, end = self.child_offsets[node_id], self.child_offsets[node_id + 1]
+        position = bisect_left(self.child_weights, weight, start, end)
+        if position < end and self.child_weights[position] == weight:
+            return self.child_ids[position]
+        return None
+
+    def max_child_weight(self, node_id: int) -> int:
+        """ returns the largest weight among the children of a node, 0 if it has none """
+        if not self.frozen:
+            self.freeze()
+        start, end = self.child_offsets[node_id], self.child_offsets[node_id + 1]
+        return self.child_weights[end - 1] if end > start else 0
+
+    def children_in_range(self, node_id: int, low: int, high: int):
+        """
+        returns the ids of all children whose weight lies in [low, high],
+        the children of a frozen store are sorted by weight so the range is found by bisection,
+        a store that was changed since it was last frozen is frozen again first
+        """
+        if not self.frozen:
+            self.freeze()
+        start, end = self.child_offsets[node_id], self.child_offsets[node_id + 1]
+        first = bisect_left(self.child_weights, low, start, end)
+        last = bisect_right(self.child_weights, high, first, end)
+        return self.child_ids[first:last]
+
+    def freeze(self):
+        """
+        packs the names into one blob and the children into an offset table,
+        afterwards the per node lists used while building are released
+        """
+        if self.frozen:
+            return
+        n = len(self.parents)
+
+        # names: one utf-8 blob, node i spans blob[name_offsets[i]:name_offsets[i + 1]]
+        encoded = [name.encode("UTF-8") for name in self._names]
+        offsets = array("q", [0]) * (n + 1)
+        position = 0
+        for i in range(n):
+            position += len(encoded[i])
+            offsets[i + 1] = position
+        self.blob = b"".join(encoded)
+        self.name_offsets = offsets
+
+        # children: counting sort over the parent array, visiting the nodes in order of their weight
+        # so that the children of node i, child_ids[child_offsets[i]:child_offsets[i + 1]], end up sorted by weight
+        child_offsets = array("i", [0]) * (n + 1)
+        for i in range(1, n):
+            child_offsets[self.parents[i] + 1] += 1
+        for i in range(n):
+            child_offsets[i + 1] += child_offsets[i]
+        child_ids = array("i", [0]) * max(n - 1, 0)
+        child_weights = array("i", [0]) * max(n - 1, 0)
+        fill = array("i", child_offsets[:n])
+        for i in sorted(range(1, n), key=self.weights.__getitem__):
+            parent = self.parents[i]
+            child_ids[fill[parent]] = i
+            child_weights[fill[parent]] = self.weights[i]
+            fill[parent] += 1
+        self.child_offsets = child_offsets
+        self.child_ids = child_ids
+        self.child_weights = child_weights
+
+        self._names = []
+        self._child_index = {}
+        self.frozen = True
+
+    def verify(self) -> bool:
+        """
+        checks that no node has two children with the same weight, which the searches rely on,
+        this reads the whole children table, so it is only done when asked for
+        :return: True if the store holds a correct BK-tree
+        """
+        self.freeze()
+        weights = numpy.asarray(self.child_weights)
+        starts = numpy.asarray(self.child_offsets)[:-1]
+        repeated = numpy.zeros(len(weights), dtype=bool)
+        repeated[1:] = weights[1:] == weights[:-1]
+        # the first child of a node is compared with the last child of the node before it
+        repeated[starts[starts < len(weights)]] = False
+        return not repeated.any()
+
+    def thaw(self):
+        """
+        turns a frozen store (also one that is mapped from an index file) back into a growable one,
+        the names are unpacked and the (parent, weight) index is rebuilt from the flat arrays
+        """
+        if not self.frozen:
+            return
+        self._names = self.names()
+        self.parents = array("i", self.parents)
+        self.weights = array("i", self.weights)
+        self.deleted = bytearray(self.deleted)
+        self._child_index = {self._key(self.parents[i], self.weights[i]): i for i in range(1, len(self.parents))}
+        self.blob = b""
+        self.name_offsets = None
+        self.child_offsets = None
+        self.child_ids = None
+        self.child_weights = None
+        self.path = None
+        self._mmap = None
+        self.frozen = False
+
+    def save(self, path, metric):
+        """
+        writes the frozen store to a binary index file (see IndexFormat)
+        :param path: path of the index file
+        :param metric: name of the distance metric the tree was built with
+        """
+        self.freeze()
+        n = len(self.parents)
+        signatures = self.signatures()
+        # the file is written next to the old one and then swapped in,
+        # so processes that still have the old index mapped are not affected
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as f:
+            header = IndexFormat.header.pack(IndexFormat.magic, IndexFormat.version, sys.byteorder[0].encode(),
+                                             metric.encode("ascii")[:8], n, len(self.blob))
+            f.write(header + b"\0" * IndexFormat.padding(len(header)))
+            for attribute, typecode, _, _ in IndexFormat.arrays:
+                data = array(typecode, getattr(self, attribute)).tobytes()
+                f.write(data + b"\0" * IndexFormat.padding(len(data)))
+            for data in signatures.to_arrays():
+                data = data.tobytes()
+                f.write(data + b"\0" * IndexFormat.padding(len(data)))
+            f.write(self.blob)
+        os.replace(temporary, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        opens a binary index file written by save() without reading it:
+        the arrays are views on a read-only memory map, so the operating system only loads the pages
+        a query touches, and processes that open the same file share those pages
+        :param path: path of the index file
+        :return: tuple of the frozen store and the name of the metric
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        size = IndexFormat.header.size
+        if len(view) < size:
+            raise ValueError(f"{path} is not a BK-tree index")
+        magic, version, byteorder, metric, n, blob_size = IndexFormat.header.unpack(view[:size])
+        if magic != IndexFormat.magic:
+            raise ValueError(f"{path} is not a BK-tree index")
+        if not 1 <= version <= IndexFormat.version:
+            raise ValueError(f"{path} has index format version {version}, expected {IndexFormat.version}")
+        if byteorder != sys.byteorder[0].encode():
+            raise ValueError(f"{path} was written on a machine with a different byte order")
+
+        store = cls()
+        position = size + IndexFormat.padding(size)
+        for attribute, typecode, length, since in IndexFormat.arrays:
+            # older files simply lack the arrays that were added later
+            if version < since:
+                setattr(store, attribute, memoryview(bytes(length(n) * array(typecode).itemsize)).cast(typecode))
+                continue
+            end = position + length(n) * array(typecode).itemsize
+            if end > len(view):
+                raise ValueError(f"{path} is truncated")
+            setattr(store, attribute, view[position:end].cast(typecode))
+            position = end + IndexFormat.padding(end)
+        # older files have no signatures, they are calculated from the names when they are needed
+        if version >= 3:
+            try:
+                store._signatures, position = Signatures.from_buffer(mapped, position, n)
+            except ValueError:
+                raise ValueError(f"{path} is truncated")
+        if position + blob_size != len(view):
+            raise ValueError(f"{path} is truncated")
+        store.blob = view[position:]
+        store.frozen = True
+        store.path = path
+        store._mmap = mapped
+        return store, metric.rstrip(b"\0").decode("ascii")
+
+    def __reduce_ex__(self, protocol):
+        # a store backed by an index file is passed to other processes as its path, they map the same pages
+        if self.path is not None:
+            return _open_store, (self.path,)
+        return super().__reduce_ex__(protocol)
+
+    def depths(self):
+        """
+        calculates the depth of every node in a single pass,
+        parents always have a lower id than their children
+        """
+        depths = array("i", [0]) * len(self.parents)
+        for i in range(1, len(self.parents)):
+            depths[i] = depths[self.parents[i]] + 1
+        return depths
+
+    def node(self, node_id: int = 0):
+        return Node(self, node_id)
+
+    def write_text(self, f, root: int = 0, level: int = 0):
+        """
+        writes the tree below a node to a text file, one line per node in preorder:
+        the depth of the node as tabs, then repr((weight, name)) and " deleted" for deleted words, e.g.
+        (0, 'hase')
+        \t(1, 'hose')
+        \t\t(2, 'nase')
+        \t(2, 'haus')
+        the children of a node follow it ordered by weight, so read_text() can rebuild the tree from the lines alone
+        the lines are written while walking the tree, nothing but the stack of the walk is kept in memory
+        :param f: file opened for writing text
+        :param root: id of the node the text starts at
+        :param level: depth the root is written at
+        :return: number of lines written
+        """
+        if not self.frozen:
+            self.freeze()
+        weights, deleted = self.weights, self.deleted
+        count = 0
+        stack = [(root, level)]
+        while stack:
+            node, depth = stack.pop()
+            line = "\t" * depth + repr((weights[node], self.name(node)))
+            f.write(line + " deleted\n" if deleted[node] else line + "\n")
+            count += 1
+            # pushed in reverse, so the children come out ordered by weight
+            stack.extend((child, depth + 1) for child in reversed(self.children(node)))
+        return count
+
+    @classmethod
+    def read_text(cls, f):
+        """
+        rebuilds a tree from the lines written by write_text() without calculating any distance,
+        the parent of every line is the last line before it that is one level higher
+        :param f: file opened for reading text (any iterable of lines)
+        :return: frozen NodeStore
+        """
+        store = cls()
+        # ids of the last node seen at each depth
+        path = []
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            depth = len(line) - len(line.lstrip("\t"))
+            line = line[depth:]
+            deleted = line.endswith(" deleted")
+            if deleted:
+                line = line[:-len(" deleted")]
+            comma = line.index(", ")
+            weight = int(line[1:comma])
+            name = line[comma + 2:-1]
+            # words are letters only, so repr just put them in quotes, anything else is decoded properly
+            if name[0] == name[-1] == "'" and "\\" not in name and "'" not in name[1:-1]:
+                name = name[1:-1]
+            else:
+                name = ast.literal_eval(name)
+            assert depth <= len(path) and (depth > 0 or not path), f"line '{line}' has no parent"
+            del path[depth:]
+            node = store.add_node(name=name, parent=path[-1] if path else -1, weight=weight if path else 0)
+            if deleted:
+                store.deleted[node] = 1
+            path.append(node)
+        assert len(store) > 0, "the text contains no tree"
+        store.freeze()
+        return store
+
+
+def _open_store(path):
+    return NodeStore.open(path)[0]
+
+
+class Node:
+    """
+    Light-weight view on a single node of a NodeStore
+    offers the attributes the searches walk the tree with (name, weight, children, is_leaf),
+    without keeping an object per node
+    """
+    __slots__ = ("store", "id")
+
+    def __init__(self, store: NodeStore, node_id: int):
+        self.store = store
+        self.id = node_id
+
+    @property
+    def name(self) -> str:
+        return self.store.name(self.id)
+
+    @property
+    def weight(self) -> int:
+        return self.store.weights[self.id]
+
+    @property
+    def children(self):
+        store = self.store
+        return [Node(store, child) for child in store.children(self.id)]
+
+    @property
+    def is_leaf(self) -> bool:
+        return self.store.child_count(self.id) == 0
+
+    @property
+    def child_count(self) -> int:
+        return self.store.child_count(self.id)
+
+    @property
+    def deleted(self) -> bool:
+        return bool(self.store.deleted[self.id])
+
+    @property
+    def max_child_weight(self) -> int:
+        return self.store.max_child_weight(self.id)
+
+    def children_in_range(self, low, high):
+        """ returns the children whose weight lies in [low, high] """
+        store = self.store
+        return [Node(store, child) for child in store.children_in_range(self.id, low, high)]
+
+    def __str__(self, level=0):
+        """
+        Magic function to print the tree in string format, see NodeStore.write_text
+        to save large trees, write_text should be used directly, since this builds the whole text in memory
+        :param level: basically the depth of a node (distance to root)
+        :return:
+        tree in string format
+        """
+        text = io.StringIO()
+        self.store.write_text(text, root=self.id, level=level)
+        return text.getvalue()
@@ -0,0 +1,477 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Auxillary import Methods, Config
+from model.BKTree import chunk_distances
+from model.Distances import Signatures
+from model.Metrics import metrics as default_metrics
+from model.Registry import registry
+from multiprocessing import Pool
+from bisect import insort
+import io
+import mmap
+import numpy
+import os
+import struct
+import sys
+
+
+class PivotFormat:
+    """
+    Layout of the binary index file written by PivotTable.save()
+    header: magic, format version, byte order, metric (8 bytes, ascii), number of words, size of the name blob,
+    number of pivots
+    followed by the arrays, each one starting at a multiple of 8 bytes:
+    name_offsets (int64, n + 1), pivots (int32, p), table (int32, n * p), deleted (uint8, n),
+    since version 2 the signatures of the words (see Signatures.arrays), and the utf-8 name blob
+    """
+    magic = b"PTIX"
+    version = 2
+    header = struct.Struct("<4sIc8sQQI")
+    # (attribute, dtype, length as a function of the number of words and pivots)
+    arrays = [("name_offsets", numpy.int64, lambda n, p: n + 1),
+              ("pivots", numpy.int32, lambda n, p: p),
+              ("table", numpy.int32, lambda n, p: n * p),
+              ("deleted", numpy.uint8, lambda n, p: n)]
+
+    @staticmethod
+    def padding(size):
+        return -size % 8
+
+
+class PivotTable:
+    """
+    LAESA style index: instead of a tree, the distance of every word to a few pivot words is stored in a table
+    a word w can only be within d of a query q if |dist(w, p) - dist(q, p)| <= d for every pivot p,
+    so a query calculates its distance to the pivots and then only the words that pass this check
+    for all pivots at once (a vectorized pass over the table)
+    that check relies on the triangle inequality, so it is only made for true metrics (Metric.true_metric):
+    a table of another metric gets no pivots and works like a Scan
+    offers the same interface as BKTree: tree (the object View searches), length, renderer(), get_graph(),
+    statistics(), save(), insert(), delete() and compact()
+    """
+
+    # name of the engine (see Metric.engine and the --engine option)
+    engine = "pivot"
+
+    def __init__(self, word_list, edit_dist, workers=None, cleaned=False, metrics=None):
+        # phase timings and the distances to the pivots are reported here, like in BKTree
+        # (only while building, so that the table does not take the metrics along when it is pickled)
+        metrics = metrics or default_metrics
+        self.edit_dist = edit_dist
+        self.metric = registry.get(edit_dist)
+        self.workers = workers or Methods.thread_count()
+        # a list that went through Methods.clean_list already (like the one of the Controller) is only copied
+        if cleaned:
+            self._names = list(word_list)
+        else:
+            with metrics.phase("clean"):
+                self._names = Methods.clean_list(word_list)
+        self.length = len(self._names)
+        self.deleted = numpy.zeros(self.length, dtype=numpy.uint8)
+        self.path = None
+        self._mmap = None
+        self._ids = None
+        # signatures of the words, metrics that compare them also use them for the columns of the table
+        self._signatures = None
+        if self.metric.signed is not None:
+            with metrics.phase("signatures"):
+                self._signatures = Signatures.build(self._names)
+        count = self._pivot_count()
+        if count:
+            print(f"Choosing {count} pivots...")
+        with metrics.phase("pivots"):
+            self.pivots, self.table = self._choose_pivots(count)
+        metrics.count(f"distance.{self.metric.name}", len(self.pivots) * self.length)
+        if count:
+            print("Done.")
+        self.tree = self
+
+    def _pivot_count(self):
+        """
+        :return: number of pivots of a new table, 0 for metrics that break the triangle inequality,
+        since their pivots could rule out matches
+        """
+        return min(Config.pivot_table_size, self.length) if self.metric.true_metric else 0
+
+    @property
+    def prunes(self):
+        """ True if queries rule out words with the pivots, which needs pivots and a true metric """
+        return len(self.pivots) > 0 and self.metric.true_metric
+
+    def _choose_pivots(self, count):
+        """
+        farthest first: the first pivot is the first word, every further pivot is the word
+        that is farthest from the pivots chosen so far, so that the pivots look at the list from different sides
+        the distances to a new pivot are the next column of the table
+        :param count: number of pivots
+        :return: tuple of the pivot ids and the table (one row per word, one column per pivot)
+        """
+        words = self._names
+        if count == 0:
+            return numpy.zeros(0, dtype=numpy.int32), numpy.zeros((len(words), 0), dtype=numpy.int32)
+        chunks = Methods.chunkify(words, self.workers)
+        columns = []
+        pivots = [0]
+        closest = numpy.full(len(words), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        parallel = self.workers > 1 and len(chunks) > 1 and self._signatures is None
+        pool = Pool(min(self.workers, len(chunks))) if parallel else None
+        try:
+            while True:
+                pivot = words[pivots[-1]]
+                if self._signatures is not None:
+                    # comparing signatures is cheaper than sending the words to other processes
+                    column = self._distances(pivot, numpy.arange(len(words)))
+                elif pool is not None:
+                    column = numpy.concatenate(pool.map(chunk_distances, [(pivot, chunk, self.edit_dist)
+                                                                          for chunk in chunks], chunksize=1))
+                else:
+                    column = self.metric.many(pivot, words)
+                columns.append(column)
+                if len(pivots) == count:
+                    break
+                closest = numpy.minimum(closest, column)
+                closest[pivots] = -1
+                pivots.append(int(numpy.argmax(closest)))
+        finally:
+            if pool is not None:
+                pool.close()
+        table = numpy.stack(columns, axis=1).astype(numpy.int32) if columns else numpy.zeros((0, 0), numpy.int32)
+        return numpy.array(pivots, dtype=numpy.int32), table
+
+    def __len__(self):
+        return len(self.deleted)
+
+    def name(self, word_id: int) -> str:
+        if self._names is not None:
+            return self._names[word_id]
+        offsets = self.name_offsets
+        return str(self.blob[offsets[word_id]:offsets[word_id + 1]], "UTF-8")
+
+    def names(self):
+        """ returns the words that were not deleted, in order of their id """
+        return [self.name(i) for i in numpy.flatnonzero(self.deleted == 0)]
+
+    def signatures(self):
+        """
+        returns the Signatures of the words in order of their id, like NodeStore.signatures()
+        """
+        if self._signatures is None:
+            self._signatures = Signatures.build([self.name(i) for i in range(len(self))])
+        elif len(self._signatures) < len(self):
+            self._signatures = self._signatures.extend([self.name(i) for i in range(len(self._signatures), len(self))])
+        return self._signatures
+
+    def _query(self, word):
+        """ :return: the word encoded for the signatures, None if the metric does not compare signatures """
+        if self.metric.signed is None:
+            return None
+        return self.signatures().query(word)
+
+    def _distances(self, word, ids, query=None):
+        """
+        :param ids: ids of the words the distance is calculated to
+        :param query: the word encoded by _query(), so that a query that calls this more than once encodes it once
+        :return: integer array with the distance of every word
+        """
+        if self.metric.signed is None:
+            return self.metric.many(word, [self.name(i) for i in ids])
+        return self.metric.signed(query or self._query(word), self.signatures(), ids, self.name)
+
+    def _lower_bounds(self, word):
+        """
+        :return: for every word of the table a lower bound of its distance to the given word,
+        0 for all of them if the table does not prune (also for tables saved with pivots for another metric)
+        """
+        if not self.prunes:
+            return numpy.zeros(len(self), dtype=numpy.int64)
+        query = self.metric.many(word, [self.name(p) for p in self.pivots])
+        return numpy.abs(self.table.astype(numpy.int64) - query).max(axis=1)
+
+    def candidate_ids(self, word, d):
+        """
+        :return: array with the ids of the words that can be within d of the given word according to the pivots
+        """
+        return numpy.flatnonzero((self._lower_bounds(word) <= d) & (self.deleted == 0))
+
+    def candidates(self, word, d):
+        """
+        :return: the words that can be within d of the given word according to the pivots
+        """
+        return [self.name(i) for i in self.candidate_ids(word, d)]
+
+    def matches(self, word, d):
+        """
+        :return: dictionary of all words within d of the given word and their distance
+        """
+        ids = self.candidate_ids(word, d)
+        distances = self._distances(word, ids).tolist()
+        return {self.name(i): dist for i, dist in zip(ids.tolist(), distances) if dist <= d}
+
+    def nearest(self, word, k, distances=None):
+        """
+        the words are visited in order of their lower bound, block by block, until the bound of the next block
+        exceeds the distance of the k-th best word found so far
+        words with the same distance are ordered alphabetically and the word itself is left out, like in View
+        :param distances: function(word, ids) that calculates the distances of a block, View passes its own
+        so that the calculated distances are counted
+        :return: dictionary of the k closest words and their distance, in order of increasing distance
+        """
+        if k <= 0:
+            return {}
+        bounds = self._lower_bounds(word)
+        live = numpy.flatnonzero(self.deleted == 0)
+        order = live[numpy.argsort(bounds[live], kind="stable")]
+        if distances is None:
+            query = self._query(word)
+            distances = lambda word, ids: self._distances(word, ids, query)
+        # without pivots no block can be skipped, so the words are compared in the larger batches of the kernels
+        size = Config.pivot_block_size if self.prunes else Config.batch_block_size
+        best = []
+        for start in range(0, len(order), size):
+            block = order[start:start + size]
+            if len(best) == k and bounds[block[0]] > best[-1][0]:
+                break
+            for i, dist in zip(block.tolist(), distances(word, block).tolist()):
+                # the name is only needed for words that can still make it into the k best
+                if len(best) == k and dist > best[-1][0]:
+                    continue
+                name = self.name(i)
+                if name != word and (len(best) < k or (dist, name) < best[-1]):
+                    insort(best, (dist, name))
+                    if len(best) > k:
+                        best.pop()
+        return {name: dist for dist, name in best}
+
+    def verify(self) -> bool:
+        """
+        checks that the table has a row for every word and that the row of every pivot holds its distance to itself
+        (which is not 0 for the scaled similarities)
+        :return: True if the table is consistent
+        """
+        if self.table.shape != (len(self), len(self.pivots)):
+            return False
+        itself = [self.metric.dist(self.name(p), self.name(p)) for p in self.pivots]
+        return self.table[self.pivots, numpy.arange(len(self.pivots))].tolist() == itself
+
+    def _find(self, word):
+        """ :return: id of the word, None if it is not part of the table """
+        if self._ids is None:
+            self._ids = {self.name(i): i for i in range(len(self))}
+        return self._ids.get(word)
+
+    def _thaw(self):
+        """ copies a memory mapped table into memory, so that it can be changed """
+        if self._names is None:
+            self._names = [self.name(i) for i in range(len(self))]
+            self.pivots = numpy.array(self.pivots)
+            self.table = numpy.array(self.table)
+            self.deleted = numpy.array(self.deleted)
+            # the names are in _names now, the views of the memory map are dropped so that the table can be pickled
+            self.blob = b""
+            self.name_offsets = None
+            self.path = None
+            self._mmap = None
+
+    def insert(self, word):
+        """
+        adds a word to the table, a word that was deleted before is simply restored
+        :return: True if the table changed
+        """
+        word_id = self._find(word)
+        if word_id is not None and not self.deleted[word_id]:
+            return False
+        self._thaw()
+        if word_id is not None:
+            self.deleted[word_id] = 0
+        else:
+            distance = self.metric.dist
+            row = numpy.array([[distance(word, self.name(p)) for p in self.pivots]], dtype=numpy.int32)
+            self.table = numpy.concatenate([self.table, row.reshape(1, len(self.pivots))])
+            self.deleted = numpy.append(self.deleted, numpy.uint8(0))
+            self._ids[word] = len(self._names)
+            self._names.append(word)
+        self.length += 1
+        return True
+
+    def delete(self, word):
+        """
+        removes a word from the table, it is only flagged until compact() is called
+        :return: True if the table changed
+        """
+        word_id = self._find(word)
+        if word_id is None or self.deleted[word_id]:
+            return False
+        self._thaw()
+        self.deleted[word_id] = 1
+        self.length -= 1
+        return True
+
+    def compact(self):
+        """
+        removes the rows of deleted words, deleted pivots keep their row since the columns are measured from them
+        :return: number of words that had to be inserted again, always 0 since no other row depends on a deleted one
+        """
+        if not self.deleted.any():
+            return 0
+        if self.length == 0:
+            raise ValueError("cannot remove every word of the table")
+        self._thaw()
+        keep = self.deleted == 0
+        keep[self.pivots] = True
+        ids = numpy.flatnonzero(keep)
+        new_ids = numpy.cumsum(keep) - 1
+        if self._signatures is not None:
+            self._signatures = self.signatures().take(ids)
+        self._names = [self._names[i] for i in ids]
+        self.table = self.table[ids]
+        self.deleted = self.deleted[ids]
+        self.pivots = new_ids[self.pivots].astype(numpy.int32)
+        self._ids = None
+        return 0
+
+    @staticmethod
+    def renderer(root=None, max_depth=None):
+        """ a table has no tree structure that could be drawn """
+        return None
+
+    @staticmethod
+    def get_graph(headless=False, root=None, max_depth=None):
+        return None
+
+    def statistics(self):
+        """
+        :return: dictionary with the size of the table and the share of the words the typical query radius
+        of the metric (Metric.radius) still has to look at, measured on a few sampled words
+        """
+        live = numpy.flatnonzero(self.deleted == 0)
+        sample = live[numpy.linspace(0, len(live) - 1, min(len(live), 20)).astype(int)]
+        radius = self.metric.radius
+        visited = [float((self._lower_bounds(self.name(i)) <= radius).mean()) for i in sample]
+        return {"engine": self.engine, "words": self.length, "pivots": len(self.pivots),
+                "visited_share": round(sum(visited) / len(visited), 4) if visited else 0}
+
+    def save(self, path):
+        """
+        writes the table to a binary index file (see PivotFormat)
+        :param path: path of the index file
+        """
+        names = [self.name(i).encode("UTF-8") for i in range(len(self))]
+        blob = b"".join(names)
+        offsets = numpy.concatenate([[0], numpy.cumsum([len(name) for name in names], dtype=numpy.int64)])
+        arrays = {"name_offsets": offsets, "pivots": self.pivots, "table": self.table, "deleted": self.deleted}
+        signatures = self.signatures()
+        # written next to the old file and then swapped in, like NodeStore.save()
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as f:
+            header = PivotFormat.header.pack(PivotFormat.magic, PivotFormat.version, sys.byteorder[0].encode(),
+                                             self.metric.name.encode("ascii"), len(self), len(blob),
+                                             len(self.pivots))
+            f.write(header + b"\0" * PivotFormat.padding(len(header)))
+            for attribute, dtype, _ in PivotFormat.arrays:
+                data = numpy.ascontiguousarray(arrays[attribute], dtype=dtype).tobytes()
+                f.write(data + b"\0" * PivotFormat.padding(len(data)))
+            for data in signatures.to_arrays():
+                data = data.tobytes()
+                f.write(data + b"\0" * PivotFormat.padding(len(data)))
+            f.write(blob)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def is_index(path):
+        """ :return: True if the file was written by PivotTable.save() """
+        with open(path, "rb") as f:
+            return f.read(len(PivotFormat.magic)) == PivotFormat.magic
+
+    @classmethod
+    def open(cls, path):
+        """
+        opens an index file written by save() as a read-only memory map, like NodeStore.open()
+        :param path: path of the index file
+        :return: the table
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        size = PivotFormat.header.size
+        if len(view) < size:
+            raise ValueError(f"{path} is not a pivot table index")
+        magic, version, byteorder, metric, n, blob_size, p = PivotFormat.header.unpack(view[:size])
+        if magic != PivotFormat.magic:
+            raise ValueError(f"{path} is not a pivot table index")
+        if not 1 <= version <= PivotFormat.version:
+            raise ValueError(f"{path} has index format version {version}, expected {PivotFormat.version}")
+        if byteorder != sys.byteorder[0].encode():
+            raise ValueError(f"{path} was written on a machine with a different byte order")
+
+        table = cls.__new__(cls)
+        position = size + PivotFormat.padding(size)
+        for attribute, dtype, length in PivotFormat.arrays:
+            count = length(n, p)
+            end = position + count * numpy.dtype(dtype).itemsize
+            if end > len(view):
+                raise ValueError(f"{path} is truncated")
+            setattr(table, attribute, numpy.frombuffer(mapped, dtype=dtype, count=count, offset=position))
+            position = end + PivotFormat.padding(end)
+        # older files have no signatures, they are calculated from the names when they are needed
+        table._signatures = None
+        if version >= 2:
+            try:
+                table._signatures, position = Signatures.from_buffer(mapped, position, n)
+            except ValueError:
+                raise ValueError(f"{path} is truncated")
+        if position + blob_size != len(view):
+            raise ValueError(f"{path} is truncated")
+        table.table = table.table.reshape(n, p)
+        table.blob = view[position:]
+        table.edit_dist = metric.rstrip(b"\0").decode("ascii")
+        table.metric = registry.get(table.edit_dist)
+        table.workers = 1
+        table.length = int(n - numpy.count_nonzero(table.deleted))
+        table.path = path
+        table._mmap = mapped
+        table._names = None
+        table._ids = None
+        table.tree = table
+        return table
+
+    def __reduce_ex__(self, protocol):
+        # a table backed by an index file is passed to other processes as its path, they map the same pages
+        if self.path is not None:
+            return type(self).open, (self.path,)
+        return super().__reduce_ex__(protocol)
+
+    def write_text(self, f):
+        """
+        writes the text version of the table to an open file line by line:
+        the pivots, then every word with its distance to each pivot
+        :return: number of words written
+        """
+        f.write("pivots: " + ", ".join(self.name(p) for p in self.pivots) + "\n")
+        for i in range(len(self)):
+            marker = " (deleted)" if self.deleted[i] else ""
+            f.write(f"{self.name(i)}{marker}\t" + " ".join(map(str, self.table[i].tolist())) + "\n")
+        return len(self)
+
+    def __str__(self):
+        text = io.StringIO()
+        self.write_text(text)
+        return text.getvalue()
+
+
+class Scan(PivotTable):
+    """
+    Compares every query with all words, in batches of Config.batch_block_size words (with the signature kernels
+    where the metric has them), which finds every match for any metric
+    the engine of the metrics that break the triangle inequality, for which neither the edges of a BK-tree nor
+    pivots can rule out words without missing matches
+    it is a pivot table without pivots, so it is saved, opened and updated like one
+    """
+
+    engine = "scan"
+
+    def _pivot_count(self):
+        return 0
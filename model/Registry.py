@@ -0,0 +1,125 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from model.Distances import LevenshteinDistance, HammingDistance, JaccardDistance, JaroWinklerDistance
+import numpy
+
+
+class Metric:
+    """
+    One entry of the metric registry: the functions of a string metric and what the indexes need to know about it
+    trees, tables and views look their metric up once when they are created and then call its functions directly
+    """
+
+    def __init__(self, name, dist, many=None, threshold=False, true_metric=False, value_range=(0, None),
+                 lower_bounds=(), engine=None, radius=1, signed=None):
+        """
+        :param name: short name the metric is chosen by (at most 8 ascii characters, it is stored in the index files),
+        longer names given by the user are matched by their first three characters, e.g. "levenshtein"
+        :param dist: function(w1, w2) that returns the distance of two words as integer
+        :param many: function(word, candidates) that returns an integer numpy array with the distance of every
+        candidate, calculated from dist one by one if it is not given
+        :param threshold: dist and many also take max_dist (a number or one per candidate) and may return any value
+        above it for words that are further away, which lets them stop early
+        :param true_metric: the triangle inequality holds, so BK-tree and pivot table searches find every match,
+        otherwise a BK-tree search is a (fast) approximation that may miss a few words and a pivot table has no pivots
+        :param value_range: (smallest, largest) possible distance, the largest is None if it grows with the length
+        of the words
+        :param lower_bounds: (name, function) pairs of cheap lower bounds, see LowerBounds
+        :param engine: index its queries are answered with unless another one is chosen, "bktree", "pivot" or "scan",
+        by default a BK-tree for true metrics and otherwise a scan of all words, which finds every match for any metric
+        :param radius: typical query radius, used to rate roots and pivot tables
+        :param signed: function(query, signatures, ids, name, max_dist) that calculates the distances to words of an
+        index from the Signatures the index keeps for them, the query word is encoded once with Signatures.query()
+        and name(id) returns the word for the ones that cannot be compared by their signature, None if the metric
+        has no use for signatures
+        """
+        assert name.isascii() and 0 < len(name) <= 8, "metric names are stored in 8 ascii characters"
+        self.name = name
+        self.dist = dist
+        self.many = many or self._one_by_one
+        self.threshold = threshold
+        # dist and many with an optional max_dist, which is simply ignored by metrics without a threshold variant
+        if threshold:
+            self.bounded, self.bounded_many = self.dist, self.many
+        else:
+            self.bounded = lambda w1, w2, max_dist=None: dist(w1, w2)
+            self.bounded_many = lambda word, candidates, max_dist=None: self.many(word, candidates)
+        self.true_metric = true_metric
+        self.value_range = value_range
+        self.lower_bounds = list(lower_bounds)
+        self.engine = engine or ("bktree" if true_metric else "scan")
+        self.radius = radius
+        self.signed = signed
+
+    def _one_by_one(self, word, candidates):
+        dist = self.dist
+        return numpy.fromiter((dist(word, candidate) for candidate in candidates), dtype=numpy.int64,
+                              count=len(candidates))
+
+    def __reduce__(self):
+        # worker processes look the metric up in their own registry instead of pickling its functions
+        return _lookup, (self.name,)
+
+    def __repr__(self):
+        return f"Metric({self.name!r})"
+
+
+def _lookup(name):
+    return registry.get(name)
+
+
+class MetricRegistry:
+    """
+    Maps the names of the metrics to their Metric entries
+    custom metrics are added with register(); to be available in the worker processes of the parallel build,
+    batch and server modes, they have to be registered when a module is imported, not in a main guard
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        :param metric: Metric, it replaces a registered metric of the same name
+        :return: the metric
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        """
+        :param name: name of a registered metric or a longer name starting with its first three characters
+        :return: the Metric
+        :raise TypeError: if there is no such metric
+        """
+        metric = self._metrics.get(name) or self._metrics.get(name[:3])
+        if metric is None:
+            raise TypeError(f"unknown distance metric '{name}', choose one of {', '.join(self.names())}")
+        return metric
+
+    def names(self):
+        return list(self._metrics)
+
+    def __contains__(self, name):
+        return name in self._metrics or name[:3] in self._metrics
+
+
+# the metrics every part of the program looks up its metric in
+registry = MetricRegistry()
+registry.register(Metric("lev", LevenshteinDistance.dist, LevenshteinDistance.many, threshold=True, true_metric=True,
+                         lower_bounds=LevenshteinDistance.lower_bounds))
+# Hamming counts the difference in length of words that contain each other, which breaks the triangle inequality
+# in a few cases, Jaccard and Jaro-Winkler are scaled similarities and break it more often,
+# so all three compare the query with every word
+# (Jaccard counts repeated letters in the intersection, so its distances grow above 1000 for longer words)
+registry.register(Metric("ham", HammingDistance.dist, HammingDistance.many,
+                         lower_bounds=HammingDistance.lower_bounds, signed=HammingDistance.signed))
+registry.register(Metric("jac", JaccardDistance.J, JaccardDistance.many,
+                         lower_bounds=JaccardDistance.lower_bounds, radius=100, signed=JaccardDistance.signed))
+registry.register(Metric("jar", JaroWinklerDistance.jaro_Winkler, JaroWinklerDistance.many, threshold=True,
+                         value_range=(0, JaroWinklerDistance.scale), lower_bounds=JaroWinklerDistance.lower_bounds,
+                         radius=100))
@@ -0,0 +1,163 @@
+# Konrad Brüggemann
+# Universität Potsdam
+# Bachelor Computerlinguistik
+# 4. Semester
+
+
+from array import array
+from collections import namedtuple
+from html import escape
+
+
+# positions of the drawn nodes in preorder: ids in the NodeStore, position of the parent (-1 for the root),
+# depth below the drawn root and x coordinate (in leaf widths), truncated marks nodes whose children are cut off
+Layout = namedtuple("Layout", ["ids", "parents", "depths", "xs", "truncated", "width"])
+
+
+class TreeRenderer:
+    """
+    Draws a tree or a part of it straight from the flat arrays of its NodeStore, without copying it into a graph
+    the layout is calculated in one iterative pass over the nodes in preorder and one pass back,
+    so it takes linear time and does not run into the recursion limit on deep trees
+    write_dot() streams the tree to a Graphviz file node by node, write_svg() writes a finished drawing
+    """
+
+    # size of the SVG drawing: horizontal space per leaf and vertical space per level in pixels
+    leaf_width = 70
+    level_height = 80
+    radius = 5
+
+    def __init__(self, store, root=0, max_depth=None):
+        """
+        :param store: NodeStore of the tree
+        :param root: id of the node whose subtree is drawn
+        :param max_depth: number of levels below root that are drawn, None draws all of them
+        """
+        # the children of a frozen store are a slice of one array instead of a scan over all nodes
+        if not store.frozen:
+            store.freeze()
+        self.store = store
+        self.root = root
+        self.max_depth = max_depth
+
+    def walk(self):
+        """
+        :return: generator of (node id, parent id, depth) in preorder, the parent of the root is -1
+        """
+        store = self.store
+        max_depth = self.max_depth
+        stack = [(self.root, -1, 0)]
+        while stack:
+            node, parent, depth = stack.pop()
+            yield node, parent, depth
+            if max_depth is None or depth < max_depth:
+                # pushed in reverse, so the children come out ordered by weight
+                stack.extend((child, node, depth + 1) for child in reversed(store.children(node)))
+
+    def layout(self):
+        """
+        every leaf gets its own column from left to right, every parent is centered above its first and last child
+        :return: Layout of the drawn nodes
+        """
+        store = self.store
+        ids = array("i")
+        parents = array("i")
+        depths = array("i")
+        positions = {}
+        for node, parent, depth in self.walk():
+            positions[node] = len(ids)
+            ids.append(node)
+            parents.append(positions[parent] if parent >= 0 else -1)
+            depths.append(depth)
+        n = len(ids)
+        xs = array("d", [0.0]) * n
+        lows = array("d", [float("inf")]) * n
+        highs = array("d", [float("-inf")]) * n
+        has_children = bytearray(n)
+        for position in range(1, n):
+            has_children[parents[position]] = 1
+        leaves = 0
+        for position in range(n):
+            if not has_children[position]:
+                xs[position] = leaves
+                leaves += 1
+        # going backwards, all children of a node are placed before the node itself
+        for position in range(n - 1, -1, -1):
+            if has_children[position]:
+                xs[position] = (lows[position] + highs[position]) / 2
+            parent = parents[position]
+            if parent >= 0:
+                if xs[position] < lows[parent]:
+                    lows[parent] = xs[position]
+                if xs[position] > highs[parent]:
+                    highs[parent] = xs[position]
+        truncated = bytearray(n)
+        for position in range(n):
+            if not has_children[position] and store.child_count(ids[position]) > 0:
+                truncated[position] = 1
+        return Layout(ids, parents, depths, xs, truncated, max(leaves, 1))
+
+    def write_dot(self, path):
+        """
+        writes the tree as an undirected Graphviz graph, one line per node and edge,
+        the nodes are written while walking the tree, so nothing but the stack of the walk is kept in memory
+        :return: number of nodes written
+        """
+        store = self.store
+        count = 0
+        with open(path, "w", encoding="UTF-8") as f:
+            f.write("graph bktree {\n"
+                    '  node [style=filled, fillcolor="#F3D2FF", fontname="monospace"];\n')
+            for node, parent, depth in self.walk():
+                attributes = f'label="{self._quote(store.name(node))}"'
+                if store.deleted[node]:
+                    attributes += ', fillcolor="#DDDDDD", fontcolor="#888888"'
+                if depth == self.max_depth and store.child_count(node) > 0:
+                    attributes += ", peripheries=2"
+                f.write(f"  n{node} [{attributes}];\n")
+                if parent >= 0:
+                    f.write(f'  n{parent} -- n{node} [label="{store.weights[node]}"];\n')
+                count += 1
+            f.write("}\n")
+        return count
+
+    def write_svg(self, path):
+        """
+        writes a drawing of the tree in the same layout as the graph window
+        nodes whose children are not drawn get a double circle, deleted words are grey
+        :return: number of nodes written
+        """
+        store = self.store
+        layout = self.layout()
+        width = self.leaf_width
+        height = self.level_height
+
+        def position(i):
+            return (layout.xs[i] + 0.5) * width, (layout.depths[i] + 0.5) * height
+
+        with open(path, "w", encoding="UTF-8") as f:
+            levels = (max(layout.depths) if layout.ids else 0) + 1
+            f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{layout.width * width}" '
+                    f'height="{levels * height}" font-family="monospace" font-size="12">\n')
+            # the edges are drawn first, so that the nodes are drawn on top of them
+            f.write('<g stroke="#555555">\n')
+            for i in range(1, len(layout.ids)):
+                x, y = position(i)
+                px, py = position(layout.parents[i])
+                f.write(f'<line x1="{px:.1f}" y1="{py:.1f}" x2="{x:.1f}" y2="{y:.1f}"/>'
+                        f'<text x="{(x + px) / 2:.1f}" y="{(y + py) / 2:.1f}" stroke="none" fill="#AA3333">'
+                        f'{store.weights[layout.ids[i]]}</text>\n')
+            f.write("</g>\n<g>\n")
+            for i, node in enumerate(layout.ids):
+                x, y = position(i)
+                fill = "#DDDDDD" if store.deleted[node] else "#F3D2FF"
+                stroke = ' stroke="#555555" stroke-width="3"' if layout.truncated[i] else ""
+                f.write(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="{self.radius}" fill="{fill}"{stroke}/>'
+                        f'<text x="{x:.1f}" y="{y - 2 * self.radius:.1f}" text-anchor="middle">'
+                        f"{escape(store.name(node))}</text>\n")
+            f.write("</g>\n</svg>\n")
+        return len(layout.ids)
+
+    @staticmethod
+    def _quote(name):
+        return name.replace("\\", "\\\\").replace('"', '\\"')
@@ -4,8 +4,31 @@
 # 4. Semester
 
 
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import unittest
-from model.Distances import LevenshteinDistance, HammingDistance
+from itertools import product
+from model.Auxillary import Config, Methods
+from model.BKTree import BKTree
+from model.Cache import BuildCache, QueryCache
+from model.NodeStore import NodeStore
+from model.PivotTable import PivotTable, Scan
+from model.Metrics import Metrics, metrics
+from model.Registry import Metric, registry
+from model.Distances import LevenshteinDistance, HammingDistance, JaccardDistance, JaroWinklerDistance, LowerBounds
+from model.Distances import Signatures
+from Batch import Batch
+from Controller import Controller
+from Benchmark import Benchmark, WordGenerator
+from Server import Server
+from View import View
 
 
 class BKTreeTests:
@@ -15,8 +38,21 @@ class BKTreeTests:
 
     def test_if_tree_is_correct(self):
         print("Testing tree for correctness...")
+        # trees kept in a NodeStore can be checked on its flat arrays without walking the tree
+        if hasattr(self.tree, "store"):
+            return self._test_if_store_is_correct(self.tree.store)
         return self._test_if_tree_is_correct(self.tree)
 
+    @staticmethod
+    def _test_if_store_is_correct(store):
+        # the children of every node are sorted by weight, so two edges with the same weight would be neighbours
+        weights = store.child_weights
+        for node in range(len(store)):
+            for position in range(store.child_offsets[node] + 1, store.child_offsets[node + 1]):
+                if weights[position] == weights[position - 1]:
+                    return "Tree is not a BK tree!"
+        return "No problems found."
+
     def _test_if_tree_is_correct(self, tree):
         weights = []
         for child in tree.children:
@@ -30,6 +66,35 @@ class BKTreeTests:
         return "No problems found."
 
 
+class IngestionTests(unittest.TestCase):
+
+    def _read(self, text, separator=None):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "words.txt")
+            with open(path, "w", encoding="UTF-8") as f:
+                f.write(text)
+            return list(Methods.read_words(path, separator))
+
+    def test_words_across_blocks(self):
+        block_size = Config.read_block_size
+        Config.read_block_size = 3
+        try:
+            self.assertEqual(self._read("haus\nmaus\n\nlaus"), ["haus", "maus", "", "laus"])
+            self.assertEqual(self._read("haus  maus\tla  "), ["haus", "maus", "la"])
+            self.assertEqual(self._read("haus;maus;", separator=";"), ["haus", "maus"])
+        finally:
+            Config.read_block_size = block_size
+
+    def test_separator_is_guessed(self):
+        self.assertEqual(self._read("haus, maus,laus"), ["haus", " maus", "laus"])
+        self.assertEqual(self._read("haus maus"), ["haus", "maus"])
+
+    def test_clean_list(self):
+        # neighbouring words with punctuation were skipped by the old in-place removal
+        words = ["a.b", "c,d", "e!f", "haus", " maus", "haus", "Ba\u0308r", "B\u00e4r", "x1"]
+        self.assertEqual(Methods.clean_list(iter(words)), ["B\u00e4r", "haus", "maus"])
+
+
 class LevenshteinTests(unittest.TestCase):
 
     def test_insertion(self):
@@ -49,6 +114,731 @@ class LevenshteinTests(unittest.TestCase):
         result = LevenshteinDistance.dist("copyright", "modesty")
         self.assertEqual(result, 8)
 
+    def test_within_bound(self):
+        result = LevenshteinDistance.dist("copyright", "modesty", max_dist=8)
+        self.assertEqual(result, 8)
+
+    def test_exceeding_bound(self):
+        result = LevenshteinDistance.dist("copyright", "modesty", max_dist=3)
+        self.assertEqual(result, 4)
+
+
+class JaroWinklerTests(unittest.TestCase):
+
+    # distances of the original list based implementation
+    pairs = [("martha", "marhta", 38), ("dixon", "dicksonx", 186), ("jellyfish", "smellyfish", 103),
+             ("hose", "hase", 150), ("a", "b", 1000), ("abcabc", "cbacba", 111), ("straße", "strasse", 90)]
+
+    def test_known_distances(self):
+        for w1, w2, expected in self.pairs:
+            self.assertEqual(JaroWinklerDistance.jaro_Winkler(w1, w2), expected)
+
+    def test_threshold(self):
+        for w1, w2, expected in self.pairs:
+            for bound in [0, 50, 100, 150, 200, 999]:
+                result = JaroWinklerDistance.jaro_Winkler(w1, w2, max_dist=bound)
+                self.assertEqual(result, expected if expected <= bound else bound + 1)
+
+    def test_batch_threshold(self):
+        candidates = BatchKernelTests.candidates
+        for bound in [100, 300]:
+            expected = [min(JaroWinklerDistance.jaro_Winkler(c, "hello"), bound + 1) for c in candidates]
+            self.assertEqual(JaroWinklerDistance.many("hello", candidates, max_dist=bound).tolist(), expected)
+            self.assertEqual(JaroWinklerDistance.many("hello", candidates[:3], max_dist=[bound] * 3).tolist(),
+                             expected[:3])
+
+
+class BatchKernelTests(unittest.TestCase):
+
+    candidates = ["hello", "mellow", "yellow", "hallo", "help", "hell", "o", "", "olleh", "helloworld", "Hello"]
+
+    def _assert_same_as_scalar(self, many, scalar):
+        for word in ["hello", "low", "h", "wörld"]:
+            self.assertEqual(many(word, self.candidates).tolist(), [scalar(c, word) for c in self.candidates])
+
+    def test_levenshtein(self):
+        self._assert_same_as_scalar(LevenshteinDistance.many, LevenshteinDistance.dist)
+
+    def test_levenshtein_bound(self):
+        self.assertEqual(LevenshteinDistance.many("hello", self.candidates, max_dist=1).tolist(),
+                         [LevenshteinDistance.dist(c, "hello", 1) for c in self.candidates])
+
+    def test_hamming(self):
+        self._assert_same_as_scalar(HammingDistance.many, HammingDistance.dist)
+
+    def test_jaccard(self):
+        self._assert_same_as_scalar(JaccardDistance.many, JaccardDistance.J)
+
+    def test_jaro_winkler(self):
+        self._assert_same_as_scalar(JaroWinklerDistance.many, JaroWinklerDistance.jaro_Winkler)
+
+
+class SignatureTests(unittest.TestCase):
+
+    # repeated letters beyond the layers and letters outside of the alphabet are calculated from the names
+    words = BatchKernelTests.candidates + ["aaaaaa", "straße", "ßß", "日本語"]
+
+    def test_same_as_batch_kernels(self):
+        signatures = Signatures.build(self.words)
+        self.assertEqual(signatures.exact.tolist().count(0), 1)
+        ids = list(range(len(self.words)))
+        for word in ["hello", "low", "h", "wörld", "aaa", "日本", ""]:
+            query = signatures.query(word)
+            for metric in [JaccardDistance, HammingDistance]:
+                self.assertEqual(metric.signed(query, signatures, ids, self.words.__getitem__).tolist(),
+                                 metric.many(word, self.words).tolist())
+                self.assertEqual(metric.signed(query, signatures, ids[:3], self.words.__getitem__).tolist(),
+                                 metric.many(word, self.words[:3]).tolist())
+
+    def test_saved_with_the_tree(self):
+        tree = BKTree(list(self.words), "jac", workers=1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tree.bkidx")
+            tree.save(path)
+            store, _ = NodeStore.open(path)
+            self.assertEqual(store.signatures().masks.tolist(), tree.store.signatures().masks.tolist())
+            tree = BKTree.from_store(store, "jac")
+            tree.insert("hellohello")
+            self.assertEqual(len(store.signatures()), len(store))
+            view = View(tree.tree, "jac")
+            # repeated letters are counted in the intersection, so the largest distance is above 1000
+            self.assertEqual(set(view.search("hello", d=10000)), set(tree.names()))
+
+    def test_pivot_table(self):
+        table = PivotTable(list(self.words), "jac", workers=1)
+        view = View(table.tree, "jac")
+        table.insert("lowlow")
+        table.delete("hello")
+        table.compact()
+        self.assertEqual(len(table.signatures()), len(table))
+        for word in ["low", "hell", "ß"]:
+            names = table.candidates(word, 500)
+            expected = {w: d for w, d in zip(names, JaccardDistance.many(word, names).tolist()) if d <= 500}
+            self.assertEqual(view.search(word, d=500), expected)
+            self.assertEqual(table.matches(word, 500), expected)
+
+
+class LowerBoundTests(unittest.TestCase):
+
+    words = ["".join(letters) for letters in product("abc", repeat=4)] + ["", "a", "cab", "abcabc", "bbbbbbb"]
+
+    def test_bounds_below_distance(self):
+        for word in ["", "abc", "aabb", "cccccc"]:
+            exact = LevenshteinDistance.many(word, self.words)
+            self.assertTrue((LowerBounds.length(word, self.words) <= exact).all())
+            self.assertTrue((LowerBounds.bag(word, self.words) <= exact).all())
+            self.assertTrue((LowerBounds.length(word, self.words) <= HammingDistance.many(word, self.words)).all())
+
+    def test_bag_scalar_and_batch_agree(self):
+        for word in ["abc", "aabb"]:
+            self.assertEqual(LowerBounds.bag(word, self.words).tolist(),
+                             [LowerBounds.bag(word, [candidate])[0] for candidate in self.words])
+
+    def test_cascade_keeps_matches(self):
+        table = PivotTable(list(self.words), edit_dist="lev", workers=1)
+        view = View(table.tree, "lev")
+        for word in ["abc", "aabb", "cccc"]:
+            self.assertEqual(view._get_matches(word, 2, table), table.matches(word, 2))
+        stats = view.filter_stats(reset=True)
+        self.assertGreater(stats["rejected"]["bag"], 0)
+        self.assertEqual(view.filter_stats()["exact"], 0)
+
+
+class NodeStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        # 64 words, enough to skip plotting
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        self.tree = BKTree(list(self.words), edit_dist="lev")
+
+    def test_every_word_stored_once(self):
+        store = self.tree.store
+        self.assertEqual(sorted(store.name(i) for i in range(len(store))), sorted(self.words))
+
+    def test_edge_weights(self):
+        store = self.tree.store
+        for node in range(1, len(store)):
+            parent = store.parents[node]
+            self.assertEqual(store.weights[node], LevenshteinDistance.dist(store.name(node), store.name(parent)))
+
+    def test_verify(self):
+        self.assertTrue(self.tree.store.verify())
+        store = NodeStore()
+        store.add_node("abc", -1, 0)
+        store.add_node("abd", 0, 1)
+        store.add_node("xbc", 0, 1)
+        self.assertFalse(store.verify())
+
+    def test_children_in_range(self):
+        store = self.tree.store
+        for node in range(len(store)):
+            weights = [store.weights[child] for child in store.children(node)]
+            self.assertEqual(weights, sorted(weights))
+            in_range = [child for child in store.children(node) if 1 <= store.weights[child] <= 2]
+            self.assertEqual(list(store.children_in_range(node, 1, 2)), in_range)
+
+    def test_parallel_build_is_identical(self):
+        serial = self.tree.store
+        Config.parallel_build_size, size = 10, Config.parallel_build_size
+        try:
+            parallel = BKTree(list(self.words), edit_dist="lev", workers=3).store
+        finally:
+            Config.parallel_build_size = size
+
+        def edges(store):
+            return sorted((store.name(store.parents[i]), store.weights[i], store.name(i)) for i in range(1, len(store)))
+        self.assertEqual(edges(serial), edges(parallel))
+
+    def test_index_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tree.bkidx")
+            self.tree.store.save(path, metric="lev")
+            store, metric = NodeStore.open(path)
+            self.assertEqual(metric, "lev")
+            self.assertEqual(store.names(), self.tree.store.names())
+            self.assertEqual(list(store.child_weights), list(self.tree.store.child_weights))
+            self.assertEqual(BKTreeTests(store.node(0)).test_if_tree_is_correct(), "No problems found.")
+            del store
+
+    def test_scratch_data_dropped(self):
+        self.assertFalse(hasattr(self.tree, "dist_to_root"))
+        self.assertFalse(hasattr(self.tree, "word_list"))
+        self.assertTrue(self.tree.store.frozen)
+
+
+class QueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)] + ["abcdd", "dcba", "ab", "a"]
+        self.tree = BKTree(list(self.words), edit_dist="lev")
+        self.view = View(self.tree.tree, "lev")
+
+    def _brute_force(self, word):
+        return sorted((LevenshteinDistance.dist(word, w), w) for w in self.words if w != word)
+
+    def test_get_matches(self):
+        for word in ["abc", "bd", "dddd", "xyz"]:
+            expected = {w: dist for dist, w in self._brute_force(word) if dist <= 1}
+            self.assertEqual(self.view._get_matches(word, 1, self.tree.tree), {**expected, **(
+                {word: 0} if word in self.words else {})})
+
+    def test_nearest(self):
+        for word in ["abc", "bd", "dddd", "xyz"]:
+            for k in [1, 3, 10]:
+                self.assertEqual(self.view.nearest(word, k), [w for _, w in self._brute_force(word)[:k]])
+
+    def test_chosen_root(self):
+        for pivot in ["fanout", "visits"]:
+            tree = BKTree(list(self.words), edit_dist="lev", workers=1, pivot=pivot)
+            index, _ = BKTree.choose_root(sorted(set(self.words)), "lev", pivot)
+            self.assertEqual(tree.statistics()["root"], sorted(set(self.words))[index])
+            self.assertEqual(BKTreeTests._test_if_store_is_correct(tree.store), "No problems found.")
+            view = View(tree.tree, "lev")
+            self.assertEqual(sorted(view.get_matches("abc", 1)), sorted(self.view.get_matches("abc", 1)))
+
+
+class PivotTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)] + ["abcdd", "dcba", "ab", "a"]
+        self.table = PivotTable(list(self.words), edit_dist="lev", workers=1)
+        self.view = View(self.table.tree, "lev")
+
+    def _brute_force(self, word):
+        return sorted((LevenshteinDistance.dist(word, w), w) for w in self.words if w != word)
+
+    def test_matches_and_nearest(self):
+        for word in ["abc", "bd", "dddd", "xyz"]:
+            self.assertEqual(sorted(self.view.get_matches(word, 1)),
+                             sorted(w for dist, w in self._brute_force(word) if dist <= 1))
+            self.assertEqual(self.view.nearest(word, 3), [w for _, w in self._brute_force(word)[:3]])
+
+    def test_index_file_and_updates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.bkidx")
+            self.table.save(path)
+            self.assertTrue(PivotTable.is_index(path))
+            table = PivotTable.open(path)
+            self.assertTrue(table.verify())
+            self.assertEqual(table.names(), self.table.names())
+            self.assertTrue(table.insert("abcda"))
+            self.assertTrue(table.delete(table.name(table.pivots[1])))
+            self.assertTrue(table.delete("dcba"))
+            table.compact()
+            table.save(path)
+            table = PivotTable.open(path)
+            expected = set(self.words) - {"dcba", self.table.name(self.table.pivots[1])} | {"abcda"}
+            self.assertEqual(set(table.names()), expected)
+            self.assertEqual(table.matches("abcda", 0), {"abcda": 0})
+            self.assertNotIn("dcba", table.nearest("dcb", 10))
+
+    def test_scan(self):
+        scan = Scan(list(self.words), edit_dist="lev", workers=1)
+        self.assertEqual(len(scan.pivots), 0)
+        self.assertEqual((scan.statistics()["engine"], scan.statistics()["visited_share"]), ("scan", 1.0))
+        view = View(scan.tree, "lev")
+        self.assertEqual(view.nearest("abc", 3), [w for _, w in self._brute_force("abc")[:3]])
+        self.assertNotIn("pivot", view.rejected)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scan.bkidx")
+            scan.save(path)
+            self.assertIsInstance(pickle.loads(pickle.dumps(Scan.open(path))), Scan)
+
+    def test_changed_table_can_be_pickled(self):
+        # a changed table is no longer backed by its file, so it is sent to spawned workers as a whole
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.bkidx")
+            self.table.save(path)
+            table = PivotTable.open(path)
+            self.assertTrue(table.insert("abcda"))
+            copy = pickle.loads(pickle.dumps(table))
+            self.assertIsNone(copy.path)
+            self.assertEqual(copy.names(), table.names())
+            self.assertEqual(copy.matches("abcda", 0), {"abcda": 0})
+
+
+class RecallTests(unittest.TestCase):
+    """ the default engine of every metric has to find the same words as comparing the query with all of them """
+
+    words = WordGenerator(5).words(600)
+
+    def _brute_force(self, metric, word):
+        distances = registry.get(metric).many(word, self.words).tolist()
+        return sorted((dist, w) for dist, w in zip(distances, self.words) if w != word)
+
+    def test_scaled_metrics(self):
+        queries = WordGenerator(6).queries(self.words, 15)
+        for metric in ["jac", "jar"]:
+            # a pivot table of these metrics has no pivots, so it has to find the same words as the scan
+            for table in [Scan(list(self.words), metric, workers=1), PivotTable(list(self.words), metric, workers=1)]:
+                self.assertFalse(table.prunes)
+                view = View(table.tree, metric)
+                radius = registry.get(metric).radius
+                for word in queries:
+                    expected = self._brute_force(metric, word)
+                    self.assertEqual(sorted(view.get_matches(word, radius)),
+                                     sorted(w for dist, w in expected if dist <= radius))
+                    self.assertEqual(view.nearest(word, 5), [w for _, w in expected[:5]])
+                self.assertNotIn("pivot", view.rejected)
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        self.tree = BKTree(list(self.words), edit_dist="lev")
+
+    def _run(self, workers, **query):
+        out = io.StringIO()
+        batch = Batch(self.tree.tree, "lev", workers=workers, **query)
+        batch.run(["abc\n", "abc\n", "\n", "xyz\n", "bd\n"], out)
+        return [json.loads(line) for line in out.getvalue().splitlines()], batch
+
+    def test_radius(self):
+        results, batch = self._run(workers=1, d=1)
+        self.assertEqual([result["query"] for result in results], ["abc", "xyz", "bd"])
+        self.assertEqual(batch.duplicates, 1)
+        view = View(self.tree.tree, "lev")
+        self.assertEqual([match for match, _ in results[0]["matches"]], sorted(view.get_matches("abc", 1)))
+
+    def test_workers_give_same_results(self):
+        self.assertEqual(self._run(workers=1, k=3)[0], self._run(workers=2, k=3)[0])
+
+    def test_workers_only_report_their_queries(self):
+        # forked workers start with a copy of the metrics of the build, which must not be sent back
+        metrics.reset()
+        tree = BKTree(list(self.words), edit_dist="lev", workers=1)
+        build_calls = metrics.counters["distance.lev"]
+        batch = Batch(tree.tree, "lev", workers=2, d=1)
+        batch.run(["abc\n", "xyz\n", "bd\n", "dcba\n"], io.StringIO())
+        self.assertEqual(metrics.counters["distance.lev"], build_calls + batch.exact)
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        self.tree = BKTree(list(self.words), edit_dist="lev")
+
+    async def _session(self, requests, **options):
+        server = await Server(self.tree.tree, "lev", workers=1, **options).start()
+        try:
+            reader, writer = await asyncio.open_connection(server.host, server.port)
+            for request in requests:
+                writer.write(request.encode("UTF-8") + b"\n")
+            await writer.drain()
+            answers = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            await writer.wait_closed()
+            return {answer.get("id"): answer for answer in answers}, server.stats()
+        finally:
+            await server.close()
+
+    def test_queries(self):
+        answers, stats = asyncio.run(self._session([
+            '{"id": 1, "word": "abc", "d": 1}', '{"id": 2, "word": "abc", "k": 3}', '{"id": 3, "word": "abc"}']))
+        view = View(self.tree.tree, "lev")
+        self.assertEqual(sorted(match for match, _ in answers[1]["matches"]), sorted(view.get_matches("abc", 1)))
+        self.assertEqual([match for match, _ in answers[2]["matches"]], view.nearest("abc", 3))
+        self.assertIn("error", answers[3])
+        self.assertEqual((stats["requests"], stats["errors"]), (3, 1))
+
+    def test_bad_requests(self):
+        answers, stats = asyncio.run(self._session([
+            '{"id": 1, "word": "", "d": 1}', '{"id": 2, "word": "abc", "d": 1, "k": 2}',
+            '{"id": 3, "word": "abc", "d": "1"}', '{"id": 4, "word": "abc", "k": true}', '[1]']))
+        self.assertTrue(all(answer["error"].startswith("bad request") for answer in answers.values()))
+        self.assertEqual(stats["errors"], 5)
+
+    def test_failed_query_is_answered(self):
+        server = Server(self.tree.tree, "lev", workers=1)
+
+        async def query(word, d=None, k=None):
+            raise RuntimeError("worker died")
+
+        server.query = query
+        answer = asyncio.run(server._answer('{"id": 1, "word": "abc", "d": 1}'))
+        self.assertEqual((answer["id"], answer["error"]), (1, "query failed: RuntimeError: worker died"))
+        self.assertEqual(server.errors, 1)
+
+    def test_identical_queries_are_coalesced(self):
+        answers, stats = asyncio.run(self._session([f'{{"id": {i}, "word": "abd", "k": 5}}' for i in range(8)]))
+        self.assertEqual(len({json.dumps(answer["matches"]) for answer in answers.values()}), 1)
+        self.assertGreater(stats["coalesced"], 0)
+
+    def test_busy(self):
+        answers, stats = asyncio.run(self._session(['{"id": 1, "word": "abc", "d": 1}'], max_pending=0))
+        self.assertEqual(answers[1]["error"], "busy")
+        self.assertEqual(stats["rejected"], 1)
+
+
+class IncrementalUpdateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        self.tree = BKTree(list(self.words), edit_dist="lev")
+
+    def _assert_words(self, words):
+        view = View(self.tree.tree, "lev")
+        for word in ["abc", "ddd", "xyz", "bb"]:
+            expected = {w: LevenshteinDistance.dist(word, w) for w in words if LevenshteinDistance.dist(word, w) <= 1}
+            self.assertEqual(view._get_matches(word, 1, self.tree.tree), expected)
+
+    def test_insert(self):
+        self.assertTrue(self.tree.insert("xyz"))
+        self.assertFalse(self.tree.insert("abc"))
+        self._assert_words(self.words + ["xyz"])
+
+    def test_delete_and_compact(self):
+        removed = ["abc", "aaa", self.tree.store.name(1)]
+        for word in removed:
+            self.assertTrue(self.tree.delete(word))
+        self.assertFalse(self.tree.delete("xyz"))
+        remaining = [w for w in self.words if w not in removed]
+        self._assert_words(remaining)
+        self.tree.compact()
+        self.assertEqual(sorted(self.tree.store.names()), sorted(remaining))
+        self._assert_words(remaining)
+        self.assertEqual(BKTreeTests(self.tree.tree).test_if_tree_is_correct(), "No problems found.")
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram_and_callbacks(self):
+        metrics = Metrics()
+        events = []
+        metrics.subscribe(lambda *event: events.append(event))
+        for value in [0.05, 3, 3, 7000]:
+            metrics.observe("latency", value)
+        with metrics.phase("build"):
+            metrics.count("calls", 2)
+        histogram = metrics.snapshot()["histograms"]["latency"]
+        self.assertEqual((histogram["count"], histogram["max"]), (4, 7000))
+        self.assertEqual((histogram["buckets"][0], histogram["buckets"][Metrics.buckets.index(5)],
+                          histogram["buckets"][-1]), (1, 2, 1))
+        self.assertEqual([event[:2] for event in events][-2:], [("count", "calls"), ("phase", "build")])
+
+    def test_take_and_merge(self):
+        worker, main = Metrics(), Metrics()
+        for _ in range(2):
+            worker.count("calls")
+            worker.observe("latency", 1)
+            main.merge(worker.take())
+        self.assertEqual(worker.snapshot()["counters"], {})
+        self.assertEqual(main.counters["calls"], 2)
+        self.assertEqual(main.histograms["latency"]["count"], 2)
+
+    def test_build_and_query_are_reported(self):
+        metrics = Metrics()
+        words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        tree = BKTree(list(words), edit_dist="lev", workers=1, metrics=metrics)
+        self.assertEqual(set(metrics.phases), {"clean", "root_distances", "insert"})
+        build_calls = metrics.counters["distance.lev"]
+        view = View(tree.tree, "lev", metrics=metrics)
+        view.get_matches("abc", 1)
+        self.assertEqual(metrics.counters["query.range"], 1)
+        self.assertEqual(metrics.counters["distance.lev"] - build_calls, view.filter_stats()["exact"])
+        self.assertGreater(metrics.counters["query.nodes_pruned"], 0)
+
+    def test_cleaned_list_is_not_cleaned_again(self):
+        metrics = Metrics()
+        words = Methods.clean_list(["hose", "hase", "rose", "hase", "Häuser"])
+        tree = BKTree(words, edit_dist="lev", workers=1, metrics=metrics, cleaned=True)
+        self.assertNotIn("clean", metrics.phases)
+        self.assertEqual(sorted(tree.names()), words)
+        self.assertEqual(str(tree.tree), str(BKTree(words, edit_dist="lev", workers=1).tree))
+
+    def test_pivot_nearest_is_reported(self):
+        metrics = Metrics()
+        words = ["".join(letters) for letters in product("abcd", repeat=3)]
+        table = PivotTable(list(words), edit_dist="lev", workers=1, metrics=metrics)
+        self.assertEqual(set(metrics.phases), {"clean", "pivots"})
+        self.assertEqual(metrics.counters["distance.lev"], len(table.pivots) * len(words))
+        metrics.reset()
+        view = View(table.tree, "lev", metrics=metrics)
+        view.nearest("abc", 3)
+        stats = view.filter_stats()
+        self.assertGreater(stats["exact"], 0)
+        self.assertEqual(stats["exact"] + stats["rejected"]["pivot"], table.length)
+        self.assertEqual(metrics.counters["distance.lev"], stats["exact"] + len(table.pivots))
+        self.assertEqual(metrics.counters["query.nodes_visited"], stats["exact"])
+
+
+class TextFormatTests(unittest.TestCase):
+
+    def test_text_round_trip(self):
+        words = ["hose", "hase", "rose", "nase", "haus", "maus", "laus", "häuser"]
+        tree = BKTree(words, edit_dist="lev", workers=1)
+        tree.delete("maus")
+        text = io.StringIO()
+        self.assertEqual(tree.write_text(text), len(words))
+        self.assertEqual(text.getvalue(), str(tree.tree))
+        self.assertIn("'maus') deleted", text.getvalue())
+        calls = metrics.counters.get("distance.lev", 0)
+        loaded = BKTree.read_text(io.StringIO(text.getvalue()), edit_dist="lev")
+        self.assertEqual(metrics.counters.get("distance.lev", 0), calls)
+        self.assertEqual(sorted(loaded.names()), sorted(set(words) - {"maus"}))
+        self.assertEqual([tree.store.name(i) for i in tree.store.children(0)],
+                         [loaded.store.name(i) for i in loaded.store.children(0)])
+        view = View(loaded.tree, "lev", cache_size=0)
+        self.assertEqual(view.search("hause", d=1), View(tree.tree, "lev", cache_size=0).search("hause", d=1))
+        self.assertEqual(BKTreeTests(loaded.tree).test_if_tree_is_correct(), "No problems found.")
+
+    def test_names_that_need_escaping(self):
+        store = NodeStore.read_text(["(0, 'a')\n", "\t(1, \"it's\")\n", "\t\t(2, 'x\\\\y')\n"])
+        self.assertEqual(store.names(), ["a", "it's", "x\\y"])
+        text = io.StringIO()
+        store.write_text(text)
+        self.assertEqual(NodeStore.read_text(io.StringIO(text.getvalue())).names(), store.names())
+
+    def test_deep_tree_does_not_recurse(self):
+        store = NodeStore()
+        for i in range(5000):
+            store.add_node(name=f"w{i}", parent=i - 1, weight=1)
+        text = io.StringIO()
+        store.write_text(text)
+        self.assertEqual(len(NodeStore.read_text(io.StringIO(text.getvalue()))), 5000)
+
+
+class RendererTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = BKTree(["hose", "hase", "rose", "nase", "haus", "maus", "laus"], edit_dist="lev", workers=1)
+
+    def test_parents_are_centered_above_their_children(self):
+        layout = self.tree.renderer().layout()
+        self.assertEqual(len(layout.ids), 7)
+        self.assertEqual(sorted(layout.xs[i] for i in range(7) if i not in layout.parents), list(range(layout.width)))
+        for position in set(layout.parents) - {-1}:
+            children = [layout.xs[i] for i in range(7) if layout.parents[i] == position]
+            self.assertEqual(layout.xs[position], (min(children) + max(children)) / 2)
+            self.assertTrue(all(layout.depths[i] == layout.depths[position] + 1
+                                for i in range(7) if layout.parents[i] == position))
+
+    def test_partial_subtree(self):
+        store = self.tree.store
+        renderer = self.tree.renderer(max_depth=1)
+        layout = renderer.layout()
+        self.assertEqual(len(layout.ids), 1 + store.child_count(0))
+        self.assertEqual(list(layout.truncated), [0] + [int(store.child_count(i) > 0) for i in layout.ids[1:]])
+        child = store.children(0)[0]
+        self.assertEqual(self.tree.renderer(root=store.name(child)).layout().ids[0], child)
+        with self.assertRaises(KeyError):
+            self.tree.renderer(root="xyz")
+
+    def test_dot_and_svg_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            renderer = self.tree.renderer()
+            self.assertEqual(renderer.write_dot(os.path.join(directory, "tree.dot")), 7)
+            with open(os.path.join(directory, "tree.dot"), encoding="UTF-8") as f:
+                dot = f.read()
+            self.assertEqual(dot.count(" -- "), 6)
+            self.assertIn('label="laus"', dot)
+            self.assertEqual(renderer.write_svg(os.path.join(directory, "tree.svg")), 7)
+            with open(os.path.join(directory, "tree.svg"), encoding="UTF-8") as f:
+                svg = f.read()
+            self.assertEqual(svg.count("<circle"), 7)
+            self.assertEqual(svg.count("<line"), 6)
+
+
+class RegistryTests(unittest.TestCase):
+
+    def tearDown(self):
+        registry._metrics.pop("lcp", None)
+
+    def test_lookup(self):
+        self.assertIs(registry.get("levenshtein"), registry.get("lev"))
+        self.assertIs(registry.get("jaro_winkler"), registry.get("jar"))
+        self.assertIs(registry.get("jaccard"), registry.get("jac"))
+        self.assertTrue(registry.get("lev").true_metric)
+        self.assertEqual(registry.get("jar").value_range, (0, 1000))
+        self.assertEqual(registry.get("jac").value_range, (0, None))
+        self.assertEqual(registry.get("lev").engine, "bktree")
+        self.assertEqual(registry.get("jar").engine, "scan")
+        self.assertEqual(registry.get("ham").engine, "scan")
+        with self.assertRaises(TypeError):
+            registry.get("cosine")
+        self.assertIs(pickle.loads(pickle.dumps(registry.get("ham"))), registry.get("ham"))
+
+    def test_custom_metric(self):
+        # distance between two words: the letters that are not part of their common prefix
+        def lcp(w1, w2):
+            common = len(os.path.commonprefix([w1, w2]))
+            return len(w1) + len(w2) - 2 * common
+
+        registry.register(Metric("lcp", lcp))
+        words = ["hose", "hosen", "hase", "haus", "rose", "hosentasche"]
+        tree = BKTree(words, edit_dist="lcp", workers=1)
+        self.assertEqual(tree.statistics()["nodes"], len(words))
+        matches = View(tree.tree, "lcp", cache_size=0).search("hose", d=1)
+        self.assertEqual(matches, {"hose": 0, "hosen": 1})
+        self.assertEqual(list(registry.get("lcp").many("hose", ["hase", "rose"])), [6, 8])
+
+
+class StartupTests(unittest.TestCase):
+
+    def test_plotting_libraries_are_not_imported(self):
+        # the plotting libraries are only needed for --plot, they would double the start up time of every other run
+        code = "import sys, Controller; print('matplotlib' in sys.modules or 'networkx' in sys.modules)"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "False")
+
+    def test_pivot_table_has_no_graph(self):
+        self.assertIsNone(PivotTable(["hose", "hase", "rose"], edit_dist="jar", workers=1).get_graph())
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_generator_is_reproducible(self):
+        words = WordGenerator(seed=3).words(500)
+        self.assertEqual(words, WordGenerator(seed=3).words(500))
+        self.assertNotEqual(words, WordGenerator(seed=4).words(500))
+        self.assertEqual(len(set(words)), 500)
+        self.assertTrue(all(word.isalpha() for word in words))
+
+    def test_run_records_every_mode(self):
+        benchmark = Benchmark(sizes=[200], metrics=["ham", "jar"], queries=5, kernel_size=100, workers=1)
+        with contextlib.redirect_stderr(io.StringIO()):
+            results = benchmark.run()["results"]
+        self.assertIn("kernel/ham/batch", results)
+        # the BK-tree is built for every metric, the scan of the metrics that use one by default as well
+        self.assertIn("build/jar/200/workers=1", results)
+        self.assertIn("build/jar/200/scan/workers=1", results)
+        self.assertGreater(results["build/ham/200/workers=1"]["peak_mb"], 0)
+        self.assertEqual({"query/ham/200/d=1", "query/ham/200/d=2", "query/ham/200/d=3", "query/ham/200/k=5"},
+                         {name for name in results if name.startswith("query/ham")})
+
+    def test_compare_finds_regressions(self):
+        baseline = {"results": {"a": {"seconds": 1.0}, "b": {"seconds": 1.0}, "tiny": {"seconds": 0.0001}}}
+        results = {"results": {"a": {"seconds": 1.1}, "b": {"seconds": 2.0}, "tiny": {"seconds": 0.0005},
+                               "new": {"seconds": 5.0}}}
+        self.assertEqual(Benchmark.compare(results, baseline, tolerance=0.25), [("b", 1.0, 2.0, 1.0)])
+        self.assertEqual(Benchmark.compare(results, baseline, tolerance=1.5), [])
+
+
+class QueryCacheTests(unittest.TestCase):
+
+    def test_smaller_radius_is_filtered(self):
+        cache = QueryCache(max_entries=2)
+        cache.put("abc", 2, {"abc": 0, "abd": 1, "xbd": 2})
+        self.assertEqual(cache.get("abc", 1), {"abc": 0, "abd": 1})
+        self.assertIsNone(cache.get("abc", 3))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_larger_radius_replaces_smaller(self):
+        cache = QueryCache(max_entries=2)
+        cache.put("abc", 1, {"abc": 0})
+        cache.put("abc", 2, {"abc": 0, "xbd": 2})
+        cache.put("abc", 1, {"abc": 0})
+        self.assertEqual(cache.get("abc", 2), {"abc": 0, "xbd": 2})
+
+    def test_least_recently_used_is_evicted(self):
+        cache = QueryCache(max_entries=2)
+        cache.put("a", 1, {})
+        cache.put("b", 1, {})
+        cache.get("a", 1)
+        cache.put("c", 1, {})
+        self.assertIsNone(cache.get("b", 1))
+        self.assertEqual(cache.get("a", 1), {})
+        self.assertEqual(cache.evictions, 1)
+
+
+class BuildCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = BuildCache(self.directory.name, max_bytes=100)
+        self.list_path = os.path.join(self.directory.name, "words.txt")
+        with open(self.list_path, "w", encoding="UTF-8") as f:
+            f.write("abc\nabd")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_index(self, key, size):
+        with open(self.cache.index_path(key), "wb") as f:
+            f.write(b"\0" * size)
+
+    def test_key_depends_on_content_and_metric(self):
+        key = BuildCache.key(["abc", "abd"], "lev")
+        self.assertEqual(key, BuildCache.key(["abc", "abd"], "levenshtein"))
+        self.assertNotEqual(key, BuildCache.key(["abc", "abe"], "lev"))
+        self.assertNotEqual(key, BuildCache.key(["abc", "abd"], "ham"))
+
+    def test_diff_key(self):
+        key = BuildCache.diff_key("base", ["x", "y"], ["abc"])
+        self.assertEqual(key, BuildCache.diff_key("base", ["y", "x", "x"], ["abc"]))
+        self.assertNotEqual(key, BuildCache.diff_key("base", ["x", "y", "abc"], []))
+        self.assertNotEqual(key, BuildCache.diff_key("other", ["x", "y"], ["abc"]))
+
+    def test_diff_needs_saved_tree(self):
+        output_dir = Config.output_dir
+        Config.output_dir = self.directory.name
+        try:
+            controller = Controller(self.list_path, demo=None, dist="lev", add=self.list_path)
+            with contextlib.redirect_stdout(io.StringIO()), self.assertRaises(SystemExit):
+                controller.main()
+        finally:
+            Config.output_dir = output_dir
+
+    def test_lookup_notices_changed_file(self):
+        self._write_index("k1", 10)
+        self.cache.remember(self.list_path, "lev", "k1")
+        self.assertEqual(self.cache.lookup(self.list_path, "lev"), "k1")
+        self.assertIsNone(self.cache.lookup(self.list_path, "ham"))
+        with open(self.list_path, "a", encoding="UTF-8") as f:
+            f.write("\nabe")
+        self.assertIsNone(self.cache.lookup(self.list_path, "lev"))
+        self.assertEqual(self.cache.previous(self.list_path, "lev"), "k1")
+
+    def test_least_recently_used_is_evicted(self):
+        for number, key in enumerate(["old", "new", "current"]):
+            self._write_index(key, 60)
+            os.utime(self.cache.index_path(key), (number, number))
+        self.assertEqual(self.cache.evict(keep="current"), ["old", "new"])
+        self.assertTrue(self.cache.has("current"))
+
 
 if __name__ == '__main__':
     unittest.main()